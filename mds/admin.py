@@ -20,6 +20,12 @@ class ProviderAdmin(admin.ModelAdmin):
     list_filter = ["operator"]
     ordering = ["name"]
 
+    def delete_queryset(self, request, queryset):
+        # Bulk deletion doesn't call Provider.delete()
+        provider_ids = list(queryset.values_list("pk", flat=True))
+        super().delete_queryset(request, queryset)
+        models.invalidate_provider_config(*provider_ids)
+
 
 @admin.register(models.Device)
 class DeviceAdmin(admin.ModelAdmin):
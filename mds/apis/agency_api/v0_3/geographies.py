@@ -1,27 +1,31 @@
 from rest_framework import exceptions
-from rest_framework import response
+from rest_framework import serializers
 from rest_framework import viewsets
 
 from mds import models
+from mds.apis import utils as apis_utils
 
 
-class GeographyViewSet(viewsets.ReadOnlyModelViewSet):
+class GeographiesSerializer(serializers.Serializer):
+    def to_representation(self, policy):
+        # We already dump the geographies as a dict of FeatureCollections
+        # Just flatten the dict to a list
+        return {
+            # Geographies already stored in the GeoJSON format
+            "type": "FeatureCollection",
+            "features": list(policy.geographies.values()),
+        }
+
+
+class GeographyViewSet(
+    apis_utils.PublishedPoliciesCacheMixin, viewsets.ReadOnlyModelViewSet
+):
     permission_classes = ()  # Public endpoint
     # Allow to access geographies from any published policy
     # Past or future, active or superseded by another policy
     queryset = models.Policy.objects.filter(published_date__isnull=False)
+    serializer_class = GeographiesSerializer
 
     def list(self, request, *args, **kwargs):
         # The spec excluded that use case
         raise exceptions.NotFound()
-
-    def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        # We already dump the geographies as a dict of FeatureCollections
-        # Just flatten the dict to a list
-        features = instance.geographies.values()
-
-        return response.Response(
-            # Geographies already stored in the GeoJSON format
-            {"type": "FeatureCollection", "features": features}
-        )
@@ -121,7 +121,9 @@ class PolicySerializer(serializers.Serializer):
         return [str(policy.id) for policy in policy.prev_policies.all()]
 
 
-class PolicyViewSet(viewsets.ReadOnlyModelViewSet):
+class PolicyViewSet(
+    apis_utils.PublishedPoliciesCacheMixin, viewsets.ReadOnlyModelViewSet
+):
     queryset = (
         models.Policy.objects.prefetch_related("providers", "prev_policies")
         .filter(published_date__isnull=False)  # Not drafts
@@ -0,0 +1,236 @@
+"""
+Fast path validation of the telemetry pushed by providers
+
+The same rules and error messages as ``DeviceTelemetryInputSerializer``
+(still used for the schema and non-JSON payloads), but in a single pass
+over the plain data, without going through DRF fields for each value.
+Providers push batches of a thousand frames.
+"""
+from collections.abc import Mapping
+import functools
+import uuid
+
+from rest_framework import fields
+from rest_framework import serializers
+from rest_framework.exceptions import ErrorDetail, ValidationError
+from rest_framework.settings import api_settings
+
+from mds import utils
+
+
+# Not evaluated yet, the messages are translated
+FIELD_MESSAGES = fields.Field.default_error_messages
+FLOAT_MESSAGES = {**FIELD_MESSAGES, **fields.FloatField.default_error_messages}
+INTEGER_MESSAGES = {**FIELD_MESSAGES, **fields.IntegerField.default_error_messages}
+UUID_MESSAGES = {**FIELD_MESSAGES, **fields.UUIDField.default_error_messages}
+SERIALIZER_MESSAGES = {
+    **FIELD_MESSAGES,
+    **serializers.Serializer.default_error_messages,
+}
+LIST_MESSAGES = {**FIELD_MESSAGES, **serializers.ListSerializer.default_error_messages}
+
+
+class Invalid(Exception):
+    """The value of a field is invalid, with the error details of the field."""
+
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+def fail(messages, key, **kwargs):
+    """Like ``Field.fail``."""
+    return Invalid([ErrorDetail(messages[key].format(**kwargs), code=key)])
+
+
+def fail_non_field(messages, key, **kwargs):
+    """Like the errors of ``Serializer`` and ``ListSerializer`` themselves."""
+    return Invalid(
+        {
+            api_settings.NON_FIELD_ERRORS_KEY: [
+                ErrorDetail(messages[key].format(**kwargs), code=key)
+            ]
+        }
+    )
+
+
+def check_limits(messages, value, min_value, max_value):
+    """Like the validators added by numeric fields."""
+    errors = []
+    if max_value is not None and value > max_value:
+        message = messages["max_value"].format(max_value=max_value)
+        errors.append(ErrorDetail(message, code="max_value"))
+    if min_value is not None and value < min_value:
+        message = messages["min_value"].format(min_value=min_value)
+        errors.append(ErrorDetail(message, code="min_value"))
+    if errors:
+        raise Invalid(errors)
+    return value
+
+
+def to_float(value, min_value=None, max_value=None):
+    if isinstance(value, str) and len(value) > fields.FloatField.MAX_STRING_LENGTH:
+        raise fail(FLOAT_MESSAGES, "max_string_length")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise fail(FLOAT_MESSAGES, "invalid")
+    return check_limits(FLOAT_MESSAGES, value, min_value, max_value)
+
+
+def to_integer(value, min_value=None, max_value=None):
+    if isinstance(value, str) and len(value) > fields.IntegerField.MAX_STRING_LENGTH:
+        raise fail(INTEGER_MESSAGES, "max_string_length")
+    try:
+        value = int(fields.IntegerField.re_decimal.sub("", str(value)))
+    except (TypeError, ValueError):
+        raise fail(INTEGER_MESSAGES, "invalid")
+    return check_limits(INTEGER_MESSAGES, value, min_value, max_value)
+
+
+def to_uuid(value):
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        if isinstance(value, int):
+            return uuid.UUID(int=value)
+        elif isinstance(value, str):
+            return uuid.UUID(hex=value)
+    except ValueError:
+        pass
+    raise fail(UUID_MESSAGES, "invalid", value=value)
+
+
+def to_timestamp(value):
+    # Like apis_utils.UnixTimestampMilliseconds (not checking it is an integer)
+    return utils.from_mds_timestamp(value)
+
+
+def validate_gps(attrs, swap_lat_lng=False):
+    """The checks of ``GPSSerializer.validate``.
+
+    Raises:
+        ValidationError
+    """
+    if swap_lat_lng:
+        attrs["lat"], attrs["lng"] = attrs["lng"], attrs["lat"]
+
+    # Now we can validate (this will not catch valid inversions)
+    if attrs["lat"] < -90.0 or attrs["lat"] > 90.0:
+        raise ValidationError(
+            {"lat": "Latitude is outside [-90 90]: %s" % attrs["lat"]}
+        )
+    if attrs["lng"] < -180.0 or attrs["lng"] > 180.0:
+        raise ValidationError(
+            {"lng": "Longitude is outside [-180 180]: %s" % attrs["lng"]}
+        )
+
+    return attrs
+
+
+# (name, source, conversion, required, min_value, max_value)
+# in the order of the serializer fields
+GPS_FIELDS = (
+    ("lat", "lat", to_float, True, None, None),
+    ("lng", "lng", to_float, True, None, None),
+    ("altitude", "altitude", to_float, False, None, None),
+    ("heading", "heading", to_float, False, 0, None),
+    ("speed", "speed", to_float, False, None, None),
+    ("hdop", "accuracy", to_float, False, 1, None),
+    ("satellites", "satellites", to_integer, False, 0, None),
+)
+
+
+def validate_fields(data, field_specs):
+    """Like ``Serializer.to_internal_value``."""
+    if not isinstance(data, Mapping):
+        raise fail_non_field(
+            SERIALIZER_MESSAGES, "invalid", datatype=type(data).__name__
+        )
+
+    validated = {}
+    errors = {}
+    for name, source, conversion, required, min_value, max_value in field_specs:
+        try:
+            value = data[name]
+        except KeyError:
+            if required:
+                errors[name] = fail(FIELD_MESSAGES, "required").detail
+            continue
+        if value is None:
+            errors[name] = fail(FIELD_MESSAGES, "null").detail
+            continue
+        try:
+            if min_value is None and max_value is None:
+                validated[source] = conversion(value)
+            else:
+                validated[source] = conversion(value, min_value, max_value)
+        except Invalid as exc:
+            errors[name] = exc.detail
+
+    if errors:
+        raise Invalid(errors)
+    return validated
+
+
+def to_gps(value, swap_lat_lng):
+    attrs = validate_fields(value, GPS_FIELDS)
+    try:
+        return validate_gps(attrs, swap_lat_lng)
+    except ValidationError as exc:
+        raise Invalid(serializers.as_serializer_error(exc))
+
+
+def validate_telemetry(data, swap_lat_lng=False):
+    """Validate the payload of the telemetry endpoint.
+
+    Returns:
+        the same validated data as ``DeviceTelemetryInputSerializer``
+
+    Raises:
+        ValidationError, with the same details as the serializer
+    """
+    if not isinstance(data, Mapping):
+        raise ValidationError(
+            fail_non_field(
+                SERIALIZER_MESSAGES, "invalid", datatype=type(data).__name__
+            ).detail
+        )
+
+    try:
+        frames = data["data"]
+    except KeyError:
+        raise ValidationError({"data": fail(FIELD_MESSAGES, "required").detail})
+    if frames is None:
+        raise ValidationError({"data": fail(FIELD_MESSAGES, "null").detail})
+    if not isinstance(frames, list):
+        raise ValidationError(
+            {
+                "data": fail_non_field(
+                    LIST_MESSAGES, "not_a_list", input_type=type(frames).__name__
+                ).detail
+            }
+        )
+
+    to_swapped_gps = functools.partial(to_gps, swap_lat_lng=swap_lat_lng)
+    frame_fields = (
+        ("device_id", "device_id", to_uuid, True, None, None),
+        ("gps", "gps", to_swapped_gps, True, None, None),
+        ("timestamp", "timestamp", to_timestamp, True, None, None),
+        ("charge", "battery_pct", to_float, False, 0, 1),
+    )
+    validated = []
+    errors = []
+    for frame in frames:
+        try:
+            if frame is None:
+                raise fail(FIELD_MESSAGES, "null")
+            validated.append(validate_fields(frame, frame_fields))
+        except Invalid as exc:
+            errors.append(exc.detail)
+        else:
+            errors.append({})
+
+    if any(errors):
+        raise ValidationError({"data": errors})
+    return {"data": validated}
@@ -7,15 +7,19 @@ from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
+from django.conf import settings
 from django.contrib.gis.geos import Point
 from django.db.utils import IntegrityError
 
 from mds import db_helpers
-from mds import enums, models, provider_mapping
+from mds import enums, models, provider_config, provider_mapping
+from mds import utils
 from mds.access_control.permissions import require_scopes
 from mds.access_control.scopes import SCOPE_AGENCY_API
 from mds.apis import utils as apis_utils
+from mds.apis.agency_api.v0_3 import telemetry_validator
 from mds.utils import is_telemetry_enabled
 
 logger = logging.getLogger(__name__)
@@ -142,21 +146,10 @@ class GPSSerializer(serializers.Serializer):
         attrs = super().validate(value)
 
         # Some providers may mistake latitude and longitude
-        provider = self.context.get("provider")
-        if provider and provider.agency_api_configuration.get("swap_lat_lng"):
-            attrs["lat"], attrs["lng"] = attrs["lng"], attrs["lat"]
-
-        # Now we can validate (this will not catch valid inversions)
-        if attrs["lat"] < -90.0 or attrs["lat"] > 90.0:
-            raise ValidationError(
-                {"lat": "Latitude is outside [-90 90]: %s" % attrs["lat"]}
-            )
-        if attrs["lng"] < -180.0 or attrs["lng"] > 180.0:
-            raise ValidationError(
-                {"lng": "Longitude is outside [-180 180]: %s" % attrs["lng"]}
-            )
-
-        return attrs
+        config = self.context.get("provider_config")
+        return telemetry_validator.validate_gps(
+            attrs, swap_lat_lng=config and config.swap_lat_lng
+        )
 
 
 def gps_to_gis_point(gps_data):
@@ -215,19 +208,9 @@ class DeviceEventSerializer(serializers.Serializer):
         # event_type(s) and event_type_reason(s).
         # A provider uses the old version if agency_api_version == "draft" in its
         # api_configuration.
-        provider_id = self.context["request"].user.provider_id
-        provider = models.Provider.objects.get(id=provider_id)
-        # TODO(hcauwelier) make it mandatory, see SMP-1673
-        api_version = provider.agency_api_configuration.get("api_version")
-        if not api_version:
-            # TODO(hcauwelier) clean up, "api_configuration" was for the provider API
-            api_version = provider.api_configuration.get("agency_api_version")
-            if not api_version:
-                api_version = enums.MDS_VERSIONS[enums.DEFAULT_AGENCY_API_VERSION].value
-        else:
-            # We store the enum key, which cannot be a numeric identifier
-            # It doubles as a validity check
-            api_version = enums.MDS_VERSIONS[api_version].value
+        api_version = provider_config.get_agency_api_version(
+            self.context["request"].user.provider_id
+        )
         event_type = validated_data.get("event_type")
         event_type_reason = validated_data.get("event_type_reason")
         # TODO(hcauwelier) remove "draft" (pre 0.2) support
@@ -251,7 +234,7 @@ class DeviceEventSerializer(serializers.Serializer):
         event_record = models.EventRecord(
             timestamp=validated_data["timestamp"],
             point=gps_to_gis_point(validated_data["telemetry"].get("gps", {})),
-            device_id=device.id,
+            device=device,
             event_type=event_type,
             event_type_reason=event_type_reason,
             properties={
@@ -259,13 +242,9 @@ class DeviceEventSerializer(serializers.Serializer):
                 "trip_id": validated_data.get("trip_id"),
             },
         )
-        db_helpers.upsert_event_records(
-            [event_record], enums.EVENT_SOURCE.agency_api.name, on_conflict_update=True
-        )
-
-        # We don't get the created event record but we need to return it
-        return models.EventRecord.objects.get(
-            device=device, timestamp=validated_data["timestamp"]
+        # Overwriting, so it is always saved, no need to read it back
+        return db_helpers.upsert_event_record(
+            event_record, enums.EVENT_SOURCE.agency_api.name, on_conflict_update=True
         )
 
 
@@ -303,19 +282,29 @@ class DeviceTelemetryInputSerializer(serializers.Serializer):
                 {"data.device_id": "Unknown ids: %s" % " ".join(unknown_ids)}
             )
 
-        event_records = (
-            models.EventRecord(
-                timestamp=telemetry["timestamp"],
-                point=gps_to_gis_point(telemetry.get("gps", {})),
-                device_id=telemetry["device_id"],
-                event_type=enums.EVENT_TYPE.telemetry.name,
-                properties={"telemetry": telemetry, "trip_id": None},
-            )
+        rows = (
+            {
+                "device_id": telemetry["device_id"],
+                "timestamp": telemetry["timestamp"],
+                "point": utils.to_ewkt_point(
+                    telemetry["gps"]["lng"], telemetry["gps"]["lat"]
+                ),
+                "event_type": enums.EVENT_TYPE.telemetry.name,
+                "properties": {"telemetry": telemetry, "trip_id": None},
+            }
             for telemetry in validated_data["data"]
         )
-        db_helpers.upsert_event_records(
-            event_records, enums.EVENT_SOURCE.agency_api.name, on_conflict_update=True
-        )
+        if getattr(settings, "AGENCY_API_TELEMETRY_QUEUE", False):
+            # Absorb the bursts, see the save_queued_telemetry command
+            rows = list(rows)
+            if rows:
+                models.QueuedTelemetry.objects.create(
+                    provider_id=provider_id, rows=rows
+                )
+        else:
+            db_helpers.copy_event_records(
+                rows, enums.EVENT_SOURCE.agency_api.name, on_conflict_update=True
+            )
 
         # We don't have the created event records,
         # but we will return an empty response anyway (cf. DeviceViewSet)
@@ -351,14 +340,23 @@ class DeviceViewSet(
         },
     }
 
+    @property
+    def pagination_class(self):
+        # Providers reconciling big fleets page through the whole list
+        if getattr(settings, "AGENCY_API_CURSOR_PAGINATION", False):
+            return apis_utils.CursorPagination
+        return api_settings.DEFAULT_PAGINATION_CLASS
+
     def create(self, *args, **kwargs):
         return self._create(*args, **kwargs)
 
     @action(detail=True, methods=["post", "options"])
     def event(self, request, id):
         """Endpoint to receive an event from a provider."""
+        # Needed before validating the event, only what the view reads
+        # (its provider configuration may swap the coordinates)
         try:
-            device = models.Device.objects.get(pk=id)
+            device = models.Device.objects.only("id", "provider_id").get(pk=id)
         except models.Device.DoesNotExist:
             return Response(
                 data={
@@ -379,7 +377,7 @@ class DeviceViewSet(
             context={
                 "device": device,
                 "request_or_response": "request",
-                "provider": device.provider,
+                "provider_config": provider_config.get(device.provider_id),
             },
         )
         request_serializer.is_valid(raise_exception=True)
@@ -395,10 +393,17 @@ class DeviceViewSet(
         context = self.get_serializer_context()  # adds the request to the context
         context["request_or_response"] = "request"
         provider_id = request.user.provider_id
-        context["provider"] = models.Provider.objects.get(pk=provider_id)
+        context["provider_config"] = provider_config.get(provider_id)
         serializer = self.get_serializer(data=request.data, context=context)
-        serializer.is_valid(raise_exception=True)
-        instance = serializer.save() if is_telemetry_enabled() else None
+        if type(request.data) is dict:  # Parsed from JSON
+            # Same result as the serializer, much faster on big batches
+            validated_data = telemetry_validator.validate_telemetry(
+                request.data, swap_lat_lng=context["provider_config"].swap_lat_lng
+            )
+        else:
+            serializer.is_valid(raise_exception=True)
+            validated_data = serializer.validated_data
+        instance = serializer.create(validated_data) if is_telemetry_enabled() else None
         response_serializer = self.get_serializer(
             instance=instance, context={"request_or_response": "response"}
         )
@@ -1,8 +1,16 @@
 """A few helpers around DRF."""
+import calendar
 import datetime
+import hashlib
 import json
 
+from django.conf import settings
 from django.contrib.gis import geos
+from django.core import exceptions
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django_filters import rest_framework as filters
 from rest_framework import pagination
 from rest_framework import serializers
@@ -31,6 +39,20 @@ class LimitOffsetPagination(pagination.LimitOffsetPagination):
     default_limit = 100
 
 
+class CursorPagination(pagination.CursorPagination):
+    """Keyset pagination, for paging through big collections.
+
+    No count query and stable pages while rows are being inserted,
+    at the cost of only providing next and previous links.
+    """
+
+    page_size = 100
+    page_size_query_param = "limit"
+    max_page_size = 1000
+    # Must be unique and immutable
+    ordering = "id"
+
+
 # Viewsets #####################################################
 
 
@@ -98,6 +120,122 @@ class MultiSerializerViewSetMixin:
         return super().get_serializer(*args, **kwargs)
 
 
+class PublishedPoliciesCacheMixin:
+    """HTTP caching of the published policies (and their geographies).
+
+    Published policies are superseded by new ones rather than modified,
+    their ID and publication date identify what is rendered:
+    - the responses have an ETag (and a Last-Modified header for a single policy)
+      and conditional requests get a 304 without fetching the policies;
+    - the rendered responses can also be kept in the Django cache named
+      by the ``AGENCY_API_POLICIES_CACHE`` setting (disabled by default),
+      for ``AGENCY_API_POLICIES_CACHE_TTL`` seconds (a day by default).
+    """
+
+    _cache_validators = None
+    _cache_key = None
+
+    def list(self, request, *args, **kwargs):
+        return self._cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached(super().retrieve, request, *args, **kwargs)
+
+    def get_cache_validators(self):
+        """The ETag and Last-Modified date (or None) of the policies to render.
+
+        Returns:
+            None when there are no policies, e.g. to let a 404 be raised
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.action == "retrieve":
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            try:
+                queryset = queryset.filter(
+                    **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+                )
+            except (TypeError, ValueError, exceptions.ValidationError):
+                return None
+        # Superseding a policy lists it in the previous policies of the other one
+        rows = list(
+            queryset.prefetch_related(None)
+            .order_by()
+            .values_list("id", "published_date", "prev_policies")
+        )
+        if not rows and self.action == "retrieve":
+            return None
+        versions = sorted(
+            (str(policy_id), published_date.isoformat(), str(prev_policy_id))
+            for policy_id, published_date, prev_policy_id in rows
+        )
+        digest = hashlib.sha256(
+            json.dumps(
+                [
+                    # The same content for the same URL and format
+                    self.request.get_full_path(),
+                    self.request.accepted_renderer.format,
+                    versions,
+                ]
+            ).encode("utf-8")
+        )
+        last_modified = None
+        # Policies leave the list (ending, deleted) without changing the dates
+        if self.action == "retrieve":
+            last_modified = max(published_date for _, published_date, _ in rows)
+        return f'"{digest.hexdigest()}"', last_modified
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self._cache_validators and response.status_code in (200, 304):
+            etag, last_modified = self._cache_validators
+            response["ETag"] = etag
+            if last_modified:
+                response["Last-Modified"] = http_date(last_modified)
+            if self._cache_key and response.status_code == 200:
+                response.render()
+                # With the headers of DRF, e.g. "Vary: Accept" for shared caches
+                _get_policies_cache().set(
+                    self._cache_key,
+                    (list(response.items()), response.content),
+                    getattr(settings, "AGENCY_API_POLICIES_CACHE_TTL", 86400),
+                )
+        return response
+
+    def _cached(self, view, request, *args, **kwargs):
+        validators = self.get_cache_validators()
+        if not validators:
+            return view(request, *args, **kwargs)
+        etag, last_modified = validators
+        if last_modified:
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+        self._cache_validators = etag, last_modified
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is not None:  # Not modified (or a failed precondition)
+            return response
+
+        cache = _get_policies_cache()
+        if cache is None:
+            return view(request, *args, **kwargs)
+        cache_key = "mds:policies:" + etag.strip('"')
+        cached = cache.get(cache_key)
+        if cached is not None:
+            headers, content = cached
+            response = HttpResponse(content)
+            for header, value in headers:
+                response[header] = value
+            return response
+        self._cache_key = cache_key  # Cached once rendered
+        return view(request, *args, **kwargs)
+
+
+def _get_policies_cache():
+    alias = getattr(settings, "AGENCY_API_POLICIES_CACHE", None)
+    return caches[alias] if alias else None
+
+
 # Serializers ##################################################
 
 
@@ -0,0 +1,502 @@
+"""
+Computing the compliances of the vehicles with the published policies
+
+Each run evaluates the policies in effect at a given time (now minus the lag)
+and maintains the ``Compliance`` intervals of the vehicles in violation:
+new violations are opened, the ones that stopped are closed.
+
+The rules are evaluated in the database, a single query for each rule,
+against the state of the devices at that time (their latest event before it).
+PostGIS prepares the geographies of the rule as they are compared
+to every device, instead of parsing them again and again.
+
+The runs are incremental, see ``ComplianceWatermark``:
+- fleet size ("count") rules are only evaluated again when events were saved
+  or became visible since the previous run (or the rule just came into effect);
+- speed rules only look at the telemetries not seen by the previous run
+  (the days and times of the rule are checked at the time of each telemetry);
+- time rules are always evaluated, time passing is enough to violate them.
+
+Not supported: minimum of vehicles (no vehicle to blame), user rules.
+"""
+import datetime
+import json
+import logging
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from mds import enums
+from mds import models
+
+
+logger = logging.getLogger(__name__)
+
+# The saved_at of events is the start of the transaction saving them,
+# leave them time to be committed before considering them seen
+SAVED_AT_MARGIN = datetime.timedelta(minutes=5)
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")  # By weekday()
+
+TIME_UNITS = {"seconds": 1, "minutes": 60, "hours": 3600}
+
+# From the meters per second of the telemetry
+SPEED_UNITS = {"kph": 3.6, "mph": 2.2369362920544}
+
+
+def compute_compliances(lag=datetime.timedelta(0), now=None):
+    """Evaluate the published policies for the given lag.
+
+    Args:
+        lag: how long to wait for the events before computing the compliances
+        now: the time of the run, only useful to tests
+
+    Returns:
+        The number of compliances opened and closed
+    """
+    if now is None:
+        now = timezone.now()
+    at = now - lag
+    stats = {"opened": 0, "closed": 0}
+
+    with transaction.atomic():
+        # Don't evaluate twice at once
+        watermark = (
+            models.ComplianceWatermark.objects.select_for_update()
+            .filter(lag=lag)
+            .first()
+        )
+        # Not using PolicyQueryset.active, superseding policies are evaluated too
+        policies = list(
+            models.Policy.objects.filter(
+                Q(end_date__gt=at) | Q(end_date__isnull=True),
+                start_date__lte=at,
+                published_date__lte=at,
+            ).prefetch_related("providers")
+        )
+        evaluation = Evaluation(at, lag, watermark, _events_changed(watermark, at))
+        for policy in policies:
+            for rule in policy.rules:
+                opened, closed = evaluation.evaluate(policy, rule)
+                stats["opened"] += opened
+                stats["closed"] += closed
+
+        # The violations of the policies no longer in effect end with them
+        stats["closed"] += (
+            models.Compliance.objects.filter(lag=lag, end_date__isnull=True)
+            .exclude(policy__in=policies)
+            .update(end_date=at, saved_at=now)
+        )
+
+        models.ComplianceWatermark.objects.update_or_create(
+            lag=lag,
+            defaults={"computed_at": at, "last_saved_at": now - SAVED_AT_MARGIN},
+        )
+
+    logger.info(
+        "Compliances with a lag of %s: %d opened and %d closed",
+        lag,
+        stats["opened"],
+        stats["closed"],
+    )
+    return stats
+
+
+def _events_changed(watermark, at):
+    """Were events saved or became visible since the previous run?"""
+    if watermark is None:
+        return True
+    return models.EventRecord.objects.filter(
+        Q(timestamp__gt=watermark.computed_at, timestamp__lte=at)
+        | Q(saved_at__gt=watermark.last_saved_at)
+    ).exists()
+
+
+class Evaluation:
+    """The evaluation of the rules at a given time."""
+
+    def __init__(self, at, lag, watermark, events_changed):
+        self.at = at
+        self.lag = lag
+        self.watermark = watermark
+        self.events_changed = events_changed
+        self._has_states = False
+
+    def evaluate(self, policy, rule):
+        rule_type = rule["rule_type"]
+        if rule_type in ("count", "permit"):
+            if (
+                not self.events_changed
+                and _in_effect(rule, self.at)
+                and self._was_in_effect(policy, rule)
+            ):
+                return 0, 0  # The same states, the same violations
+            evaluate = self.evaluate_count
+        elif rule_type == "time":
+            evaluate = self.evaluate_time
+        elif rule_type == "speed":
+            evaluate = self.evaluate_speed
+        else:
+            return 0, 0
+
+        violations = []
+        # The telemetries are checked at their own time
+        in_effect = rule_type == "speed" or _in_effect(rule, self.at)
+        if rule.get("maximum") is not None and in_effect:
+            geographies = _get_geographies(policy, rule)
+            if geographies["geography_ids"]:
+                violations = evaluate(policy, rule, geographies)
+        if rule_type == "speed":
+            # Each excess of speed is an interval of its own
+            return self._save_violations(policy, rule, violations, closed=True), 0
+        return self._update_violations(policy, rule, violations)
+
+    def evaluate_count(self, policy, rule, geographies):
+        """The vehicles beyond the maximum of each geography, the latest ones."""
+        self._create_states()
+        conditions, params = _device_conditions(policy, rule, "state")
+        conditions += _status_conditions(rule, params)
+        query = f"""
+            WITH {_GEOGRAPHIES_CTE},
+            matching AS (
+                SELECT
+                    state.device_id,
+                    geography.id AS geography_id,
+                    row_number() OVER (
+                        PARTITION BY geography.id
+                        ORDER BY state.status_timestamp, state.device_id
+                    ) AS rank
+                FROM compliance_states AS state
+                JOIN geographies AS geography
+                    ON ST_Intersects(geography.geom, state.point)
+                WHERE {" AND ".join(conditions)}
+            )
+            SELECT device_id, geography_id, %(at)s
+            FROM matching
+            WHERE rank > %(maximum)s
+            """
+        params.update(geographies, at=self.at, maximum=rule["maximum"])
+        return _fetch_violations(query, params)
+
+    def evaluate_time(self, policy, rule, geographies):
+        """The vehicles in the same status for longer than the maximum."""
+        self._create_states()
+        conditions, params = _device_conditions(policy, rule, "state")
+        conditions += _status_conditions(rule, params)
+        unit = TIME_UNITS[rule.get("rule_units") or "minutes"]
+        query = f"""
+            WITH {_GEOGRAPHIES_CTE}
+            SELECT
+                state.device_id,
+                geography.id,
+                state.status_timestamp + %(maximum)s
+            FROM compliance_states AS state
+            JOIN geographies AS geography
+                ON ST_Intersects(geography.geom, state.point)
+            WHERE {" AND ".join(conditions)}
+                AND state.status_timestamp + %(maximum)s <= %(at)s
+            """
+        params.update(
+            geographies,
+            at=self.at,
+            maximum=datetime.timedelta(seconds=rule["maximum"] * unit),
+        )
+        return _fetch_violations(query, params)
+
+    def evaluate_speed(self, policy, rule, geographies):
+        """The telemetries faster than the maximum, not seen yet."""
+        conditions, params = _device_conditions(policy, rule, "device")
+        conditions += _in_effect_conditions(rule, "event.timestamp", params)
+        query = f"""
+            WITH {_GEOGRAPHIES_CTE}
+            SELECT event.device_id, geography.id, event.timestamp
+            FROM mds_eventrecord AS event
+            JOIN mds_device AS device ON device.id = event.device_id
+            JOIN geographies AS geography
+                ON ST_Intersects(geography.geom, event.point)
+            WHERE {" AND ".join(conditions)}
+                AND event.timestamp <= %(at)s
+                AND event.timestamp >= %(start_date)s
+                AND (
+                    %(computed_at)s::timestamptz IS NULL
+                    OR event.timestamp > %(computed_at)s
+                    OR event.saved_at > %(last_saved_at)s
+                )
+                AND jsonb_typeof(event.properties -> 'telemetry' -> 'gps' -> 'speed')
+                    = 'number'
+                AND (event.properties -> 'telemetry' -> 'gps' ->> 'speed')::float
+                    * %(unit)s > %(maximum)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM mds_compliance AS compliance
+                    WHERE compliance.policy_id = %(policy_id)s
+                        AND compliance.rule = %(rule_id)s
+                        AND compliance.geography = geography.id
+                        AND compliance.vehicle_id = event.device_id
+                        AND compliance.start_date = event.timestamp
+                        AND compliance.lag = %(lag)s
+                )
+            """
+        params.update(
+            geographies,
+            at=self.at,
+            start_date=policy.start_date,
+            computed_at=self.watermark.computed_at if self.watermark else None,
+            last_saved_at=self.watermark.last_saved_at if self.watermark else None,
+            unit=SPEED_UNITS[rule.get("rule_units") or "kph"],
+            maximum=rule["maximum"],
+            policy_id=policy.pk,
+            rule_id=rule["rule_id"],
+            lag=self.lag,
+        )
+        return _fetch_violations(query, params)
+
+    def _was_in_effect(self, policy, rule):
+        if self.watermark is None:
+            return False
+        computed_at = self.watermark.computed_at
+        return (
+            policy.published_date <= computed_at
+            and policy.start_date <= computed_at
+            and _in_effect(rule, computed_at)
+        )
+
+    def _create_states(self):
+        """The state of each device at the time of the evaluation."""
+        if self._has_states:
+            return
+        with connection.cursor() as cursor:
+            # Dropped at the end of the transaction, unless several runs share it
+            cursor.execute("DROP TABLE IF EXISTS compliance_states")
+            cursor.execute(
+                """
+                CREATE TEMPORARY TABLE compliance_states ON COMMIT DROP AS
+                SELECT
+                    device.id AS device_id,
+                    device.provider_id,
+                    device.category,
+                    device.propulsion,
+                    latest_status.timestamp AS status_timestamp,
+                    latest_status.event_type,
+                    COALESCE(status_map.status, %(unknown_status)s) AS status,
+                    latest_gps.point
+                FROM mds_device AS device
+                -- A single index lookup per device, see DeviceQueryset
+                CROSS JOIN LATERAL (
+                    SELECT timestamp, event_type
+                    FROM mds_eventrecord
+                    WHERE device_id = device.id
+                        AND event_type <> 'telemetry'
+                        AND timestamp <= %(at)s
+                    ORDER BY timestamp DESC
+                    LIMIT 1
+                ) AS latest_status
+                CROSS JOIN LATERAL (
+                    SELECT point
+                    FROM mds_eventrecord
+                    WHERE device_id = device.id
+                        AND point IS NOT NULL
+                        AND timestamp <= %(at)s
+                    ORDER BY timestamp DESC
+                    LIMIT 1
+                ) AS latest_gps
+                LEFT OUTER JOIN unnest(%(event_types)s::text[], %(statuses)s::text[])
+                    AS status_map (event_type, status)
+                    ON status_map.event_type = latest_status.event_type
+                """,
+                {
+                    "at": self.at,
+                    "unknown_status": enums.DEVICE_STATUS.unknown.name,
+                    "event_types": list(enums.EVENT_TYPE_TO_DEVICE_STATUS.keys()),
+                    "statuses": list(enums.EVENT_TYPE_TO_DEVICE_STATUS.values()),
+                },
+            )
+            cursor.execute("CREATE INDEX ON compliance_states USING gist (point)")
+            cursor.execute("ANALYZE compliance_states")
+        self._has_states = True
+
+    def _update_violations(self, policy, rule, violations):
+        """Open the new violations and close the ones that stopped."""
+        violations = {
+            (vehicle_id, geography_id): start_date
+            for vehicle_id, geography_id, start_date in violations
+        }
+        ongoing = {
+            (vehicle_id, geography_id): pk
+            for pk, vehicle_id, geography_id in models.Compliance.objects.filter(
+                policy=policy, rule=rule["rule_id"], lag=self.lag, end_date__isnull=True
+            ).values_list("pk", "vehicle_id", "geography")
+        }
+        new_violations = {
+            key: start_date
+            for key, start_date in violations.items()
+            if key not in ongoing
+        }
+        if new_violations:
+            # Violating again, e.g. back in the geography with the same status,
+            # the new interval can't start before the end of the previous one
+            previous = (
+                models.Compliance.objects.filter(
+                    policy=policy,
+                    rule=rule["rule_id"],
+                    lag=self.lag,
+                    vehicle_id__in={vehicle_id for vehicle_id, _ in new_violations},
+                    end_date__gte=min(new_violations.values()),
+                )
+                .order_by()
+                .values_list("vehicle_id", "geography")
+                .annotate(last_end_date=Max("end_date"))
+            )
+            for vehicle_id, geography_id, last_end_date in previous:
+                start_date = new_violations.get((vehicle_id, geography_id))
+                if start_date is not None and start_date <= last_end_date:
+                    new_violations[vehicle_id, geography_id] = last_end_date
+        opened = self._save_violations(
+            policy,
+            rule,
+            [
+                (vehicle_id, geography_id, start_date)
+                for (vehicle_id, geography_id), start_date in new_violations.items()
+            ],
+        )
+        stopped = [pk for key, pk in ongoing.items() if key not in violations]
+        closed = 0
+        if stopped:
+            closed = models.Compliance.objects.filter(pk__in=stopped).update(
+                end_date=self.at, saved_at=timezone.now()
+            )
+        return opened, closed
+
+    def _save_violations(self, policy, rule, violations, closed=False):
+        models.Compliance.objects.bulk_create(
+            [
+                models.Compliance(
+                    policy=policy,
+                    vehicle_id=vehicle_id,
+                    rule=rule["rule_id"],
+                    geography=geography_id,
+                    start_date=start_date,
+                    end_date=start_date if closed else None,
+                    lag=self.lag,
+                )
+                for vehicle_id, geography_id, start_date in violations
+            ]
+        )
+        return len(violations)
+
+
+# The geographies of the rule, from the GeoJSON frozen in the policy
+# (only the polygons, ST_Intersects doesn't support geometry collections)
+_GEOGRAPHIES_CTE = """
+    geographies AS (
+        SELECT
+            id,
+            ST_CollectionExtract(
+                ST_SetSRID(ST_GeomFromGeoJSON(geojson), 4326), 3
+            ) AS geom
+        FROM unnest(%(geography_ids)s::uuid[], %(geometries)s::text[])
+            AS geography (id, geojson)
+    )"""
+
+
+def _get_geographies(policy, rule):
+    geography_ids = []
+    geometries = []
+    for geography_id in rule["geographies"]:
+        geography = (policy.geographies or {}).get(str(geography_id))
+        if not geography:
+            logger.warning(
+                "Geography %s of policy %s is unknown", geography_id, policy.pk
+            )
+            continue
+        geography_ids.append(str(geography_id))
+        geometries.append(json.dumps(geography["geometry"]))
+    return {"geography_ids": geography_ids, "geometries": geometries}
+
+
+def _device_conditions(policy, rule, alias):
+    """The SQL conditions on the devices the rule applies to, and their params."""
+    conditions = ["TRUE"]
+    params = {}
+    provider_ids = [str(provider.pk) for provider in policy.providers.all()]
+    if provider_ids:  # All the providers otherwise
+        conditions.append(f"{alias}.provider_id = ANY(%(provider_ids)s::uuid[])")
+        params["provider_ids"] = provider_ids
+    vehicle_types = rule.get("vehicle_types") or []
+    if vehicle_types and "all" not in vehicle_types:
+        conditions.append(f"{alias}.category = ANY(%(vehicle_types)s::text[])")
+        params["vehicle_types"] = vehicle_types
+    propulsion_types = rule.get("propulsion_types") or []
+    if propulsion_types and "all" not in propulsion_types:
+        conditions.append(f"{alias}.propulsion && %(propulsion_types)s::text[]")
+        params["propulsion_types"] = propulsion_types
+    return conditions, params
+
+
+def _status_conditions(rule, params):
+    """The SQL conditions on the statuses (and event types) of the rule."""
+    statuses = []
+    event_types = []
+    for status, status_event_types in (rule.get("statuses") or {}).items():
+        if status_event_types:
+            event_types.extend(status_event_types)
+        else:  # All the events of this status
+            statuses.append(status)
+    if not statuses and not event_types:  # All the statuses
+        return []
+    params.update(statuses=statuses, status_event_types=event_types)
+    return [
+        "(state.status = ANY(%(statuses)s::text[])"
+        " OR state.event_type = ANY(%(status_event_types)s::text[]))"
+    ]
+
+
+def _in_effect(rule, at):
+    """Is the rule in effect at this time of the day and day of the week?"""
+    local = timezone.localtime(at)
+    days = rule.get("days")
+    if days and DAYS[local.weekday()] not in days:
+        return False
+    start_time = _parse_time(rule.get("start_time")) or datetime.time.min
+    end_time = _parse_time(rule.get("end_time")) or datetime.time.max
+    if start_time <= end_time:
+        return start_time <= local.time() <= end_time
+    return local.time() >= start_time or local.time() <= end_time  # Overnight
+
+
+def _in_effect_conditions(rule, column, params):
+    """The SQL conditions of ``_in_effect`` on a timestamp column."""
+    conditions = []
+    local = f"({column} AT TIME ZONE %(time_zone)s)"
+    days = rule.get("days")
+    if days:
+        conditions.append(f"extract(isodow FROM {local}) = ANY(%(days)s::int[])")
+        params["days"] = [DAYS.index(day) + 1 for day in days if day in DAYS]
+    start_time = _parse_time(rule.get("start_time"))
+    end_time = _parse_time(rule.get("end_time"))
+    if start_time is not None or end_time is not None:
+        start_time = start_time or datetime.time.min
+        end_time = end_time or datetime.time.max
+        operator = "AND" if start_time <= end_time else "OR"  # Overnight
+        conditions.append(
+            f"({local}::time >= %(start_time)s {operator} "
+            f"{local}::time <= %(end_time)s)"
+        )
+        params.update(start_time=start_time, end_time=end_time)
+    if conditions:
+        params["time_zone"] = timezone.get_current_timezone_name()
+    return conditions
+
+
+def _parse_time(value):
+    if isinstance(value, str):
+        return datetime.time.fromisoformat(value)
+    return value
+
+
+def _fetch_violations(query, params):
+    """The (vehicle ID, geography ID, start date) of each violation."""
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchall()
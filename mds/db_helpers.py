@@ -1,19 +1,43 @@
+import datetime
+import io
 import json
 import types
 
 from django.db import connection
+from psycopg2 import extras
 from rest_framework.utils import encoders
 
+from . import enums
+from . import metrics
 
-def upsert_providers(providers: types.GeneratorType):
+
+# Number of rows sent at once in multi-row VALUES statements
+PAGE_SIZE = 1000
+
+write_seconds = metrics.histogram(
+    "mds_db_write_seconds", "Time spent writing rows, by function."
+)
+rows_written = metrics.counter(
+    "mds_db_rows_written", "Number of rows inserted or updated, by function."
+)
+rows_ignored = metrics.counter(
+    "mds_db_rows_ignored", "Number of rows ignored as duplicates, by function."
+)
+
+
+def upsert_providers(providers: types.GeneratorType, page_size=PAGE_SIZE):
     """
     Using "upsert" to create providers.
 
     Conflicts are always ignored.
+
+    Rows are sent in multi-row VALUES statements of ``page_size`` rows.
+
+    Returns:
+        the list of IDs actually inserted
     """
 
     def serialize(provider):
-        provider.clean()
         return {
             "id": provider.id,
             "name": provider.name,
@@ -40,33 +64,45 @@ def upsert_providers(providers: types.GeneratorType):
             agency_api_configuration,
             colors,
             operator
-        ) VALUES (
-            %(id)s,
-            %(name)s,
-            %(base_api_url)s,
-            %(oauth2_url)s,
-            %(api_authentication)s,
-            %(api_configuration)s,
-            %(agency_api_authentication)s,
-            %(agency_api_configuration)s,
-            %(colors)s,
-            %(operator)s
-        ) ON CONFLICT DO NOTHING
+        ) VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING id
     """
+    template = """(
+        %(id)s,
+        %(name)s,
+        %(base_api_url)s,
+        %(oauth2_url)s,
+        %(api_authentication)s,
+        %(api_configuration)s,
+        %(agency_api_authentication)s,
+        %(agency_api_configuration)s,
+        %(colors)s,
+        %(operator)s
+    )"""
 
-    with connection.cursor() as cursor:
-        cursor.executemany(query, (serialize(provider) for provider in providers))
+    return _execute_values(
+        "upsert_providers",
+        query,
+        (serialize(provider) for provider in providers),
+        template=template,
+        page_size=page_size,
+    )
 
 
-def upsert_devices(devices: types.GeneratorType):
+def upsert_devices(devices: types.GeneratorType, page_size=PAGE_SIZE):
     """
     Using "upsert" to create devices.
 
     Conflicts are always ignored.
+
+    Rows are sent in multi-row VALUES statements of ``page_size`` rows.
+
+    Returns:
+        the list of IDs actually inserted
     """
 
     def serialize(device):
-        device.clean()
         return {
             "id": device.id,
             "provider_id": device.provider_id,
@@ -91,22 +127,59 @@ def upsert_devices(devices: types.GeneratorType):
             manufacturer,
             dn_status,
             saved_at
-        ) VALUES (
-            %(id)s,
-            %(provider_id)s,
-            %(registration_date)s,
-            %(identification_number)s,
-            %(category)s,
-            %(model)s,
-            %(propulsion)s,
-            %(manufacturer)s,
-            %(dn_status)s,
-            CURRENT_TIMESTAMP
-        ) ON CONFLICT DO NOTHING
+        ) VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING id
     """
+    template = """(
+        %(id)s,
+        %(provider_id)s,
+        %(registration_date)s,
+        %(identification_number)s,
+        %(category)s,
+        %(model)s,
+        %(propulsion)s,
+        %(manufacturer)s,
+        %(dn_status)s,
+        CURRENT_TIMESTAMP
+    )"""
+
+    return _execute_values(
+        "upsert_devices",
+        query,
+        (serialize(device) for device in devices),
+        template=template,
+        page_size=page_size,
+    )
+
+
+def _execute_values(function, query, rows, template, page_size):
+    """Run the query with the rows as VALUES, by page, and collect the results."""
+    rows = _RowCounter(rows)
+    with write_seconds.time(function=function), connection.cursor() as cursor:
+        results = extras.execute_values(
+            cursor, query, rows, template=template, page_size=page_size, fetch=True
+        )
+    _count_rows(function, rows.count, len(results))
+    return [row[0] for row in results]
 
-    with connection.cursor() as cursor:
-        cursor.executemany(query, (serialize(device) for device in devices))
+
+class _RowCounter:
+    """Count the rows of the iterable as they are consumed."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+def _count_rows(function, sent, written):
+    rows_written.inc(written, function=function)
+    rows_ignored.inc(sent - written, function=function)
 
 
 def upsert_event_records(
@@ -126,46 +199,232 @@ def upsert_event_records(
         on_conflict_update: ignore duplicates (default) or overwrite
     """
 
-    def serialize(event_record):
-        event_record.clean()
-        return {
-            "timestamp": event_record.timestamp,
-            "device_id": str(event_record.device_id),
-            "point": event_record.point.ewkt if event_record.point else None,
-            "event_type": event_record.event_type,
-            "event_type_reason": event_record.event_type_reason,
-            # The same encoder as in the model
-            "properties": json.dumps(event_record.properties, cls=encoders.JSONEncoder),
-            "source": source,
-            # The model field was renamed, not the table field
-            "first_saved_at": event_record.publication_time,
-        }
+    copy_event_records(
+        (_serialize_event_record(event_record) for event_record in event_records),
+        source,
+        on_conflict_update=on_conflict_update,
+    )
 
+
+def upsert_event_record(event_record, source: str, on_conflict_update=False):
+    """
+    Single record version of ``upsert_event_records``, in a single query.
+
+    Returns:
+        the event record with its ID and save time,
+        or None if it was ignored as a duplicate
+    """
     query = """
-        INSERT INTO mds_eventrecord (
-            device_id,
-            timestamp,
-            point,
-            event_type,
-            event_type_reason,
-            properties,
-            source,
-            first_saved_at,
-            saved_at
-        ) VALUES (
-            %(device_id)s,
-            %(timestamp)s,
-            %(point)s,
-            %(event_type)s,
-            %(event_type_reason)s,
-            %(properties)s,
-            %(source)s,
-            %(first_saved_at)s,
-            current_timestamp
+        WITH merged AS (
+            INSERT INTO mds_eventrecord (
+                device_id,
+                timestamp,
+                point,
+                event_type,
+                event_type_reason,
+                properties,
+                source,
+                first_saved_at,
+                saved_at
+            ) VALUES (
+                %(device_id)s,
+                %(timestamp)s,
+                %(point)s,
+                %(event_type)s,
+                %(event_type_reason)s,
+                %(properties)s,
+                %(source)s,
+                %(publication_time)s,
+                current_timestamp
+            )
+        """
+    query += _on_conflict(on_conflict_update)
+    query += """
+            RETURNING id, device_id, timestamp, point, event_type, properties, saved_at
+        ),
+        """
+    query += _device_states_query("merged", overwrite=False)
+    query += """
+        SELECT id, saved_at FROM merged
+        """
+    row = _serialize_event_record(event_record)
+    params = {
+        **row,
+        "properties": json.dumps(row["properties"], cls=encoders.JSONEncoder),
+        "source": source,
+        **_device_states_params(),
+    }
+
+    with write_seconds.time(function="upsert_event_record"):
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            result = cursor.fetchone()
+    _count_rows("upsert_event_record", 1, 1 if result else 0)
+    if not result:
+        return None
+    event_record.id, event_record.saved_at = result
+    event_record.source = source
+    return event_record
+
+
+def _serialize_event_record(event_record):
+    event_record.clean()
+    return {
+        "device_id": event_record.device_id,
+        "timestamp": event_record.timestamp,
+        "point": event_record.point.ewkt if event_record.point else None,
+        "event_type": event_record.event_type,
+        "event_type_reason": event_record.event_type_reason,
+        "properties": event_record.properties,
+        "publication_time": event_record.publication_time,
+    }
+
+
+def copy_event_records(
+    rows: types.GeneratorType,
+    source: str,
+    on_conflict_update=False,
+    same_source_only=False,
+):
+    """
+    Bulk version of ``upsert_event_records`` working on plain rows.
+
+    Rows are streamed to a temporary staging table with ``COPY FROM STDIN``,
+    then merged into the event records in a single ``INSERT ... SELECT`` query,
+    whatever the number of rows.
+
+    Args:
+        rows: list of dicts, with the same keys as the EventRecord fields, except:
+            - "point" is EWKT (see ``utils.to_ewkt_point``) or None
+            - "properties" is a dict, not yet encoded
+        source: enums.EVENT_SOURCE
+        on_conflict_update: ignore duplicates (default) or overwrite
+        same_source_only: only overwrite the event records saved from this source
+
+    Returns:
+        the number of event records written
+    """
+    buffer = io.StringIO()
+    count = 0
+    for count, row in enumerate(rows, start=1):
+        buffer.write(
+            "\t".join(
+                _copy_value(value)
+                for value in (
+                    count,  # To apply the duplicates of the batch in order
+                    row["device_id"],
+                    row["timestamp"],
+                    row["point"],
+                    row["event_type"],
+                    row.get("event_type_reason"),
+                    # The same encoder as in the model
+                    json.dumps(row["properties"], cls=encoders.JSONEncoder),
+                    # The model field was renamed, not the table field
+                    row.get("publication_time"),
+                )
+            )
         )
+        buffer.write("\n")
+    if not count:
+        return 0
+    buffer.seek(0)
+
+    query = """
+        WITH staged AS (
+            DELETE FROM mds_eventrecord_staging RETURNING *
+        ),
+        merged AS (
+            INSERT INTO mds_eventrecord (
+                device_id,
+                timestamp,
+                point,
+                event_type,
+                event_type_reason,
+                properties,
+                source,
+                first_saved_at,
+                saved_at
+            )
+            SELECT DISTINCT ON (device_id, timestamp)
+                device_id,
+                timestamp,
+                point,
+                event_type,
+                event_type_reason,
+                properties,
+                %(source)s,
+                first_saved_at,
+                current_timestamp
+            FROM staged
         """
     if on_conflict_update:
+        # The last duplicate of the batch wins, as if the rows were upserted in turn
         query += """
+            ORDER BY device_id, timestamp, position DESC
+            """
+    else:
+        query += """
+            ORDER BY device_id, timestamp, position
+            """
+    query += _on_conflict(on_conflict_update, same_source_only)
+    # Only the lines actually written update the devices, in the same query
+    query += """
+            RETURNING device_id, timestamp, point, event_type, properties
+        ),
+        """
+    query += _device_states_query("merged", overwrite=False)
+    query += """
+        SELECT count(*) FROM merged
+        """
+    params = {"source": source, **_device_states_params()}
+
+    with write_seconds.time(function="copy_event_records"):
+        written = _copy_and_merge(buffer, query, params)
+    _count_rows("copy_event_records", count, written)
+    return written
+
+
+def _copy_and_merge(buffer, query, params):
+    """Stream the rows to the staging table then merge them with the query."""
+    with connection.cursor() as cursor:
+        # Private to the session, and emptied in case a previous merge failed
+        cursor.execute(
+            """
+            CREATE TEMPORARY TABLE IF NOT EXISTS mds_eventrecord_staging (
+                position integer,
+                device_id uuid,
+                timestamp timestamp with time zone,
+                point geometry,
+                event_type text,
+                event_type_reason text,
+                properties jsonb,
+                first_saved_at timestamp with time zone
+            );
+            TRUNCATE mds_eventrecord_staging;
+            """
+        )
+        cursor.copy_expert(
+            """
+            COPY mds_eventrecord_staging (
+                position,
+                device_id,
+                timestamp,
+                point,
+                event_type,
+                event_type_reason,
+                properties,
+                first_saved_at
+            ) FROM STDIN
+            """,
+            buffer,
+        )
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+
+def _on_conflict(on_conflict_update, same_source_only=False):
+    if on_conflict_update:
+        clause = """
             ON CONFLICT (device_id, timestamp) DO UPDATE SET
                 point = EXCLUDED.point,
                 event_type = EXCLUDED.event_type,
@@ -175,10 +434,207 @@ def upsert_event_records(
                 first_saved_at = EXCLUDED.first_saved_at,
                 saved_at = current_timestamp
             """
-    else:
-        query += """
+        if same_source_only:
+            clause += """
+            WHERE mds_eventrecord.source = EXCLUDED.source
+            """
+        return clause
+    return """
             ON CONFLICT DO NOTHING
             """
 
+
+def pop_queued_telemetry(limit):
+    """
+    Take the oldest telemetries queued by the agency API.
+
+    Rows locked by another worker are skipped, the rows taken are deleted,
+    so they must be saved in the same transaction.
+
+    Returns:
+        the list of event record rows, in the order they were queued
+    """
+    query = """
+        DELETE FROM mds_queuedtelemetry
+        WHERE id IN (
+            SELECT id FROM mds_queuedtelemetry
+            ORDER BY id
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, rows
+        """
+    with connection.cursor() as cursor:
+        cursor.execute(query, {"limit": limit})
+        queued = cursor.fetchall()
+    # DELETE ... RETURNING doesn't keep any order
+    return [row for _, rows in sorted(queued) for row in rows]
+
+
+def get_telemetry_queue_stats():
+    """
+    Returns:
+        the number of telemetry requests queued
+        and the number of seconds the oldest has been waiting (or 0)
+    """
+    query = """
+        SELECT
+            count(*),
+            COALESCE(extract(epoch FROM clock_timestamp() - min(queued_at)), 0)
+        FROM mds_queuedtelemetry
+        """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        depth, lag = cursor.fetchone()
+    return depth, float(lag)
+
+
+def rebuild_device_states(device_ids):
+    """
+    Compute again the denormalized fields of the given devices from their events.
+
+    Devices without any event are left untouched.
+    """
+    query = """
+        WITH events AS (
+            SELECT device_id, timestamp, point, event_type, properties
+            FROM mds_eventrecord
+            WHERE device_id = ANY(%(device_ids)s::uuid[])
+        ),
+        """
+    query += _device_states_query("events", overwrite=True)
+    query += """
+        SELECT count(*) FROM device_states
+        """
+    params = {"device_ids": list(device_ids), **_device_states_params()}
+
     with connection.cursor() as cursor:
-        cursor.executemany(query, (serialize(record) for record in event_records))
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+
+def _device_states_query(events, overwrite):
+    """
+    The CTEs of a query updating the denormalized fields of devices.
+
+    The update itself is the "device_states" CTE, returning the IDs updated.
+
+    The status comes from the latest event (not telemetry)
+    and the GPS point and battery from the latest event with a location.
+
+    Args:
+        events: name of a previous CTE with device_id, timestamp, point,
+            event_type and properties columns
+        overwrite: False to only apply newer events than the ones already seen,
+            so out-of-order batches never regress the state, True to reset them
+    """
+    if overwrite:
+        status_is_newer = "latest.status_timestamp IS NOT NULL"
+        gps_is_newer = "latest.gps_timestamp IS NOT NULL"
+    else:
+        status_is_newer = (
+            "latest.status_timestamp"
+            " >= COALESCE(device.dn_status_timestamp, '-infinity')"
+        )
+        gps_is_newer = (
+            "latest.gps_timestamp >= COALESCE(device.dn_gps_timestamp, '-infinity')"
+        )
+
+    # The device "saved_at" is not updated on purpose:
+    # these fields are internal and would make any device look modified
+    return f"""
+        latest_status AS (
+            SELECT DISTINCT ON (device_id) device_id, timestamp, event_type
+            FROM {events}
+            WHERE event_type <> 'telemetry'
+            ORDER BY device_id, timestamp DESC
+        ),
+        latest_gps AS (
+            SELECT DISTINCT ON (device_id)
+                device_id,
+                timestamp,
+                point,
+                CASE
+                    WHEN jsonb_typeof(properties -> 'telemetry' -> 'battery_pct')
+                        = 'number'
+                    THEN (properties -> 'telemetry' ->> 'battery_pct')::float
+                END AS battery_pct
+            FROM {events}
+            WHERE point IS NOT NULL
+            ORDER BY device_id, timestamp DESC
+        ),
+        latest AS (
+            SELECT
+                device_id,
+                latest_status.timestamp AS status_timestamp,
+                COALESCE(status_map.status, %(unknown_status)s) AS status,
+                latest_gps.timestamp AS gps_timestamp,
+                latest_gps.point,
+                latest_gps.battery_pct
+            FROM latest_status
+            FULL OUTER JOIN latest_gps USING (device_id)
+            LEFT OUTER JOIN unnest(%(event_types)s::text[], %(statuses)s::text[])
+                AS status_map (event_type, status)
+                ON status_map.event_type = latest_status.event_type
+        ),
+        locked_devices AS (
+            -- Concurrent batches (e.g. hours of archives) may update the same
+            -- devices, lock them in the same order not to deadlock
+            SELECT id
+            FROM mds_device
+            WHERE id IN (SELECT device_id FROM latest)
+            ORDER BY id
+            FOR UPDATE
+        ),
+        device_states AS (
+            UPDATE mds_device AS device SET
+                dn_status = CASE
+                    WHEN {status_is_newer} THEN latest.status
+                    ELSE device.dn_status
+                END,
+                dn_status_timestamp = CASE
+                    WHEN {status_is_newer} THEN latest.status_timestamp
+                    ELSE device.dn_status_timestamp
+                END,
+                dn_gps_point = CASE
+                    WHEN {gps_is_newer} THEN latest.point
+                    ELSE device.dn_gps_point
+                END,
+                dn_gps_timestamp = CASE
+                    WHEN {gps_is_newer} THEN latest.gps_timestamp
+                    ELSE device.dn_gps_timestamp
+                END,
+                dn_battery_pct = CASE
+                    WHEN {gps_is_newer}
+                    THEN COALESCE(latest.battery_pct, device.dn_battery_pct)
+                    ELSE device.dn_battery_pct
+                END
+            FROM latest
+            JOIN locked_devices ON locked_devices.id = latest.device_id
+            WHERE device.id = latest.device_id
+            RETURNING device.id
+        )
+        """
+
+
+def _device_states_params():
+    return {
+        "unknown_status": enums.DEVICE_STATUS.unknown.name,
+        "event_types": list(enums.EVENT_TYPE_TO_DEVICE_STATUS.keys()),
+        "statuses": list(enums.EVENT_TYPE_TO_DEVICE_STATUS.values()),
+    }
+
+
+def _copy_value(value):
+    """Format a value in the text format of COPY."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
@@ -0,0 +1,176 @@
+"""
+Finding in which geographies of the published policies points are
+
+The geographies frozen in ``Policy.geographies`` are parsed once into
+prepared GEOS geometries, indexed by their extent in an R-tree
+(packed with the Sort-Tile-Recursive algorithm), so only the geographies
+around a point are tested.
+
+Published geographies never change (see ``Policy.publish``): the index
+of a policy is built on first use and kept until the policy is published again.
+Prepared geometries can't be shared between threads, each one has its own indexes.
+"""
+import collections
+import json
+import math
+import threading
+
+from django.contrib.gis import geos
+
+
+# How many policies each thread keeps the index of
+CACHE_SIZE = 100
+
+# How many children each node of the R-tree has
+NODE_CAPACITY = 10
+
+_local = threading.local()
+_generation = 0  # Incremented to invalidate the indexes of all threads
+
+
+class STRtree:
+    """A static R-tree of extents, to find the ones covering a point."""
+
+    def __init__(self, entries, node_capacity=NODE_CAPACITY):
+        """
+        Args:
+            entries: (extent, item) of each item,
+                the extent being (xmin, ymin, xmax, ymax)
+        """
+        self._height = 0
+        level = _pack(list(entries), node_capacity)
+        while len(level) > 1:
+            level = _pack(level, node_capacity)
+            self._height += 1
+        self._root = level[0] if level else None
+
+    def query(self, x, y):
+        """The items whose extent covers the point, in no particular order."""
+        if self._root is None:
+            return []
+        found = []
+        stack = [(self._root, self._height)]
+        while stack:
+            (extent, children), height = stack.pop()
+            if not _covers(extent, x, y):
+                continue
+            if height:
+                stack.extend((child, height - 1) for child in children)
+            else:
+                found.extend(item for extent, item in children if _covers(extent, x, y))
+        return found
+
+
+class GeographyIndex:
+    """The geographies of a policy, prepared to locate points."""
+
+    def __init__(self, geographies):
+        """
+        Args:
+            geographies: the GEOS geometry of each geography ID
+        """
+        self.geography_ids = list(geographies)
+        self._prepared = []
+        entries = []
+        for position, geometry in enumerate(geographies.values()):
+            self._prepared.append(geometry.prepared)
+            entries.append((geometry.extent, position))
+        self._tree = STRtree(entries)
+
+    @classmethod
+    def from_policy(cls, policy):
+        return cls(
+            {
+                geography_id: _parse_geometry(geography["geometry"])
+                for geography_id, geography in (policy.geographies or {}).items()
+            }
+        )
+
+    def locate(self, point):
+        """The IDs of the geographies covering the point.
+
+        Args:
+            point: a GEOS point or the (longitude, latitude) of the point
+        """
+        if not isinstance(point, geos.Point):
+            point = geos.Point(*point, srid=4326)
+        candidates = sorted(self._tree.query(point.x, point.y))  # In the policy order
+        return [
+            self.geography_ids[position]
+            for position in candidates
+            if self._prepared[position].covers(point)
+        ]
+
+    def locate_many(self, points):
+        """The IDs of the geographies covering each point, see ``locate``."""
+        return [self.locate(point) for point in points]
+
+
+def get_index(policy):
+    """The index of the geographies of the published policy."""
+    cache = _get_cache()
+    key = (policy.pk, policy.published_date)
+    index = cache.get(key)
+    if index is None:
+        index = cache[key] = GeographyIndex.from_policy(policy)
+        if len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return index
+
+
+def locate(policy, points):
+    """The IDs of the geographies of the policy covering each point."""
+    return get_index(policy).locate_many(points)
+
+
+def invalidate():
+    """Forget the indexes built so far, in all threads."""
+    global _generation
+    _generation += 1
+
+
+def _get_cache():
+    if getattr(_local, "generation", None) != _generation:
+        _local.generation = _generation
+        _local.cache = collections.OrderedDict()  # (policy ID, published) -> index
+    return _local.cache
+
+
+def _parse_geometry(geometry):
+    geometry = geos.GEOSGeometry(json.dumps(geometry), srid=4326)
+    if isinstance(geometry, geos.GeometryCollection) and not isinstance(
+        geometry, geos.MultiPolygon
+    ):
+        # The polygons of the areas, see Policy.publish
+        # (a single polygon is faster to prepare and test)
+        geometry = geometry.unary_union
+    return geometry
+
+
+def _pack(entries, capacity):
+    """Group the entries by nodes of the given capacity, the nearest together."""
+    if not entries:
+        return []
+    slice_size = capacity * math.ceil(math.sqrt(math.ceil(len(entries) / capacity)))
+    entries.sort(key=lambda entry: entry[0][0] + entry[0][2])  # By center x
+    nodes = []
+    for start in range(0, len(entries), slice_size):
+        vertical_slice = sorted(
+            entries[start : start + slice_size],
+            key=lambda entry: entry[0][1] + entry[0][3],  # By center y
+        )
+        for node_start in range(0, len(vertical_slice), capacity):
+            children = vertical_slice[node_start : node_start + capacity]
+            nodes.append((_union(extent for extent, _ in children), children))
+    return nodes
+
+
+def _union(extents):
+    xmins, ymins, xmaxs, ymaxs = zip(*extents)
+    return (min(xmins), min(ymins), max(xmaxs), max(ymaxs))
+
+
+def _covers(extent, x, y):
+    return extent[0] <= x <= extent[2] and extent[1] <= y <= extent[3]
@@ -0,0 +1,34 @@
+"""
+Computing the compliances of the vehicles with the published policies
+
+Meant to be run periodically, once for each lag (e.g. from a cron).
+"""
+import datetime
+
+from django.core import management
+
+from mds import compliance
+
+
+class Command(management.BaseCommand):
+    help = "Compute the compliances of the vehicles with the published policies."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lag",
+            type=int,
+            action="append",
+            help=(
+                "Minutes to wait for the events before computing the compliances, "
+                "can be repeated (default 0)."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        for lag in options["lag"] or [0]:
+            lag = datetime.timedelta(minutes=lag)
+            stats = compliance.compute_compliances(lag)
+            self.stdout.write(
+                f"{stats['opened']} compliances opened "
+                f"and {stats['closed']} closed (lag {lag})."
+            )
@@ -3,12 +3,22 @@ Pulling data for registered providers
 
 This is the opposite of provider pushing their data to the agency API.
 """
+from concurrent import futures
 import logging
+import signal
 
+from django import db
+from django.conf import settings
 from django.core import management
 
+from mds import metrics
 from mds import models
 from mds.provider_poller import poller
+from mds.provider_poller import scheduler
+from mds.provider_poller.existence_cache import ExistenceCache
+from mds.provider_poller.settings import POLLER_BACKFILL_WORKERS
+from mds.provider_poller.settings import POLLER_PREFETCH_PAGES
+from mds.provider_poller.settings import POLLER_STREAM_CHUNK_SIZE
 
 
 logger = logging.getLogger(__name__)
@@ -23,17 +33,126 @@ class Command(management.BaseCommand):
             action="store_true",
             help=("Raise exceptions instead of ignoring them."),
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=getattr(settings, "POLLER_WORKERS", 1),
+            help=(
+                "Number of providers polled concurrently, "
+                "each one in its own thread and database connection."
+            ),
+        )
+        parser.add_argument(
+            "--prefetch-pages",
+            type=int,
+            default=POLLER_PREFETCH_PAGES,
+            help=(
+                "Number of pages downloaded in the background "
+                "while the current one is saved."
+            ),
+        )
+        parser.add_argument(
+            "--backfill-workers",
+            type=int,
+            default=POLLER_BACKFILL_WORKERS,
+            help=(
+                "Number of hours of MDS 0.4 archives polled concurrently "
+                "for a provider catching up."
+            ),
+        )
+        parser.add_argument(
+            "--stream-chunk-size",
+            type=int,
+            default=POLLER_STREAM_CHUNK_SIZE,
+            help=(
+                "Number of MDS 0.4 status changes parsed and saved at once "
+                "while the page is downloaded (requires ijson)."
+            ),
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Serve the metrics to Prometheus on this port.",
+        )
+        parser.add_argument(
+            "--daemon",
+            action="store_true",
+            help=(
+                "Keep polling each provider at its own pace "
+                "(see POLLER_INTERVAL) until terminated."
+            ),
+        )
 
     def handle(self, *args, **options):
-        for provider in models.Provider.objects.all():
-            logger.debug("Polling provider %s... ", provider.name)
-            try:
-                poller.StatusChangesPoller(provider).poll()
-            except Exception:  # pylint: disable=broad-except
-                # In dev, test... environments, we want explicit errors
-                if options["raise_on_error"]:
-                    raise
-                # But in production, we just log and try the next one
-                logger.exception("Error in polling provider %s", provider.name)
-            else:
-                logger.debug("Polling provider %s succeeded.", provider.name)
+        if options["metrics_port"]:
+            metrics.start_http_server(options["metrics_port"])
+        providers = models.Provider.objects.all()
+        raise_on_error = options["raise_on_error"]
+        self.prefetch_pages = options["prefetch_pages"]
+        self.backfill_workers = options["backfill_workers"]
+        self.stream_chunk_size = options["stream_chunk_size"]
+        # Providers may aggregate data of the same devices, share what we know
+        self.provider_cache = ExistenceCache(models.Provider)
+        self.device_cache = ExistenceCache(models.Device)
+
+        if options["daemon"]:
+            self.run_daemon(options["workers"])
+            return
+
+        if options["workers"] <= 1:
+            for provider in providers:
+                self.poll_provider(provider, raise_on_error)
+            return
+
+        # A slow provider no longer holds the others back,
+        # the round lasts as long as the slowest provider
+        with futures.ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            pending = [
+                executor.submit(self.poll_provider_in_thread, provider, raise_on_error)
+                for provider in providers
+            ]
+            for future in futures.as_completed(pending):
+                # Only raises when asked to
+                future.result()
+
+    def run_daemon(self, workers):
+        daemon = scheduler.Scheduler(self.poll_provider_until_stopped, workers)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: daemon.stop())
+        daemon.run()
+
+    def get_poller(self, provider, **kwargs):
+        return poller.StatusChangesPoller(
+            provider,
+            provider_cache=self.provider_cache,
+            device_cache=self.device_cache,
+            prefetch_pages=self.prefetch_pages,
+            backfill_workers=self.backfill_workers,
+            stream_chunk_size=self.stream_chunk_size,
+            **kwargs
+        )
+
+    def poll_provider_until_stopped(self, provider, stop_event):
+        # Errors are handled by the scheduler
+        logger.debug("Polling provider %s... ", provider.name)
+        self.get_poller(provider, stop_event=stop_event).poll()
+
+    def poll_provider(self, provider, raise_on_error):
+        logger.debug("Polling provider %s... ", provider.name)
+        try:
+            self.get_poller(provider).poll()
+        except Exception:  # pylint: disable=broad-except
+            # In dev, test... environments, we want explicit errors
+            if raise_on_error:
+                raise
+            # But in production, we just log and try the next one
+            logger.exception("Error in polling provider %s", provider.name)
+        else:
+            logger.debug("Polling provider %s succeeded.", provider.name)
+
+    def poll_provider_in_thread(self, provider, raise_on_error):
+        try:
+            self.poll_provider(provider, raise_on_error)
+        finally:
+            # Django opened a connection for this thread, don't leak it
+            db.connection.close()
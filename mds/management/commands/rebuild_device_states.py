@@ -0,0 +1,56 @@
+"""
+Compute again the denormalized fields of devices from their events
+
+They are maintained when ingesting events,
+this is for fixing existing data or after changing the mapping of statuses.
+"""
+import logging
+
+from django.core import management
+from django.db import transaction
+
+from mds import db_helpers
+from mds import models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(management.BaseCommand):
+    help = "Rebuild the denormalized status, GPS and battery fields of devices."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of devices updated in each transaction.",
+        )
+        parser.add_argument(
+            "--provider", help="Only rebuild the devices of this provider ID."
+        )
+
+    def handle(self, *args, **options):
+        devices = models.Device.objects.order_by("pk")
+        if options["provider"]:
+            devices = devices.filter(provider_id=options["provider"])
+
+        updated = 0
+        last_device_id = None
+        while True:
+            # Keyset pagination, not to rescan the table from the beginning
+            chunk = devices
+            if last_device_id:
+                chunk = chunk.filter(pk__gt=last_device_id)
+            device_ids = list(
+                chunk.values_list("pk", flat=True)[: options["chunk_size"]]
+            )
+            if not device_ids:
+                break
+
+            with transaction.atomic():
+                updated += db_helpers.rebuild_device_states(device_ids)
+            last_device_id = device_ids[-1]
+            logger.info("Devices rebuilt up to %s", last_device_id)
+
+        self.stdout.write(f"{updated} devices updated.")
@@ -0,0 +1,104 @@
+"""
+Ingest again the pages archived by the poller, without polling the providers
+
+See ``POLLER_ARCHIVE_DIR``, e.g. after changing the mapping of status changes.
+"""
+from concurrent import futures
+import datetime
+import logging
+
+from django import db
+from django.core import management
+
+from mds import models
+from mds.provider_poller import archive
+from mds.provider_poller import poller
+
+
+logger = logging.getLogger(__name__)
+
+
+def replay_file(provider_id, path, overwrite):
+    """Ingest all the pages of the given archive file.
+
+    Run in a worker process.
+
+    Returns:
+        the number of status changes ingested
+    """
+    provider = models.Provider.objects.get(pk=provider_id)
+    status_changes_poller = poller.StatusChangesPoller(
+        provider, overwrite_polled_events=overwrite
+    )
+    count = 0
+    for page in archive.read_pages(path):
+        count += status_changes_poller.process_archived_page(
+            page["api_version"], page["body"]
+        )
+    logger.info("Replayed %s status changes from %s", count, path)
+    return count
+
+
+class Command(management.BaseCommand):
+    help = "Ingest again the pages archived by the poller."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--provider",
+            action="append",
+            dest="providers",
+            help="Only replay the pages of this provider ID (can be repeated).",
+        )
+        parser.add_argument(
+            "--since",
+            type=datetime.date.fromisoformat,
+            help="Only replay the pages polled from this day (YYYY-MM-DD).",
+        )
+        parser.add_argument(
+            "--until",
+            type=datetime.date.fromisoformat,
+            help="Only replay the pages polled until this day (YYYY-MM-DD).",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of archive files replayed concurrently.",
+        )
+        parser.add_argument(
+            "--overwrite",
+            action="store_true",
+            help=(
+                "Update the events already polled, not only the missing ones "
+                "(the events pushed by the providers are kept)."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        if not archive.is_enabled():
+            raise management.CommandError("POLLER_ARCHIVE_DIR is not set.")
+        files = archive.list_files(
+            options["providers"], since=options["since"], until=options["until"]
+        )
+        overwrite = options["overwrite"]
+
+        count = 0
+        if options["processes"] <= 1:
+            for provider_id, path in files:
+                count += replay_file(provider_id, path, overwrite)
+        else:
+            # The worker processes must not share the connection of this one
+            db.connections.close_all()
+            with futures.ProcessPoolExecutor(
+                max_workers=options["processes"]
+            ) as executor:
+                pending = [
+                    executor.submit(replay_file, provider_id, path, overwrite)
+                    for provider_id, path in files
+                ]
+                for future in futures.as_completed(pending):
+                    count += future.result()
+
+        self.stdout.write(
+            f"{count} status changes replayed from {len(files)} archive files."
+        )
@@ -0,0 +1,84 @@
+"""
+Save the telemetry queued by the agency API
+
+See the AGENCY_API_TELEMETRY_QUEUE setting.
+Several workers can run concurrently.
+"""
+import logging
+import time
+
+from django.core import management
+from django.db import transaction
+
+from mds import db_helpers
+from mds import enums
+from mds import metrics
+
+
+logger = logging.getLogger(__name__)
+
+queue_depth = metrics.gauge(
+    "mds_telemetry_queue_depth", "Number of telemetry requests waiting to be saved."
+)
+queue_lag = metrics.gauge(
+    "mds_telemetry_queue_lag_seconds",
+    "Time the oldest telemetry request has been waiting to be saved.",
+)
+frames_saved = metrics.counter(
+    "mds_telemetry_queue_frames_saved", "Number of queued telemetry frames saved."
+)
+
+
+class Command(management.BaseCommand):
+    help = "Save the telemetry queued by the agency API."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of queued requests saved together.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=1.0,
+            help="Seconds to wait when the queue is empty.",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Serve the metrics to Prometheus on this port.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of waiting.",
+        )
+
+    def handle(self, *args, **options):
+        if options["metrics_port"]:
+            metrics.start_http_server(options["metrics_port"])
+        while True:
+            depth, lag = db_helpers.get_telemetry_queue_stats()
+            queue_depth.set(depth)
+            queue_lag.set(lag)
+            logger.debug("Telemetry queue: %s requests, lag of %.1fs", depth, lag)
+
+            count = self.save_batch(options["batch_size"])
+            if not count:
+                if options["once"]:
+                    return
+                time.sleep(options["sleep"])
+
+    def save_batch(self, batch_size):
+        with transaction.atomic():
+            rows = db_helpers.pop_queued_telemetry(batch_size)
+            # Coalesced into a single write
+            db_helpers.copy_event_records(
+                rows, enums.EVENT_SOURCE.agency_api.name, on_conflict_update=True
+            )
+        if rows:
+            frames_saved.inc(len(rows))
+            logger.info("%s queued telemetry frames saved", len(rows))
+        return len(rows)
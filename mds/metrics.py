@@ -0,0 +1,245 @@
+"""
+Metrics about the ingestion of data
+
+Kept in memory by each process, e.g. the long running commands,
+and exported in the Prometheus text format (see ``start_http_server``).
+
+They can also be forwarded to other systems (e.g. StatsD) with backends,
+see the ``MDS_METRICS_BACKENDS`` setting: a list of dotted paths to classes
+implementing the methods of ``Backend``.
+"""
+import bisect
+import contextlib
+import http.server
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+_lock = threading.Lock()
+_registry = {}  # name -> metric
+_backends = None  # Loaded on first use
+
+# In seconds, from a cache hit to a slow provider
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Backend:
+    """Receive the metrics as they are recorded."""
+
+    def inc(self, metric, amount, labels):
+        pass
+
+    def set(self, metric, value, labels):
+        pass
+
+    def observe(self, metric, value, labels):
+        pass
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}  # sorted labels -> value
+
+    def get(self, **labels):
+        return self._values.get(_key(labels), 0)
+
+    def samples(self):
+        """List the (labels, value) of this metric."""
+        with _lock:
+            return [(dict(key), value) for key, value in self._values.items()]
+
+    def to_prometheus(self):
+        """The lines of this metric in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {_escape_help(self.documentation)}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. a number of rows saved."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        for backend in _get_backends():
+            backend.inc(self, amount, labels)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. the size of a queue."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with _lock:
+            self._values[_key(labels)] = value
+        for backend in _get_backends():
+            backend.set(self, value, labels)
+
+
+class Histogram(Metric):
+    """The distribution of values, e.g. the time spent on requests."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        # The values are (the counts of each bucket then +Inf, the sum)
+
+    def get(self, **labels):
+        """The number of values observed."""
+        value = self._values.get(_key(labels))
+        return sum(value[0]) if value else 0
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+        for backend in _get_backends():
+            backend.observe(self, value, labels)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with _lock:
+            return [
+                (dict(key), (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            ]
+
+    def to_prometheus(self):
+        lines = [
+            f"# HELP {self.name} {_escape_help(self.documentation)}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for labels, (counts, total) in self.samples():
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulated += count
+                bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulated}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulated}")
+        return lines
+
+
+def counter(name, documentation):
+    return _register(Counter, name, documentation)
+
+
+def gauge(name, documentation):
+    return _register(Gauge, name, documentation)
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, buckets=buckets)
+
+
+def _register(metric_class, name, documentation, **kwargs):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(name, documentation, **kwargs)
+    if not isinstance(metric, metric_class):
+        raise ValueError(f"{name} is already registered as a {metric.type}")
+    return metric
+
+
+def get_metrics():
+    """All the metrics registered so far, by name."""
+    with _lock:
+        return dict(_registry)
+
+
+def to_prometheus():
+    """All the metrics in the Prometheus text format."""
+    lines = []
+    for _, metric in sorted(get_metrics().items()):
+        lines.extend(metric.to_prometheus())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scraped every few seconds, don't flood the logs
+        pass
+
+
+def start_http_server(port, address=""):
+    """Serve the metrics to Prometheus from a background thread."""
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _get_backends():
+    global _backends
+    if _backends is None:
+        _backends = [
+            import_string(path)()
+            for path in getattr(settings, "MDS_METRICS_BACKENDS", [])
+        ]
+    return _backends
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    formatted = ",".join(
+        '%s="%s"' % (name, _escape_label_value(value))
+        for name, value in sorted(labels.items())
+    )
+    return "{%s}" % formatted
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _escape_help(documentation):
+    return documentation.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    deploy_phase = "pre_deploy"
+
+    dependencies = [("mds", "0003_post_index_device_events")]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="dn_status_timestamp",
+            field=models.DateTimeField(blank=True, null=True),
+        )
+    ]
@@ -0,0 +1,40 @@
+import django.contrib.postgres.fields.jsonb
+import django.contrib.postgres.functions
+from django.db import migrations, models
+import django.db.models.deletion
+import rest_framework.utils.encoders
+
+
+class Migration(migrations.Migration):
+    deploy_phase = "pre_deploy"
+
+    dependencies = [("mds", "0004_pre_device_dn_status_timestamp")]
+
+    operations = [
+        migrations.CreateModel(
+            name="QueuedTelemetry",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "queued_at",
+                    models.DateTimeField(
+                        default=django.contrib.postgres.functions.TransactionNow
+                    ),
+                ),
+                (
+                    "rows",
+                    django.contrib.postgres.fields.jsonb.JSONField(
+                        encoder=rest_framework.utils.encoders.JSONEncoder
+                    ),
+                ),
+                (
+                    "provider",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="queued_telemetries",
+                        to="mds.Provider",
+                    ),
+                ),
+            ],
+        )
+    ]
@@ -0,0 +1,42 @@
+import django.contrib.postgres.functions
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    deploy_phase = "pre_deploy"
+
+    dependencies = [("mds", "0005_pre_queued_telemetry")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProviderPollingWindow",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start", models.DateTimeField()),
+                (
+                    "polled_at",
+                    models.DateTimeField(
+                        default=django.contrib.postgres.functions.TransactionNow
+                    ),
+                ),
+                (
+                    "provider",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="polling_windows",
+                        to="mds.Provider",
+                    ),
+                ),
+            ],
+            options={"unique_together": {("provider", "start")}},
+        )
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    deploy_phase = "pre_deploy"
+
+    dependencies = [("mds", "0006_pre_provider_polling_window")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ComplianceWatermark",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("lag", models.DurationField(unique=True)),
+                ("computed_at", models.DateTimeField()),
+                ("last_saved_at", models.DateTimeField()),
+            ],
+        )
+    ]
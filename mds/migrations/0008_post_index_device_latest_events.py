@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("mds", "0007_pre_compliance_watermark"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    """CREATE INDEX CONCURRENTLY IF NOT EXISTS "device_mds_latest_events" ON "mds_eventrecord" ("device_id", "timestamp" DESC) WHERE NOT ("event_type" = 'telemetry')""",
+                    'DROP INDEX CONCURRENTLY IF EXISTS "device_mds_latest_events"',
+                ),
+                # Made redundant by the index above
+                migrations.RunSQL(
+                    'DROP INDEX CONCURRENTLY IF EXISTS "device_mds_events_partial"',
+                    """CREATE INDEX CONCURRENTLY IF NOT EXISTS "device_mds_events_partial" ON "mds_eventrecord" ("device_id") WHERE NOT ("event_type" = 'telemetry')""",
+                ),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name="eventrecord",
+                    index=models.Index(
+                        condition=models.Q(_negated=True, event_type="telemetry"),
+                        fields=["device", "-timestamp"],
+                        name="device_mds_latest_events",
+                    ),
+                ),
+                migrations.RemoveIndex(
+                    model_name="eventrecord", name="device_mds_events_partial",
+                ),
+            ],
+        ),
+    ]
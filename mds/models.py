@@ -5,18 +5,23 @@ import json
 import uuid
 
 from django import forms
+from django.conf import settings
 from django.contrib.gis.db import models as gis_models
+from django.contrib.gis.db.models import functions as gis_functions
 from django.contrib.postgres import fields as pg_fields
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.contrib.postgres import functions as pg_functions
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Count, Prefetch, Q, Index
+from django.db import models, transaction
+from django.db.models import Count, OuterRef, Q, Index, Subquery
+from django.db.models.query import ModelIterable
 from django.utils import timezone
 from django.core.serializers.json import DjangoJSONEncoder
 
 from rest_framework.utils import encoders
 
 from . import enums
+from . import geography_index
 
 
 class UnboundedCharField(models.TextField):
@@ -72,6 +77,15 @@ def short_uuid4(uid):
     return str(uid)[:8]  # Basically splitting on the first dash
 
 
+def invalidate_provider_config(*provider_ids):
+    """The agency API caches the configuration of providers (per process)."""
+    from . import provider_config  # Circular import
+
+    provider_config.invalidate(*provider_ids)
+    # Again in case the former configuration was cached before the commit
+    transaction.on_commit(lambda: provider_config.invalidate(*provider_ids))
+
+
 class ProviderQuerySet(models.QuerySet):
     def with_device_categories(self, **kwargs):
         # A single dict would be simpler but I don't know how to make this in SQL
@@ -157,6 +171,16 @@ class Provider(models.Model):
     def __str__(self):
         return "{} ({})".format(self.name or "Provider object", short_uuid4(self.id))
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_provider_config(self.pk)
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        result = super().delete(*args, **kwargs)
+        invalidate_provider_config(pk)
+        return result
+
     @property
     def device_categories(self):
         # This will fail if you didn't call objects.with_device_categories()
@@ -168,21 +192,64 @@ class Provider(models.Model):
         return device_categories
 
 
+class ProviderPollingWindow(models.Model):
+    """An hour of archived status changes already polled from a provider.
+
+    Only kept until the polling cursor of the provider moves past it,
+    see ``StatusChangesPoller.backfill_workers``.
+    """
+
+    provider = models.ForeignKey(
+        Provider, related_name="polling_windows", on_delete=models.CASCADE
+    )
+    start = models.DateTimeField()
+    polled_at = models.DateTimeField(default=pg_functions.TransactionNow)
+
+    class Meta:
+        unique_together = [("provider", "start")]
+
+
 class DeviceQueryset(models.QuerySet):
+    _with_latest_events = False
+
     def with_latest_events(self):
-        prefetched_events = Prefetch(
-            "event_records",
-            # Excluding telemetry because MDS Agency separates event from telemetry
-            # and the "latest_event" does not count telemetries as events
-            queryset=EventRecord.objects.exclude(event_type="telemetry").order_by(
-                "-timestamp"
-            ),
-            to_attr="_latest_events",
+        # Excluding telemetry because MDS Agency separates event from telemetry
+        # and the "latest_event" does not count telemetries as events
+        latest_event = (
+            EventRecord.objects.filter(device=OuterRef("pk"))
+            .exclude(event_type="telemetry")
+            .order_by("-timestamp")
+            .values("pk")[:1]
         )
-        # Here, we can't limit the query set so, in order to limit,
-        # we have to use a latest_event property (see the property in the model)
-        prefetch_related = self.prefetch_related(prefetched_events)
-        return prefetch_related
+        # A single index lookup per device, whatever the length of its history
+        # (the events themselves are fetched along the devices, see _fetch_all)
+        clone = self.annotate(latest_event_id=Subquery(latest_event))
+        clone._with_latest_events = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._with_latest_events = self._with_latest_events
+        return clone
+
+    def _fetch_all(self):
+        fetch_latest_events = (
+            self._with_latest_events
+            and self._result_cache is None
+            and issubclass(self._iterable_class, ModelIterable)
+        )
+        super()._fetch_all()
+        if fetch_latest_events:
+            # Like a prefetch but only one event per device
+            latest_events = EventRecord.objects.in_bulk(
+                [
+                    device.latest_event_id
+                    for device in self._result_cache
+                    if device.latest_event_id
+                ]
+            )
+            for device in self._result_cache:
+                device._latest_event = latest_events.get(device.latest_event_id)
 
 
 class Device(models.Model):
@@ -208,6 +275,7 @@ class Device(models.Model):
 
     # denormalized fields - the source of truth is in the EventRecord table.
     # /!\ These fields are for internal usage and may disappear anytime
+    # (maintained when ingesting events, see db_helpers.copy_event_records)
     dn_battery_pct = models.FloatField(blank=True, null=True)
     dn_gps_point = gis_models.PointField(blank=True, null=True)
     dn_gps_timestamp = models.DateTimeField(blank=True, null=True)
@@ -215,6 +283,8 @@ class Device(models.Model):
         choices=enums.choices(enums.DEVICE_STATUS),
         default=enums.DEVICE_STATUS.unknown.name,
     )
+    # Timestamp of the event that gave the status, the newest always wins
+    dn_status_timestamp = models.DateTimeField(blank=True, null=True)
 
     objects = DeviceQueryset.as_manager()
 
@@ -227,9 +297,9 @@ class Device(models.Model):
 
     @property
     def latest_event(self):
-        if hasattr(self, "_latest_events"):
-            # don't do a query in this case, the telemetry was prefetched.
-            return self._latest_events[0] if self._latest_events else None
+        if hasattr(self, "_latest_event"):
+            # don't do a query in this case, the event was prefetched.
+            return self._latest_event
         latest_events = (
             EventRecord.objects.filter(device_id=self.id)
             .exclude(event_type="telemetry")
@@ -278,11 +348,11 @@ class EventRecord(models.Model):
     class Meta:
         unique_together = [("device", "timestamp")]
         # TODO(hcauwelier) only ~2% of the events are useful to display
-        # Speed up searching among them for a given device
+        # Speed up searching among them for a given device, the latest first
         indexes = [
             Index(
-                fields=["device"],
-                name="device_mds_events_partial",
+                fields=["device", "-timestamp"],
+                name="device_mds_latest_events",
                 condition=~Q(event_type="telemetry"),
             )
         ]
@@ -306,6 +376,22 @@ class EventRecord(models.Model):
         return self.publication_time
 
 
+class QueuedTelemetry(models.Model):
+    """Telemetry accepted by the agency API but not saved as event records yet.
+
+    See the ``AGENCY_API_TELEMETRY_QUEUE`` setting
+    and the ``save_queued_telemetry`` command.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    queued_at = models.DateTimeField(default=pg_functions.TransactionNow)
+    provider = models.ForeignKey(
+        Provider, related_name="queued_telemetries", on_delete=models.CASCADE
+    )
+    # The rows for db_helpers.copy_event_records
+    rows = pg_fields.JSONField(encoder=encoders.JSONEncoder)
+
+
 class Polygon(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
     label = UnboundedCharField(default="", blank=True, db_index=True)
@@ -331,7 +417,34 @@ class Area(models.Model):
         return "{} ({})".format(self.label or "Area object", short_uuid4(self.id))
 
 
+# The most decimals ST_AsGeoJSON can output, as many as the coordinates have
+MAX_GEOJSON_PRECISION = 15
+
+
+class SimplifyPreserveTopology(gis_functions.GeoFunc):
+    function = "ST_SimplifyPreserveTopology"
+
+
+def _frozen_geojson(geom):
+    """The GeoJSON of the geometries frozen in the policies when published.
+
+    Simplified (see ``POLICY_GEOGRAPHY_SIMPLIFY``, in degrees)
+    and with fewer decimals (see ``POLICY_GEOGRAPHY_PRECISION``)
+    to keep the policies small, both are disabled by default.
+    """
+    tolerance = getattr(settings, "POLICY_GEOGRAPHY_SIMPLIFY", None)
+    if tolerance:
+        geom = SimplifyPreserveTopology(geom, tolerance)
+    precision = getattr(settings, "POLICY_GEOGRAPHY_PRECISION", None)
+    if precision is None:
+        # Not the default of PostGIS (9 decimals since PostGIS 3)
+        precision = MAX_GEOJSON_PRECISION
+    return gis_functions.AsGeoJSON(geom, precision=precision)
+
+
 class PolicyQueryset(models.QuerySet):
+    _compliances_snapshot_of = None
+
     def active(self, at=None, **kwargs):
         if not at:
             at = timezone.now()
@@ -344,6 +457,43 @@ class PolicyQueryset(models.QuerySet):
             **kwargs,
         )
 
+    def with_compliances_snapshot(self, compliances=None):
+        """Fetch the compliances of each policy counted by rule and geography.
+
+        Args:
+            compliances: Compliance queryset, e.g. only the compliances of a provider
+
+        The snapshot is set on each policy as ``compliances_snapshot``,
+        see ``ComplianceQueryset.snapshot``.
+        """
+        clone = self._chain()
+        if compliances is None:
+            compliances = Compliance.objects.all()
+        clone._compliances_snapshot_of = compliances
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._compliances_snapshot_of = self._compliances_snapshot_of
+        return clone
+
+    def _fetch_all(self):
+        fetch_snapshot = (
+            self._compliances_snapshot_of is not None
+            and self._result_cache is None
+            and issubclass(self._iterable_class, ModelIterable)
+        )
+        super()._fetch_all()
+        if fetch_snapshot:
+            # Like a prefetch but aggregated in the database
+            snapshots = {policy.pk: [] for policy in self._result_cache}
+            for row in self._compliances_snapshot_of.filter(
+                policy__in=list(snapshots)
+            ).snapshot():
+                snapshots[row["policy_id"]].append(row)
+            for policy in self._result_cache:
+                policy.compliances_snapshot = snapshots[policy.pk]
+
 
 class Policy(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
@@ -394,24 +544,38 @@ class Policy(models.Model):
         for rule in self.rules:
             # Geographies are required in the spec
             if not rule["geographies"]:
-                raise ValidationError(f"Rule {rule.rule_id} has no geographies.")
+                raise ValidationError(f"Rule {rule['rule_id']} has no geographies.")
+
+        # All the areas at once, with their polygons already serialized
+        areas = Area.objects.filter(
+            pk__in={
+                str(area_id) for rule in self.rules for area_id in rule["geographies"]
+            }
+        ).prefetch_related(
+            models.Prefetch(
+                "polygons",
+                queryset=Polygon.objects.defer("geom", "properties").annotate(
+                    geojson=_frozen_geojson("geom")
+                ),
+            )
+        )
+        areas = {str(area.pk): area for area in areas}
 
+        for rule in self.rules:
             for area_id in rule["geographies"]:
                 geo_id = area_id_to_geo_id.get(area_id)
                 if not geo_id:
                     geo_id = area_id_to_geo_id[area_id] = uuid.uuid4()
 
-                if geo_id not in self.geographies:
-                    try:
-                        area = Area.objects.get(pk=area_id)
-                    except Area.DoesNotExist:
+                if str(geo_id) not in self.geographies:
+                    area = areas.get(str(area_id))
+                    if area is None:
                         raise ValidationError(
                             f"Geography {geo_id} referenced by "
                             f"rule {rule['rule_id']} is unknown."
                         )
-                    # This is trigger a database query,
-                    # just as a prefetch_related on a single area would anyway
-                    if not len(area.polygons.all()):
+                    polygons = area.polygons.all()  # Prefetched
+                    if not polygons:
                         raise ValidationError(f"Geography {geo_id} has no geometry.")
 
                     self.geographies[str(geo_id)] = {
@@ -419,8 +583,8 @@ class Policy(models.Model):
                         "geometry": {
                             "type": "GeometryCollection",
                             "geometries": [
-                                json.loads(polygon.geom.geojson)  # Serialized
-                                for polygon in area.polygons.all()
+                                json.loads(polygon.geojson)  # Serialized
+                                for polygon in polygons
                             ],
                         },
                         "id": geo_id,  # In the GeoJSON spec
@@ -444,6 +608,23 @@ class Policy(models.Model):
         self.published_date = at
 
         self.save()
+        geography_index.invalidate()
+
+
+class ComplianceQueryset(models.QuerySet):
+    def snapshot(self):
+        """Count the compliances by policy, rule and geography.
+
+        Returns:
+            dicts of the "policy_id", "rule", "geography", the count as "measured"
+            and the "vehicle_ids" in violation, ordered by policy, rule and geography
+        """
+        return (
+            self.order_by()
+            .values("policy_id", "rule", "geography")
+            .annotate(measured=Count("pk"), vehicle_ids=ArrayAgg("vehicle_id"))
+            .order_by("policy_id", "rule", "geography")
+        )
 
 
 class Compliance(models.Model):
@@ -464,6 +645,8 @@ class Compliance(models.Model):
     saved_at = models.DateTimeField(db_index=True, auto_now=True)
     extra = pg_fields.JSONField(blank=True, null=True)
 
+    objects = ComplianceQueryset.as_manager()
+
     class Meta:
         unique_together = (
             "policy",
@@ -478,3 +661,16 @@ class Compliance(models.Model):
 
     def __str__(self):
         return f"({short_uuid4(self.id)})"
+
+
+class ComplianceWatermark(models.Model):
+    """Where the compliance engine stopped for each lag, see mds.compliance."""
+
+    lag = models.DurationField(unique=True)
+    # The time the policies were evaluated at (the time of the run minus the lag)
+    computed_at = models.DateTimeField()
+    # The events saved since were not seen by this run
+    last_saved_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.lag} ({self.computed_at})"
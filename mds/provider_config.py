@@ -0,0 +1,93 @@
+"""
+Per-process cache of the provider configuration
+
+The agency API reads it on every request but it hardly ever changes.
+
+Saving or deleting a provider invalidates the cache of the current process,
+the other processes will see the change after ``PROVIDER_CONFIG_CACHE_TTL``.
+"""
+from collections import namedtuple
+import threading
+import time
+
+from django.conf import settings
+
+from . import enums
+from . import models
+
+
+# The values we need from the provider, already resolved
+ProviderConfig = namedtuple(
+    "ProviderConfig",
+    (
+        "provider_id",
+        # The agency API version the provider is pushing data with
+        "agency_api_version",
+        # Some providers may mistake latitude and longitude
+        "swap_lat_lng",
+    ),
+)
+
+_cache = {}  # provider ID -> (expiry, config)
+_lock = threading.Lock()
+
+
+def get(provider_id):
+    """The configuration of the given provider ID, from the cache if possible.
+
+    Raises:
+        models.Provider.DoesNotExist
+    """
+    provider_id = str(provider_id)
+    now = time.monotonic()
+    with _lock:
+        expiry, config = _cache.get(provider_id, (0, None))
+    if expiry > now:
+        return config
+
+    config = from_provider(models.Provider.objects.get(pk=provider_id))
+    ttl = getattr(settings, "PROVIDER_CONFIG_CACHE_TTL", 60)
+    with _lock:
+        _cache[provider_id] = (now + ttl, config)
+    return config
+
+
+def get_agency_api_version(provider_id):
+    return get(provider_id).agency_api_version
+
+
+def from_provider(provider):
+    """Resolve the configuration of this provider instance."""
+    return ProviderConfig(
+        provider_id=str(provider.pk),
+        agency_api_version=_resolve_agency_api_version(provider),
+        swap_lat_lng=bool(provider.agency_api_configuration.get("swap_lat_lng")),
+    )
+
+
+def _resolve_agency_api_version(provider):
+    # TODO(hcauwelier) make it mandatory, see SMP-1673
+    api_version = provider.agency_api_configuration.get("api_version")
+    if not api_version:
+        # TODO(hcauwelier) clean up, "api_configuration" was for the provider API
+        api_version = provider.api_configuration.get("agency_api_version")
+        if not api_version:
+            api_version = enums.MDS_VERSIONS[enums.DEFAULT_AGENCY_API_VERSION].value
+    else:
+        # We store the enum key, which cannot be a numeric identifier
+        # It doubles as a validity check
+        api_version = enums.MDS_VERSIONS[api_version].value
+    return api_version
+
+
+def invalidate(*provider_ids):
+    """Forget the configuration of these providers in this process."""
+    with _lock:
+        for provider_id in provider_ids:
+            _cache.pop(str(provider_id), None)
+
+
+def clear():
+    """Forget everything, e.g. between tests."""
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,87 @@
+"""
+Local archive of the pages polled from the providers
+
+Each page is appended as a JSON line to a gzip file for each provider and day,
+to ingest them again without polling the providers (see the
+``replay_provider_archives`` command), e.g. after changing the mapping.
+"""
+import datetime
+import fcntl
+import gzip
+import json
+import os
+
+from django.utils import timezone
+
+from .settings import POLLER_ARCHIVE_DIR
+
+
+FILE_SUFFIX = ".jsonl.gz"
+
+
+def is_enabled():
+    return bool(POLLER_ARCHIVE_DIR)
+
+
+def write_page(provider, api_version, url, body):
+    """Append the body of the page polled to the archive of today."""
+    polled_at = timezone.now()
+    directory = os.path.join(POLLER_ARCHIVE_DIR, str(provider.pk))
+    path = os.path.join(directory, polled_at.date().isoformat() + FILE_SUFFIX)
+    line = json.dumps(
+        {
+            "polled_at": polled_at.isoformat(),
+            "api_version": api_version,
+            "url": url,
+            "body": body,
+        }
+    )
+    # Each append is a gzip member of its own, gzip reads them all in turn
+    member = gzip.compress((line + "\n").encode("utf-8"))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "ab") as f:
+        # Several threads, or processes, may poll the same provider
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(member)
+
+
+def list_files(provider_ids=None, since=None, until=None):
+    """The archive files of the given providers and days (included), in order.
+
+    Args:
+        provider_ids: list of str, all the providers by default
+        since: datetime.date, the first day polled
+        until: datetime.date, the last day polled
+
+    Returns:
+        a list of (provider ID, path)
+    """
+    if not os.path.isdir(POLLER_ARCHIVE_DIR):
+        return []
+    if provider_ids is None:
+        provider_ids = sorted(os.listdir(POLLER_ARCHIVE_DIR))
+
+    files = []
+    for provider_id in provider_ids:
+        directory = os.path.join(POLLER_ARCHIVE_DIR, str(provider_id))
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(FILE_SUFFIX):
+                continue
+            day = datetime.date.fromisoformat(filename[: -len(FILE_SUFFIX)])
+            if (since and day < since) or (until and day > until):
+                continue
+            files.append((str(provider_id), os.path.join(directory, filename)))
+    return files
+
+
+def read_pages(path):
+    """Iterate on the pages archived in the given file, in the order polled.
+
+    Yields:
+        dicts of polled_at, api_version, url and body
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,74 @@
+import collections
+import threading
+import time
+
+from .settings import POLLER_EXISTENCE_CACHE_SIZE, POLLER_EXISTENCE_CACHE_TTL
+
+
+class ExistenceCache:
+    """Remember which primary keys of a model exist in the database.
+
+    Only the keys we are asked about are looked up, in a single query per batch,
+    so the memory used doesn't grow with the table.
+    The least recently used keys are evicted beyond ``max_size``
+    and keys expire after ``ttl`` seconds (in case rows were deleted meanwhile).
+
+    Thread-safe, the same cache can be shared between pollers.
+
+    Args:
+        model: the Django model to look up
+        max_size: int, maximum number of keys remembered
+        ttl: int, number of seconds a key is remembered
+    """
+
+    def __init__(
+        self,
+        model,
+        max_size=POLLER_EXISTENCE_CACHE_SIZE,
+        ttl=POLLER_EXISTENCE_CACHE_TTL,
+    ):
+        self.model = model
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expiries = collections.OrderedDict()  # Ordered by last use
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def missing(self, keys):
+        """Return the keys not found in the database."""
+        unknown = self._unknown(keys)
+        if not unknown:
+            return set()
+
+        found = set(
+            self.model.objects.filter(pk__in=unknown).values_list("pk", flat=True)
+        )
+        self.add(found)
+        return unknown - found
+
+    def add(self, keys):
+        """Remember these keys exist (only once they are committed!)."""
+        expiry = time.monotonic() + self.ttl
+        with self._lock:
+            for key in keys:
+                self._expiries[key] = expiry
+                self._expiries.move_to_end(key)
+            while len(self._expiries) > self.max_size:
+                self._expiries.popitem(last=False)
+
+    def _unknown(self, keys):
+        now = time.monotonic()
+        unknown = set()
+        with self._lock:
+            for key in set(keys):
+                expiry = self._expiries.get(key)
+                if expiry is None:
+                    unknown.add(key)
+                elif expiry < now:
+                    del self._expiries[key]
+                    unknown.add(key)
+                else:
+                    self._expiries.move_to_end(key)
+        return unknown
@@ -0,0 +1,53 @@
+"""
+Making sure a provider is only polled by one process at a time
+
+The poller may run on several nodes, a PostgreSQL advisory lock is taken
+for each provider polled, the others skip it and poll the next provider.
+
+The lock belongs to the database session: it is released if the process dies
+(but it doesn't work behind a pooler in transaction mode, e.g. pgbouncer).
+"""
+import contextlib
+import logging
+
+from django.db import connection, DatabaseError
+
+from .settings import POLLER_LOCKING
+
+
+logger = logging.getLogger(__name__)
+
+# Namespace of our advisory locks, the provider ID being the key in it
+LOCK_NAMESPACE = "mds.provider_poller"
+
+
+@contextlib.contextmanager
+def provider_lock(provider):
+    """Try to lock the polling of the given provider.
+
+    Yields:
+        bool, if the lock was acquired (always when ``POLLER_LOCKING`` is disabled)
+    """
+    if not POLLER_LOCKING:
+        yield True
+        return
+
+    keys = [LOCK_NAMESPACE, str(provider.pk)]
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s), hashtext(%s))", keys)
+        (locked,) = cursor.fetchone()
+    if not locked:
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_unlock(hashtext(%s), hashtext(%s))", keys
+                )
+        except DatabaseError:
+            # Released anyway when the broken connection is closed
+            logger.exception("Could not unlock the polling of %s", provider)
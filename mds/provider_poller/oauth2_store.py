@@ -10,6 +10,7 @@ from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 from retrying import retry
 
+from . import sessions
 from .settings import POLLER_TOKEN_CACHE, POLLER_TOKEN_ENCRYPTION_KEY
 
 
@@ -43,7 +44,11 @@ class OAuth2Store(threading.local):
         """Authenticate using the Backend Application Flow from OAuth2."""
         client_id = self.provider.api_authentication["client_id"]
         token = self._get_access_token()
-        client = OAuth2Session(client_id, token=token)
+        # Reuse the connections to the provider, only the token may change
+        # (the session is private to this thread)
+        client = sessions.get(self.provider, client_id=client_id)
+        if client.token != token:
+            client.token = token
         return client
 
     def _get_access_token(self):
@@ -3,27 +3,38 @@ Pulling data for registered providers
 
 This is the opposite of provider pushing their data to the agency API.
 """
+from concurrent import futures
 import datetime
 import enum
 import logging
+import queue
+import threading
+import time
 import urllib.parse
 import uuid
 
+from django import db
 from django.conf import settings
-from django.contrib.gis import geos
 from django.db import transaction
 from django.utils import timezone
 from django.utils.dateparse import parse_duration
 
-import requests
-from retrying import retry
-
 from mds import db_helpers
 from mds import enums
+from mds import metrics
 from mds import models
 from mds import utils
 from mds.provider_mapping import PROVIDER_REASON_TO_AGENCY_EVENT
+from . import archive
+from . import locking
+from . import retries
+from . import sessions
+from . import streaming
+from .existence_cache import ExistenceCache
 from .oauth2_store import OAuth2Store
+from .settings import POLLER_BACKFILL_WORKERS
+from .settings import POLLER_PREFETCH_PAGES
+from .settings import POLLER_STREAM_CHUNK_SIZE
 from .translation import translate_v0_2_to_v0_4
 
 
@@ -32,6 +43,28 @@ MDS_CONTENT_TYPE = "application/vnd.mds.provider+json"
 
 logger = logging.getLogger(__name__)
 
+request_seconds = metrics.histogram(
+    "mds_poller_request_seconds", "Time spent downloading a page, by provider."
+)
+parse_seconds = metrics.histogram(
+    "mds_poller_parse_seconds", "Time spent parsing a page, by provider."
+)
+process_seconds = metrics.histogram(
+    "mds_poller_process_seconds",
+    "Time spent validating and saving a page, by provider.",
+)
+status_changes_received = metrics.counter(
+    "mds_poller_status_changes_received",
+    "Number of status changes received, by provider.",
+)
+status_changes_dropped = metrics.counter(
+    "mds_poller_status_changes_dropped",
+    "Number of invalid status changes dropped, by provider and reason.",
+)
+polling_lag = metrics.gauge(
+    "mds_poller_lag_seconds", "Time since the last event polled, by provider."
+)
+
 
 # polling_cursor configuration field translated to query parameter
 class POLLING_CURSORS(enum.Enum):
@@ -55,9 +88,34 @@ class StatusChangesPoller:
         cursor: POLLING_CURSORS, cursor type
         from_cursor: timestamp or int, lower limit
         to_cursor: timestamp or int, upper limit
+        provider_cache: ExistenceCache of providers, to share between pollers
+        device_cache: ExistenceCache of devices, to share between pollers
+        prefetch_pages: int, number of pages downloaded in the background
+            while saving the current one (0 to download them in turn)
+        backfill_workers: int, number of hours of MDS 0.4 archives polled
+            concurrently when catching up (1 to poll them in turn)
+        stream_chunk_size: int, number of MDS 0.4 status changes parsed and saved
+            at once while the page is downloaded (0 to parse whole pages),
+            pages are not prefetched then
+        overwrite_polled_events: bool, update the event records already polled,
+            e.g. when ingesting the archives again after changing the mapping
+        stop_event: threading.Event, to stop polling after the current page
     """
 
-    def __init__(self, provider, cursor=None, from_cursor=None, to_cursor=None):
+    def __init__(
+        self,
+        provider,
+        cursor=None,
+        from_cursor=None,
+        to_cursor=None,
+        provider_cache=None,
+        device_cache=None,
+        prefetch_pages=POLLER_PREFETCH_PAGES,
+        backfill_workers=POLLER_BACKFILL_WORKERS,
+        stream_chunk_size=POLLER_STREAM_CHUNK_SIZE,
+        overwrite_polled_events=False,
+        stop_event=None,
+    ):
         self.provider = provider
         self.cursor = cursor
         self.from_cursor = from_cursor
@@ -65,9 +123,24 @@ class StatusChangesPoller:
         self.oauth2_store = OAuth2Store(provider)
         # While we poll a given provider, it may aggregate data from several providers
         # There's no difference yet between a service provider and a pure data provider
-        # (these are sets of UUIDs, not str)
-        self.provider_uids = set(models.Provider.objects.values_list("pk", flat=True))
-        self.device_uids = set(models.Device.objects.values_list("pk", flat=True))
+        # (the caches are filled with UUIDs, not str, as we see them in each page)
+        # (an empty cache is falsy, don't replace a shared one by a private one)
+        if provider_cache is None:
+            provider_cache = ExistenceCache(models.Provider)
+        if device_cache is None:
+            device_cache = ExistenceCache(models.Device)
+        self.provider_cache = provider_cache
+        self.device_cache = device_cache
+        self.prefetch_pages = prefetch_pages
+        self.backfill_workers = backfill_workers
+        self.stream_chunk_size = stream_chunk_size
+        self.overwrite_polled_events = overwrite_polled_events
+        self.stop_event = stop_event
+
+    @property
+    def metric_labels(self):
+        # Names are not unique
+        return {"provider_id": str(self.provider.pk), "provider": self.provider.name}
 
     def poll(self):
         if not self.provider.base_api_url:
@@ -83,9 +156,34 @@ class StatusChangesPoller:
         # It doubles as a validity check
         api_version = enums.MDS_VERSIONS[api_version_raw].value
 
-        logger.debug("Polling %s using version %s", self.provider.name, api_version)
+        with locking.provider_lock(self.provider) as locked:
+            if not locked:
+                logger.info(
+                    "Provider %s is polled by another process, skipping.",
+                    self.provider.name,
+                )
+                return
+            # The other process may have moved the cursors since we loaded them
+            self.provider.refresh_from_db(
+                fields=[
+                    "last_event_time_polled",
+                    "last_recorded_polled",
+                    "last_skip_polled",
+                ]
+            )
 
-        getattr(self, "_poll_status_changes_%s" % api_version_raw)(api_version)
+            logger.debug("Polling %s using version %s", self.provider.name, api_version)
+
+            try:
+                getattr(self, "_poll_status_changes_%s" % api_version_raw)(api_version)
+            finally:
+                if self.provider.last_event_time_polled:
+                    polling_lag.set(
+                        (
+                            timezone.now() - self.provider.last_event_time_polled
+                        ).total_seconds(),
+                        **self.metric_labels,
+                    )
 
     # TODO(hcauwelier) Should be deleted ASAP
     def _poll_status_changes_v0_2(self, api_version):
@@ -132,10 +230,10 @@ class StatusChangesPoller:
 
             # But we now apply a "lag" before actually polling,
             # leaving time for the provider to collect data from its devices
-            polling_lag = self.provider.api_configuration.get("provider_polling_lag")
-            if polling_lag:
-                polling_lag = parse_duration(polling_lag)
-                if (timezone.now() - last_event_time_polled) < polling_lag:
+            lag = self.provider.api_configuration.get("provider_polling_lag")
+            if lag:
+                lag = parse_duration(lag)
+                if (timezone.now() - last_event_time_polled) < lag:
                     logger.debug("Still under the polling lag, back to sleep.")
                     return
 
@@ -163,16 +261,13 @@ class StatusChangesPoller:
         )
 
         # Pagination
-        while next_url:
-            body = self._get_body(next_url, api_version)
+        for body in self._iter_pages(next_url, api_version):
             # Translate older versions of data
             translated_data = translate_v0_2_to_v0_4(body["data"])
             status_changes = translated_data["status_changes"]
             if not status_changes:
                 break
 
-            next_url = body.get("links", {}).get("next")
-
             # A transaction for each "page" of data
             with transaction.atomic():
                 # We get the maximum of the recorded and event_types
@@ -261,10 +356,10 @@ class StatusChangesPoller:
 
             # But we now apply a "lag" before actually polling,
             # leaving time for the provider to collect data from its devices
-            polling_lag = self.provider.api_configuration.get("provider_polling_lag")
-            if polling_lag:
-                polling_lag = parse_duration(polling_lag)
-                if (timezone.now() - last_event_time_polled) < polling_lag:
+            lag = self.provider.api_configuration.get("provider_polling_lag")
+            if lag:
+                lag = parse_duration(lag)
+                if (timezone.now() - last_event_time_polled) < lag:
                     logger.debug("Still under the polling lag, back to sleep.")
                     return
 
@@ -292,15 +387,12 @@ class StatusChangesPoller:
         )
 
         # Pagination
-        while next_url:
-            body = self._get_body(next_url, api_version)
+        for body in self._iter_pages(next_url, api_version):
             # MDS 0.3 is backwards compatible with 0.4
             status_changes = body["data"]["status_changes"]
             if not status_changes:
                 break
 
-            next_url = body.get("links", {}).get("next")
-
             # A transaction for each "page" of data
             with transaction.atomic():
                 # We get the maximum of the recorded and event_types
@@ -377,10 +469,10 @@ class StatusChangesPoller:
 
         # But we now apply a "lag" before actually polling,
         # leaving time for the provider to collect data from its devices
-        polling_lag = self.provider.api_configuration.get("provider_polling_lag")
-        if polling_lag:
-            polling_lag = parse_duration(polling_lag)
-            if (timezone.now() - last_event_time_polled) < polling_lag:
+        lag = self.provider.api_configuration.get("provider_polling_lag")
+        if lag:
+            lag = parse_duration(lag)
+            if (timezone.now() - last_event_time_polled) < lag:
                 logger.info("Still under the polling lag, back to sleep.")
                 return
 
@@ -396,6 +488,12 @@ class StatusChangesPoller:
         if (timezone.now() - next_event_time) > realtime_threshold:
             # We have to query the archived status changes with another format
             logger.info("last_event_time_polled is too old, asking archives")
+            if self.backfill_workers > 1 and not self.cursor:
+                # Each hour is independent from the others, poll them at once
+                self._backfill_archives(
+                    api_version, next_event_time, realtime_threshold
+                )
+                return
             # We're done with the events of the last hour, ask the next hour
             params["event_time"] = next_event_time.isoformat()[: len("YYYY-MM-DDTHH")]
         else:
@@ -404,9 +502,9 @@ class StatusChangesPoller:
             # Both bounds are mandatory now, use the lag as the event horizon
             # The provider will slice big results using pagination
             end_time = timezone.now()
-            if polling_lag:
+            if lag:
                 # We tested the lag above, so end_time can't be older than start_time
-                end_time -= polling_lag
+                end_time -= lag
             params["end_time"] = utils.to_mds_timestamp(end_time)
 
         # Provider-specific params to optimise polling
@@ -419,31 +517,21 @@ class StatusChangesPoller:
         if "event_time" in params:
             # We asked the archived status changes instead
             endpoint = "status_changes"
-        next_url = urllib.parse.urljoin(self.provider.base_api_url, endpoint)
-        if self.provider.api_configuration.get("trailing_slash"):
-            next_url += "/"
-
-        if params:
-            next_url = "%s?%s" % (next_url, urllib.parse.urlencode(params))
+        next_url = self._build_url(endpoint, params)
 
         # Pagination
-        while next_url:
-            body = self._get_body(next_url, api_version)
-            # No translation needed as long as 0.4 is the latest version
-            status_changes = body["data"]["status_changes"]
-            next_url = body.get("links", {}).get("next")
-
+        for chunks in self._iter_status_changes(next_url, api_version):
             # A transaction for each "page" of data
             with transaction.atomic():
-                if status_changes:
-                    # We get the maximum values from the status changes
-                    event_time_polled, _ = self._process_status_changes(status_changes)
-                elif endpoint == "status_changes":
-                    # This hour frame of archives didn't contain results
-                    event_time_polled = next_event_time
-                else:
-                    # Try again from this point later
-                    break
+                # We get the maximum values from the status changes
+                event_time_polled, _ = self._process_status_changes_chunks(chunks)
+                if not event_time_polled:
+                    if endpoint == "status_changes":
+                        # This hour frame of archives didn't contain results
+                        event_time_polled = next_event_time
+                    else:
+                        # Try again from this point later
+                        break
 
                 if self.cursor:
                     if self.cursor == POLLING_CURSORS.start_time.name:
@@ -458,11 +546,213 @@ class StatusChangesPoller:
                     + f"\tLast event_time: {str(event_time_polled)}."
                 )
 
-    @retry(stop_max_attempt_number=2)
+    def _backfill_archives(self, api_version, next_event_time, realtime_threshold):
+        """Poll the hours of archived status changes concurrently.
+
+        The polling cursor only moves past the hours polled without a gap,
+        the hours polled after a failed one are remembered not to poll them again.
+        """
+        first_window = next_event_time.replace(minute=0, second=0, microsecond=0)
+        windows = []
+        while (timezone.now() - next_event_time) > realtime_threshold:
+            windows.append(next_event_time.replace(minute=0, second=0, microsecond=0))
+            next_event_time += datetime.timedelta(hours=1)
+        already_polled = set(
+            self.provider.polling_windows.filter(
+                start__gte=first_window, start__lte=windows[-1]
+            ).values_list("start", flat=True)
+        )
+
+        # Move the cursor forward every now and then, not only at the end
+        chunk_size = self.backfill_workers * 10
+        with futures.ThreadPoolExecutor(max_workers=self.backfill_workers) as executor:
+            for i in range(0, len(windows), chunk_size):
+                if self._stopped():
+                    break
+                chunk = windows[i : i + chunk_size]
+                pending = [
+                    executor.submit(self._poll_archive_window, api_version, window)
+                    for window in chunk
+                    if window not in already_polled
+                ]
+                error = None
+                for future in futures.as_completed(pending):
+                    try:
+                        future.result()
+                    except Exception as exc:  # pylint: disable=broad-except
+                        logger.exception("Error in polling archives of %s", self)
+                        error = error or exc
+                already_polled.update(
+                    self.provider.polling_windows.filter(
+                        start__gte=chunk[0], start__lte=chunk[-1]
+                    ).values_list("start", flat=True)
+                )
+                self._advance_archives_cursor(windows, already_polled)
+                if error:
+                    # Try again from the first hour missing
+                    raise error
+
+    def _advance_archives_cursor(self, windows, already_polled):
+        last_window = None
+        for window in windows:
+            if window not in already_polled:
+                break
+            last_window = window
+        if not last_window:
+            return
+
+        with transaction.atomic():
+            # Just before the next hour, as if we polled it until the end
+            self.provider.last_event_time_polled = last_window + datetime.timedelta(
+                hours=1, milliseconds=-1
+            )
+            self.provider.save(update_fields=["last_event_time_polled"])
+            self.provider.polling_windows.filter(start__lte=last_window).delete()
+
+        logger.info(
+            f"Polled archives until {str(last_window)}. New state:\n"
+            + f"\tLast event_time: {str(self.provider.last_event_time_polled)}."
+        )
+
+    def _poll_archive_window(self, api_version, window):
+        """Poll all the pages of the given hour of archived status changes."""
+        params = {"event_time": window.isoformat()[: len("YYYY-MM-DDTHH")]}
+        try:
+            params.update(self.provider.api_configuration["status_changes_params"])
+        except KeyError:
+            pass
+        next_url = self._build_url("status_changes", params)
+
+        try:
+            for chunks in self._iter_status_changes(next_url, api_version):
+                with transaction.atomic():
+                    self._process_status_changes_chunks(chunks)
+            if not self._stopped():  # Or we may have missed the last pages
+                self.provider.polling_windows.get_or_create(start=window)
+        finally:
+            # Django opened a connection for this thread, don't leak it
+            db.connection.close()
+
+    def _build_url(self, endpoint, params):
+        url = urllib.parse.urljoin(self.provider.base_api_url, endpoint)
+        if self.provider.api_configuration.get("trailing_slash"):
+            url += "/"
+        if params:
+            url = "%s?%s" % (url, urllib.parse.urlencode(params))
+        return url
+
+    def _iter_pages(self, next_url, api_version):
+        """Fetch the pages in turn, following the "next" links.
+
+        The pages are always given in order, so is the polling cursor saved.
+        """
+        if self.prefetch_pages <= 0:
+            while next_url and not self._stopped():
+                body = self._get_body(next_url, api_version)
+                yield body
+                next_url = body.get("links", {}).get("next")
+            return
+
+        # Download the next pages while the caller is saving the current one
+        pages = queue.Queue(maxsize=self.prefetch_pages)
+        stop = threading.Event()
+        threading.Thread(
+            target=self._prefetch_pages,
+            args=(next_url, api_version, pages, stop),
+            daemon=True,
+        ).start()
+        try:
+            while not self._stopped():
+                body, error = pages.get()
+                if error:
+                    raise error
+                if body is None:
+                    return
+                yield body
+        finally:
+            # The caller may stop before the last page
+            stop.set()
+
+    def _iter_status_changes(self, next_url, api_version):
+        """Like ``_iter_pages`` for MDS 0.4 but only the status changes.
+
+        Each page is given as an iterable of lists of status changes,
+        to consume before asking the next page.
+        """
+        if self.stream_chunk_size <= 0 or not streaming.is_available():
+            for body in self._iter_pages(next_url, api_version):
+                # No translation needed as long as 0.4 is the latest version
+                yield [body["data"]["status_changes"]]
+            return
+
+        while next_url and not self._stopped():
+            with self._get_stream(next_url, api_version) as response:
+                # Undo the compression while parsing
+                response.raw.decode_content = True
+                page = streaming.StreamedPage(response.raw, self.stream_chunk_size)
+                chunks = page.iter_chunks()
+                if archive.is_enabled():
+                    chunks = self._archive_chunks(chunks, next_url, api_version)
+                yield chunks
+                next_url = page.body.get("links", {}).get("next")
+
+    def _stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def _archive_chunks(self, chunks, url, api_version):
+        # The whole page is never in memory, archive each chunk as a page
+        for chunk in chunks:
+            archive.write_page(
+                self.provider,
+                api_version,
+                url,
+                {"version": api_version, "data": {"status_changes": chunk}},
+            )
+            yield chunk
+
+    def _prefetch_pages(self, next_url, api_version, pages, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                except queue.Full:
+                    continue
+                return
+
+        try:
+            while next_url and not stop.is_set():
+                body = self._get_body(next_url, api_version)
+                put((body, None))
+                next_url = body.get("links", {}).get("next")
+            put((None, None))
+        except Exception as error:  # pylint: disable=broad-except
+            # Raised again in the polling thread
+            put((None, error))
+        finally:
+            # In case the token cache opened a connection for this thread
+            db.connection.close()
+
     def _get_body(self, url, api_version):
+        # Malformed JSON is retried too
+        body = retries.call(self.provider, self._get_json, url, api_version)
+        if archive.is_enabled():
+            archive.write_page(self.provider, api_version, url, body)
+        return body
+
+    def _get_stream(self, url, api_version):
+        return retries.call(
+            self.provider, self._get_response, url, api_version, stream=True
+        )
+
+    def _get_json(self, url, api_version):
+        response = self._get_response(url, api_version)
+        with parse_seconds.time(**self.metric_labels):
+            return response.json()
+
+    def _get_response(self, url, api_version, stream=False):
         authentication_type = self.provider.api_authentication.get("type")
         if authentication_type in (None, "", "none"):
-            client = requests
+            client = sessions.get(self.provider)
         elif authentication_type == "oauth2":
             client = self.oauth2_store.get_client()
         else:
@@ -484,7 +774,8 @@ class StatusChangesPoller:
             )
 
         logger.debug("Polling provider on URL %s with headers %s", url, headers)
-        response = client.get(url, timeout=30, headers=headers)
+        with request_seconds.time(**self.metric_labels):
+            response = client.get(url, timeout=30, headers=headers, stream=stream)
         # Token may be expired sooner than expected, retry in one minute
         if response.status_code in (401, 403):
             self.oauth2_store.flush_token()
@@ -512,19 +803,59 @@ class StatusChangesPoller:
                 received,
             )
 
-        body = response.json()
-        return body
+        return response
+
+    def process_archived_page(self, api_version, body):
+        """Ingest again a page from the archive, without moving the polling cursor.
+
+        Returns:
+            the number of status changes in the page
+        """
+        if api_version == enums.MDS_VERSIONS.v0_2.value:
+            data = translate_v0_2_to_v0_4(body["data"])
+        else:
+            # MDS 0.3 is backwards compatible with 0.4
+            data = body["data"]
+        status_changes = data["status_changes"]
+        with transaction.atomic():
+            self._process_status_changes(status_changes)
+        return len(status_changes)
 
     def _process_status_changes(self, status_changes):
+        return self._process_status_changes_chunks([status_changes])
+
+    def _process_status_changes_chunks(self, chunks):
+        """Save the status changes of a page, given in chunks.
+
+        Returns:
+            the maximum event time and recorded time of the page
+            (None for both if the page was empty)
+        """
         logger.debug("Processing...")
 
-        # accept timestamp as a string instead of an integer
-        status_changes = self._validate_event_times(status_changes)
-        if not status_changes:
+        received = valid = False
+        last_event_time_polled = last_recorded_polled = 0
+        elapsed = 0  # Not counting the download of streamed chunks
+        for status_changes in chunks:
+            if not status_changes:
+                continue
+            received = True
+
+            start = time.perf_counter()
+            maximums = self._process_status_changes_chunk(status_changes)
+            elapsed += time.perf_counter() - start
+            if maximums:
+                valid = True
+                last_event_time_polled = max(last_event_time_polled, maximums[0])
+                last_recorded_polled = max(last_recorded_polled, maximums[1])
+
+        if not received:
+            return None, None
+        process_seconds.observe(elapsed, **self.metric_labels)
+
+        if not valid:
             # Data so bad there is no or nothing but invalid event times
-            logger.exception(
-                "No valid event_time found in status_changes series: %s", status_changes
-            )
+            logger.exception("No valid event_time found in status_changes series")
             # How can we prevent from asking them again next time?
             if (
                 self.provider.last_event_time_polled
@@ -539,24 +870,49 @@ class StatusChangesPoller:
             # The provider really doesn't help!
             return timezone.now(), timezone.now()
 
-        last_event_time_polled = utils.from_mds_timestamp(
-            max(status_change["event_time"] for status_change in status_changes)
+        return (
+            utils.from_mds_timestamp(last_event_time_polled),
+            utils.from_mds_timestamp(last_recorded_polled),
         )
-        last_recorded_polled = utils.from_mds_timestamp(
-            max(status_change.get("recorded") or 0 for status_change in status_changes)
+
+    def _process_status_changes_chunk(self, status_changes):
+        """Save a chunk of status changes.
+
+        Returns:
+            the maximum event time and recorded time of the chunk (as timestamps)
+            or None if no event time was valid
+        """
+        labels = self.metric_labels
+        status_changes_received.inc(len(status_changes), **labels)
+
+        # accept timestamp as a string instead of an integer
+        count = len(status_changes)
+        status_changes = self._validate_event_times(status_changes)
+        status_changes_dropped.inc(
+            count - len(status_changes), reason="event_time", **labels
         )
+        if not status_changes:
+            return None
 
+        maximums = (
+            max(status_change["event_time"] for status_change in status_changes),
+            max(status_change.get("recorded") or 0 for status_change in status_changes),
+        )
+
+        count = len(status_changes)
         status_changes = self._validate_status_changes(status_changes)
+        status_changes_dropped.inc(
+            count - len(status_changes), reason="invalid", **labels
+        )
         if not status_changes:
             # None were valid, we won't ask that series again
             # (provided status changes are ordered by event_time ascending)
-            return last_event_time_polled, last_recorded_polled
+            return maximums
 
         self._create_missing_providers(status_changes)
         self._create_missing_devices(status_changes)
         self._create_event_records(status_changes)
-
-        return last_event_time_polled, last_recorded_polled
+        return maximums
 
     def _validate_event_times(self, status_changes):
         """I need this one done before validating the rest of the data."""
@@ -627,72 +983,86 @@ class StatusChangesPoller:
     def _create_missing_providers(self, status_changes):
         """Make sure all providers mentioned exist"""
 
-        with_missing_providers = [
-            status_change
-            for status_change in status_changes
-            if status_change["provider_id"] not in self.provider_uids
-        ]
+        missing_providers = self.provider_cache.missing(
+            status_change["provider_id"] for status_change in status_changes
+        )
+        # The first status change of each missing provider
+        with_missing_providers = {}
+        for status_change in status_changes:
+            if status_change["provider_id"] in missing_providers:
+                with_missing_providers.setdefault(
+                    status_change["provider_id"], status_change
+                )
 
         if with_missing_providers:
-            db_helpers.upsert_providers(
+            providers_added = db_helpers.upsert_providers(
                 (
                     _create_provider(status_change)
-                    for status_change in with_missing_providers
+                    for status_change in with_missing_providers.values()
                 )
             )
 
-            providers_added = [
-                status_change["provider_id"] for status_change in with_missing_providers
-            ]
-            self.provider_uids.update(providers_added)
+            # Don't remember them before they actually exist for other pollers
+            transaction.on_commit(lambda: self.provider_cache.add(missing_providers))
 
-            logger.info(
-                "Providers created: %s", ", ".join(str(uid) for uid in providers_added)
-            )
+            if providers_added:
+                logger.info(
+                    "Providers created: %s",
+                    ", ".join(str(uid) for uid in providers_added),
+                )
 
     def _create_missing_devices(self, status_changes):
         """Make sure all devices mentioned exist"""
 
-        with_missing_devices = [
-            status_change
-            for status_change in status_changes
-            if status_change["device_id"] not in self.device_uids
-        ]
+        missing_devices = self.device_cache.missing(
+            status_change["device_id"] for status_change in status_changes
+        )
+        # The first status change of each missing device
+        with_missing_devices = {}
+        for status_change in status_changes:
+            if status_change["device_id"] in missing_devices:
+                with_missing_devices.setdefault(
+                    status_change["device_id"], status_change
+                )
 
         if with_missing_devices:
-            db_helpers.upsert_devices(
+            # Another poller may have created some of them in the meantime
+            # (inserted in order, concurrent pollers wait for each other
+            # instead of deadlocking)
+            devices_added = db_helpers.upsert_devices(
                 (
-                    _create_device(status_change)
-                    for status_change in with_missing_devices
+                    _create_device(with_missing_devices[device_id])
+                    for device_id in sorted(with_missing_devices)
                 )
             )
-            if getattr(settings, "POLLER_CREATE_REGISTER_EVENTS", False):
+            if devices_added and getattr(
+                settings, "POLLER_CREATE_REGISTER_EVENTS", False
+            ):
                 # Create fake register events to simulate device registration
-                db_helpers.upsert_event_records(
+                db_helpers.copy_event_records(
                     (
-                        _create_register_event_record(status_change)
-                        for status_change in with_missing_devices
+                        _create_register_event_record(with_missing_devices[device_id])
+                        for device_id in devices_added
                     ),
                     source=enums.EVENT_SOURCE.provider_api.name,
                 )
 
-            devices_added = [
-                status_change["device_id"] for status_change in with_missing_devices
-            ]
-            self.device_uids.update(devices_added)
+            transaction.on_commit(lambda: self.device_cache.add(missing_devices))
 
-            logger.info(
-                "Devices created: %s", ", ".join(str(uid) for uid in devices_added)
-            )
+            if devices_added:
+                logger.info(
+                    "Devices created: %s", ", ".join(str(uid) for uid in devices_added)
+                )
 
     def _create_event_records(self, status_changes):
         """Now record the... records"""
-        db_helpers.upsert_event_records(
+        db_helpers.copy_event_records(
             (_create_event_record(status_change) for status_change in status_changes),
             enums.EVENT_SOURCE.provider_api.name,
             # Timestamps are unique per device, ignore duplicates
             # Events already pushed by the provider will always have precedence
-            on_conflict_update=False,
+            on_conflict_update=self.overwrite_polled_events,
+            same_source_only=True,
         )
 
 
@@ -736,7 +1106,8 @@ def _create_event_record(status_change):
         except ValueError:
             longitude, latitude = event_location["geometry"]["coordinates"]
             altitude = None
-        point = geos.Point(longitude, latitude, altitude, srid=4326)
+        # The altitude is only kept in the telemetry (the column is 2D)
+        point = utils.to_ewkt_point(longitude, latitude)
         properties["telemetry"] = {
             "timestamp": event_location["properties"]["timestamp"],
             "gps": {"lng": longitude, "lat": latitude},
@@ -762,15 +1133,16 @@ def _create_event_record(status_change):
         if difference > datetime.timedelta(minutes=10):
             logger.warning("publication_time and recorded differ by %s", difference)
 
-    return models.EventRecord(
-        device_id=status_change["device_id"],
-        timestamp=utils.from_mds_timestamp(status_change["event_time"]),
-        point=point,
-        event_type=status_change["agency_event_type"],
-        event_type_reason=status_change["agency_event_type_reason"],
-        properties=properties,
-        publication_time=publication_time or recorded,
-    )
+    # A row for db_helpers.copy_event_records, not an EventRecord instance
+    return {
+        "device_id": status_change["device_id"],
+        "timestamp": utils.from_mds_timestamp(status_change["event_time"]),
+        "point": point,
+        "event_type": status_change["agency_event_type"],
+        "event_type_reason": status_change["agency_event_type_reason"],
+        "properties": properties,
+        "publication_time": publication_time or recorded,
+    }
 
 
 def _create_register_event_record(status_change):
@@ -783,12 +1155,12 @@ def _create_register_event_record(status_change):
     Should the device be unregistered and registered again according to the specs,
     don't delete the fake events in the past.
     """
-    return models.EventRecord(
-        device_id=status_change["device_id"],
+    return {
+        "device_id": status_change["device_id"],
         # Another event for the same device with the same timestamp will be rejected
-        timestamp=utils.from_mds_timestamp(status_change["event_time"])
+        "timestamp": utils.from_mds_timestamp(status_change["event_time"])
         - datetime.timedelta(milliseconds=1),
-        event_type=enums.EVENT_TYPE.register.name,
-        properties={"created_on_register": True},
-        source=enums.EVENT_SOURCE.provider_api.name,
-    )
+        "point": None,
+        "event_type": enums.EVENT_TYPE.register.name,
+        "properties": {"created_on_register": True},
+    }
@@ -0,0 +1,266 @@
+"""
+Retrying the requests to the providers, without hammering them
+
+The policy of each provider can be tuned in its ``api_configuration``::
+
+    "retry_policy": {
+        "max_attempts": 3,  # Including the first one
+        "backoff": 1,  # Seconds, doubled after each attempt (with jitter)
+        "max_backoff": 60,  # Seconds, giving up if Retry-After asks more
+        "max_requests_per_second": null,  # No limit by default
+        "failure_threshold": 5,  # Failed requests in a row to open the circuit
+        "open_circuit_seconds": 300,  # Not asking the provider in the meantime
+    }
+
+The rate limits and circuit breakers are kept for the life of the process.
+"""
+from collections import namedtuple
+import email.utils
+import logging
+import random
+import threading
+import time
+
+from django.utils import timezone
+
+import requests
+
+from mds import metrics
+from .settings import POLLER_RETRY_POLICY
+
+
+logger = logging.getLogger(__name__)
+
+decisions = metrics.counter(
+    "mds_poller_request_decisions",
+    "Decisions taken when requesting a provider: "
+    "success, retry, give_up, rate_limited, circuit_opened, circuit_open.",
+)
+rate_limited_seconds = metrics.counter(
+    "mds_poller_rate_limited_seconds",
+    "Time spent waiting not to exceed the request rate of a provider.",
+)
+
+RetryPolicy = namedtuple(
+    "RetryPolicy",
+    (
+        "max_attempts",
+        "backoff",
+        "max_backoff",
+        "max_requests_per_second",
+        "failure_threshold",
+        "open_circuit_seconds",
+    ),
+)
+
+DEFAULT_POLICY = RetryPolicy(
+    max_attempts=3,
+    backoff=1,
+    max_backoff=60,
+    max_requests_per_second=None,
+    failure_threshold=5,
+    open_circuit_seconds=300,
+)._replace(**POLLER_RETRY_POLICY)
+
+# Client errors worth trying again (the token is flushed on 401 and 403)
+RETRYABLE_STATUS_CODES = (401, 403, 408, 429)
+
+# Can be mocked in tests
+sleep = time.sleep
+
+
+class CircuitOpen(Exception):
+    """The provider failed too many times in a row, we don't ask it for a while."""
+
+
+class TokenBucket:
+    """Spread the requests not to exceed the given rate."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token.
+
+        Returns:
+            the seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Going into debt, the next callers will wait longer
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+
+class CircuitBreaker:
+    """Stop asking a provider failing too many times in a row.
+
+    Once the circuit was open long enough, a single request is let through,
+    closing the circuit again on success.
+    """
+
+    def __init__(self, failure_threshold, open_seconds):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._failures = 0
+        self._open_until = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self._open_until is None:
+                return
+            if time.monotonic() < self._open_until:
+                raise CircuitOpen
+            # Let this request through, the others are still blocked
+            self._open_until = time.monotonic() + self.open_seconds
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = None
+
+    def failure(self):
+        """Count the failure.
+
+        Returns:
+            True if the circuit was opened
+        """
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.failure_threshold:
+                return False
+            self._open_until = time.monotonic() + self.open_seconds
+            return True
+
+
+_states = {}  # provider ID -> (policy, token bucket, circuit breaker)
+_lock = threading.Lock()
+
+
+def get_policy(provider):
+    return DEFAULT_POLICY._replace(**provider.api_configuration.get("retry_policy", {}))
+
+
+def call(provider, func, *args, **kwargs):
+    """Call the function requesting the provider, following its retry policy.
+
+    Raises:
+        CircuitOpen, or the last error of the function
+    """
+    policy, bucket, breaker = _get_state(provider)
+    # Names are not unique
+    labels = {"provider_id": str(provider.pk), "provider": provider.name}
+
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            breaker.check()
+        except CircuitOpen:
+            decisions.inc(decision="circuit_open", **labels)
+            raise CircuitOpen(f"Not polling {provider} after too many failures")
+
+        if bucket:
+            delay = bucket.acquire()
+            if delay:
+                decisions.inc(decision="rate_limited", **labels)
+                rate_limited_seconds.inc(delay, **labels)
+                sleep(delay)
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            if not _is_retryable(exc):
+                # The provider is not failing, we are
+                decisions.inc(decision="give_up", **labels)
+                raise
+            if breaker.failure():
+                decisions.inc(decision="circuit_opened", **labels)
+                raise
+            delay = _get_retry_delay(exc, attempt, policy)
+            if attempt >= policy.max_attempts or delay is None:
+                decisions.inc(decision="give_up", **labels)
+                raise
+            decisions.inc(decision="retry", **labels)
+            logger.warning(
+                "Error requesting %s (%s), retrying in %.1fs", provider, exc, delay
+            )
+            sleep(delay)
+        else:
+            breaker.success()
+            decisions.inc(decision="success", **labels)
+            return result
+
+
+def _get_state(provider):
+    policy = get_policy(provider)
+    key = str(provider.pk)
+    with _lock:
+        state = _states.get(key)
+        # The configuration of the provider changed
+        if state is None or state[0] != policy:
+            bucket = None
+            if policy.max_requests_per_second:
+                bucket = TokenBucket(policy.max_requests_per_second)
+            breaker = CircuitBreaker(
+                policy.failure_threshold, policy.open_circuit_seconds
+            )
+            state = _states[key] = (policy, bucket, breaker)
+    return state
+
+
+def _is_retryable(exc):
+    """Is the error worth trying again (and counted as a failure of the provider)?"""
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        status_code = exc.response.status_code
+        return status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+    # Otherwise a bug or a malformed response
+    return isinstance(exc, (requests.RequestException, ValueError))
+
+
+def _get_retry_delay(exc, attempt, policy):
+    """How long to wait before trying again (a retryable error), or None not to."""
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        retry_after = _parse_retry_after(exc.response.headers.get("Retry-After"))
+        if retry_after is not None:
+            # Not waiting that long here, the next polling round will
+            return retry_after if retry_after <= policy.max_backoff else None
+
+    # Exponential back-off with "full jitter" not to retry all at once
+    return random.uniform(
+        0, min(policy.max_backoff, policy.backoff * 2 ** (attempt - 1))
+    )
+
+
+def _parse_retry_after(value):
+    """Seconds from the Retry-After header, either seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if timezone.is_naive(retry_at):
+        retry_at = timezone.make_aware(retry_at, timezone.utc)
+    return max((retry_at - timezone.now()).total_seconds(), 0)
+
+
+def clear():
+    """Forget the rate limits and circuit breakers, e.g. between tests."""
+    with _lock:
+        _states.clear()
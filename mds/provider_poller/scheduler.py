@@ -0,0 +1,176 @@
+"""
+Polling the providers continuously, each one at its own pace
+
+Used by ``poll_providers --daemon`` instead of relaunching the command,
+so the caches and connections stay warm.
+"""
+from concurrent import futures
+import datetime
+import heapq
+import logging
+import threading
+import time
+
+from django import db
+from django.utils import timezone
+from django.utils.dateparse import parse_duration
+
+from mds import models
+from .settings import (
+    POLLER_INTERVAL,
+    POLLER_MAX_BACKOFF,
+    POLLER_REFRESH_INTERVAL,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_interval(provider):
+    """How long to wait between two polls of the given provider."""
+    polling_interval = provider.api_configuration.get("polling_interval")
+    if polling_interval:
+        return parse_duration(polling_interval)
+    return datetime.timedelta(seconds=POLLER_INTERVAL)
+
+
+def get_next_poll_time(provider, now, failures=0):
+    """When to poll again the given provider.
+
+    Args:
+        provider: Provider, as it was after polling
+        now: datetime, when the poll ended
+        failures: int, number of polls that failed in a row
+
+    Returns:
+        datetime
+    """
+    interval = get_interval(provider)
+    if failures:
+        # Back off from a provider that is down
+        return now + min(
+            interval * 2 ** failures, datetime.timedelta(seconds=POLLER_MAX_BACKOFF)
+        )
+
+    next_poll_time = now + interval
+    # No need to wake up before the provider collected data from its devices
+    polling_lag = provider.api_configuration.get("provider_polling_lag")
+    if polling_lag and provider.last_event_time_polled:
+        next_poll_time = max(
+            next_poll_time,
+            provider.last_event_time_polled + parse_duration(polling_lag),
+        )
+    return next_poll_time
+
+
+class Scheduler:
+    """Poll the providers when they are due, until stopped.
+
+    Args:
+        poll: callable taking the provider to poll and the stop event,
+            raising when polling failed
+        workers: int, number of providers polled concurrently
+    """
+
+    def __init__(self, poll, workers=1):
+        self.poll = poll
+        self.workers = max(workers, 1)
+        self.stop_event = threading.Event()
+        self._queue = []  # heap of (next poll timestamp, provider ID)
+        self._scheduled = set()  # provider IDs in the queue or being polled
+        self._failures = {}  # provider ID -> number of polls failed in a row
+
+    def stop(self):
+        """Stop polling, the providers being polled save their current page first."""
+        logger.info("Stopping the poller...")
+        self.stop_event.set()
+
+    def run(self):
+        running = {}  # future -> provider ID
+        next_refresh = 0
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stop_event.is_set():
+                now = time.time()
+                if now >= next_refresh:
+                    self._add_new_providers(now)
+                    next_refresh = now + POLLER_REFRESH_INTERVAL
+
+                while (
+                    self._queue
+                    and self._queue[0][0] <= now
+                    and len(running) < self.workers
+                ):
+                    _, provider_id = heapq.heappop(self._queue)
+                    future = executor.submit(self._poll_in_thread, provider_id)
+                    running[future] = provider_id
+
+                # Sleep until the next provider is due, but check we were not stopped
+                wake_up = next_refresh
+                if self._queue and len(running) < self.workers:
+                    wake_up = min(wake_up, self._queue[0][0])
+                timeout = min(max(wake_up - now, 0), 1)
+                if running:
+                    done, _ = futures.wait(
+                        running, timeout=timeout, return_when=futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        self._reschedule(running.pop(future), future)
+                else:
+                    self.stop_event.wait(timeout)
+
+            # Shutting down the executor waits for the providers being polled
+        logger.info("Poller stopped.")
+
+    def _add_new_providers(self, now):
+        providers = models.Provider.objects.exclude(base_api_url="").exclude(
+            base_api_url__isnull=True
+        )
+        for provider_id in providers.values_list("pk", flat=True):
+            if provider_id not in self._scheduled:
+                # Poll them right away, the poller knows where to resume
+                self._scheduled.add(provider_id)
+                heapq.heappush(self._queue, (now, provider_id))
+
+    def _poll_in_thread(self, provider_id):
+        # This thread keeps its connection between polls, unless broken or too old
+        db.close_old_connections()
+        try:
+            # Always the latest configuration
+            provider = models.Provider.objects.get(pk=provider_id)
+        except models.Provider.DoesNotExist:
+            return None
+        try:
+            self.poll(provider, self.stop_event)
+        finally:
+            db.close_old_connections()
+        return provider
+
+    def _reschedule(self, provider_id, future):
+        try:
+            provider = future.result()
+        except Exception:  # pylint: disable=broad-except
+            failures = self._failures[provider_id] = (
+                self._failures.get(provider_id, 0) + 1
+            )
+            logger.exception(
+                "Error in polling provider %s (%s failures in a row)",
+                provider_id,
+                failures,
+            )
+            try:
+                provider = models.Provider.objects.get(pk=provider_id)
+            except models.Provider.DoesNotExist:
+                provider = None
+        else:
+            self._failures.pop(provider_id, None)
+            failures = 0
+
+        if provider is None:
+            # Deleted in the meantime
+            self._scheduled.discard(provider_id)
+            self._failures.pop(provider_id, None)
+            return
+
+        next_poll_time = get_next_poll_time(provider, timezone.now(), failures)
+        logger.debug("Next poll of %s at %s", provider.name, next_poll_time)
+        heapq.heappush(self._queue, (next_poll_time.timestamp(), provider_id))
@@ -0,0 +1,102 @@
+"""
+Pooled HTTP sessions to poll the providers
+
+One session for each provider (and each thread with OAuth2),
+kept for the life of the process,
+so the connections (and their TLS handshakes) are reused
+from one page to the next and from one polling round to the next.
+"""
+import threading
+
+import requests
+from requests_oauthlib import OAuth2Session
+
+from .settings import POLLER_KEEP_ALIVE, POLLER_POOL_SIZE
+
+try:
+    import brotli  # noqa: F401 (urllib3 decodes it when installed)
+except ImportError:
+    ACCEPT_ENCODING = "gzip"
+else:
+    ACCEPT_ENCODING = "gzip, br"
+
+
+_adapters = {}  # provider ID -> connection pool
+_sessions = {}  # provider ID -> session
+# The OAuth2 token is set on the session, don't share it between threads:
+# (provider ID, OAuth2 client ID) -> session, in the "sessions" of each thread,
+# dropped with the thread (the connections are in the pool of the provider)
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def get(provider, client_id=None):
+    """The session to poll the given provider.
+
+    All the sessions of a provider share the same connections.
+
+    Args:
+        provider: Provider, the provider to poll
+        client_id: str, the OAuth2 client ID if the provider requires it
+
+    Returns:
+        requests.Session, or OAuth2Session when given a client ID
+        (the caller is responsible for setting the token)
+    """
+    provider_id = str(provider.pk)
+    with _lock:
+        if client_id:
+            sessions = getattr(_local, "sessions", None)
+            if sessions is None:
+                sessions = _local.sessions = {}
+            key = (provider_id, client_id)
+        else:
+            sessions = _sessions
+            key = provider_id
+        session = sessions.get(key)
+        if session is None:
+            adapter = _adapters.get(provider_id)
+            if adapter is None:
+                adapter = _adapters[provider_id] = _create_adapter()
+            session = sessions[key] = _create_session(client_id, adapter)
+    return session
+
+
+def _create_adapter():
+    # The same provider may be polled by several threads (prefetching, backfilling)
+    return requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=POLLER_POOL_SIZE
+    )
+
+
+def _create_session(client_id, adapter):
+    if client_id:
+        session = OAuth2Session(client_id)
+    else:
+        session = requests.Session()
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    # Pages of status changes compress very well
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    if not POLLER_KEEP_ALIVE:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def clear():
+    """Close all the sessions, e.g. between tests."""
+    global _local
+
+    with _lock:
+        sessions = list(_sessions.values())
+        adapters = list(_adapters.values())
+        _sessions.clear()
+        _adapters.clear()
+        # Forget the OAuth2 sessions of all the threads
+        _local = threading.local()
+    for session in sessions:
+        session.close()
+    for adapter in adapters:
+        adapter.close()
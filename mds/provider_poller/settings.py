@@ -9,3 +9,37 @@ POLLER_TOKEN_ENCRYPTION_KEY = getattr(
     "POLLER_TOKEN_ENCRYPTION_KEY",
     fernet.Fernet.generate_key(),  # The default is reset on each restart
 )
+
+# How many device or provider IDs the poller remembers to exist, and for how long
+POLLER_EXISTENCE_CACHE_SIZE = getattr(settings, "POLLER_EXISTENCE_CACHE_SIZE", 100_000)
+POLLER_EXISTENCE_CACHE_TTL = getattr(settings, "POLLER_EXISTENCE_CACHE_TTL", 3600)
+
+# How many pages the poller downloads ahead while saving the current one
+POLLER_PREFETCH_PAGES = getattr(settings, "POLLER_PREFETCH_PAGES", 0)
+
+# How many hours of MDS 0.4 archives the poller downloads at once when catching up
+POLLER_BACKFILL_WORKERS = getattr(settings, "POLLER_BACKFILL_WORKERS", 1)
+
+# How many connections the poller keeps open to each provider, and if it keeps them
+POLLER_POOL_SIZE = getattr(settings, "POLLER_POOL_SIZE", 10)
+POLLER_KEEP_ALIVE = getattr(settings, "POLLER_KEEP_ALIVE", True)
+
+# How many MDS 0.4 status changes the poller parses and saves at once while
+# the page is downloaded (0 to parse whole pages), requires ijson
+POLLER_STREAM_CHUNK_SIZE = getattr(settings, "POLLER_STREAM_CHUNK_SIZE", 0)
+
+# Where the poller appends the pages polled to ingest them again (None to disable)
+POLLER_ARCHIVE_DIR = getattr(settings, "POLLER_ARCHIVE_DIR", None)
+
+# When running as a daemon, the default seconds between two polls of a provider
+# (see the "polling_interval" configuration), the maximum back-off after errors
+# and how often to look for new providers
+POLLER_INTERVAL = getattr(settings, "POLLER_INTERVAL", 60)
+POLLER_MAX_BACKOFF = getattr(settings, "POLLER_MAX_BACKOFF", 3600)
+POLLER_REFRESH_INTERVAL = getattr(settings, "POLLER_REFRESH_INTERVAL", 300)
+
+# Lock each provider polled, so several nodes can poll without polling twice
+POLLER_LOCKING = getattr(settings, "POLLER_LOCKING", True)
+
+# Default retry policy of the providers, see retries.py
+POLLER_RETRY_POLICY = getattr(settings, "POLLER_RETRY_POLICY", {})
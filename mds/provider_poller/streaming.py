@@ -0,0 +1,68 @@
+"""
+Parsing the pages of status changes as they are downloaded
+
+Pages of MDS 0.4 status changes weigh several megabytes, instead of loading
+the whole page in memory, the status changes are read in chunks.
+
+Requires the optional ijson package, pages are parsed whole without it.
+"""
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+STATUS_CHANGES_PREFIX = "data.status_changes.item"
+
+
+def is_available():
+    return ijson is not None
+
+
+class StreamedPage:
+    """A page of status changes, parsed from the given file-like object.
+
+    The status changes are only read once, by ``iter_chunks``,
+    the rest of the body (e.g. the links) is complete once they are all read.
+    """
+
+    def __init__(self, stream, chunk_size):
+        # Floats, not decimals, the same as json.loads
+        self._events = ijson.parse(stream, use_float=True)
+        self._chunk_size = chunk_size
+        self._builder = ijson.ObjectBuilder()
+
+    @property
+    def body(self):
+        """The body without the status changes."""
+        # Reading the rest of the page first
+        for _ in self.iter_chunks():
+            pass
+        return getattr(self._builder, "value", {})
+
+    def iter_chunks(self):
+        """Iterate on lists of at most ``chunk_size`` status changes."""
+        chunk = []
+        item = None
+        for prefix, event, value in self._events:
+            if prefix == STATUS_CHANGES_PREFIX or prefix.startswith(
+                STATUS_CHANGES_PREFIX + "."
+            ):
+                if item is None:
+                    item = ijson.ObjectBuilder()
+                item.event(event, value)
+                # The end of the status change (or a scalar instead of an object)
+                if prefix == STATUS_CHANGES_PREFIX and event not in (
+                    "start_map",
+                    "map_key",
+                    "start_array",
+                ):
+                    chunk.append(item.value)
+                    item = None
+                    if len(chunk) >= self._chunk_size:
+                        yield chunk
+                        chunk = []
+            else:
+                self._builder.event(event, value)
+        if chunk:
+            yield chunk
@@ -36,6 +36,11 @@ def from_mds_timestamp(value: int) -> datetime:
     return datetime.datetime.fromtimestamp(value / 1000, tz=datetime.timezone.utc)
 
 
+def to_ewkt_point(longitude: float, latitude: float) -> str:
+    """Format WGS 84 coordinates as EWKT, without building a GEOS object."""
+    return "SRID=4326;POINT(%r %r)" % (float(longitude), float(latitude))
+
+
 def get_random_point(polygon):
     """Return a random point in the given polygon."""
     (x_min, y_min), (x_max, _), (_, y_max) = polygon.envelope[0][:3]
@@ -186,7 +186,7 @@ def test_device_register(client):
 
 
 @pytest.mark.django_db
-def test_device_event(client):
+def test_device_event(client, django_assert_num_queries):
     # assert that the following test post on an url without trailing slash
     # as specified by specs
     assert reverse("agency-0.3:device-event", args=[1])[-1:] != "/"
@@ -228,15 +228,34 @@ def test_device_event(client):
     assert response.status_code == 401
 
     # test nominal
-    response = client.post(
-        reverse("agency-0.3:device-event", args=[device_id]),
-        data=data,
-        content_type="application/json",
-        **auth_header(SCOPE_AGENCY_API, provider_id=provider.id),
-    )
+    n = BASE_NUM_QUERIES
+    n += 1  # select device
+    n += 1  # check provider configuration (then cached)
+    n += 1  # insert record and update device
+    with django_assert_num_queries(n):
+        response = client.post(
+            reverse("agency-0.3:device-event", args=[device_id]),
+            data=data,
+            content_type="application/json",
+            **auth_header(SCOPE_AGENCY_API, provider_id=provider.id),
+        )
     assert response.status_code == 201
     assert response.data == {"device_id": str(device_id), "status": "unavailable"}
     assert device.event_records.all().count() == 1
+    device.refresh_from_db()
+    assert device.dn_status == "unavailable"
+
+    data["event_type"] = "service_start"
+    data["timestamp"] += 1000
+    with django_assert_num_queries(n - 1):
+        response = client.post(
+            reverse("agency-0.3:device-event", args=[device_id]),
+            data=data,
+            content_type="application/json",
+            **auth_header(SCOPE_AGENCY_API, provider_id=provider.id),
+        )
+    assert response.status_code == 201
+    assert response.data == {"device_id": str(device_id), "status": "available"}
 
 
 @pytest.mark.django_db
@@ -380,8 +399,8 @@ def test_device_telemetry(client, django_assert_num_queries):
 
     n = BASE_NUM_QUERIES
     n += 1  # select devices
-    n += 1  # insert records
-    n += 1  # check provider configuration
+    n += 2  # insert records (staging table and merge, COPY not counted)
+    # (provider configuration cached by the previous request)
     with django_assert_num_queries(n):
         response = client.post(
             reverse("agency-0.3:device-telemetry"),
@@ -448,7 +467,7 @@ def test_device_telemetry_when_disabled(client, django_assert_num_queries):
     }
 
     n = BASE_NUM_QUERIES
-    n += 1  # select devices
+    n += 1  # check provider configuration
     with django_assert_num_queries(n):
         response = client.post(
             reverse("agency-0.3:device-telemetry"),
@@ -671,3 +690,33 @@ def test_create_device_with_poller_id(client):
     )
     assert response.status_code == 201
     assert device.event_records.all().count() == 1
+
+
+@pytest.mark.django_db
+@override_settings(AGENCY_API_CURSOR_PAGINATION=True)
+def test_device_list_cursor_pagination(client, django_assert_num_queries):
+    provider = factories.Provider()
+    devices = factories.Device.create_batch(3, provider=provider)
+    factories.Device()  # Another provider
+
+    n = BASE_NUM_QUERIES
+    n += 1  # query on devices (no count)
+    with django_assert_num_queries(n):
+        response = client.get(
+            reverse("agency-0.3:device-list"),
+            {"limit": 2},
+            **auth_header(SCOPE_AGENCY_API, provider_id=provider.id),
+        )
+    assert response.status_code == 200
+    assert "count" not in response.data
+    assert response.data["previous"] is None
+    device_ids = [device["device_id"] for device in response.data["results"]]
+    assert len(device_ids) == 2
+
+    response = client.get(
+        response.data["next"], **auth_header(SCOPE_AGENCY_API, provider_id=provider.id)
+    )
+    assert response.status_code == 200
+    assert response.data["next"] is None
+    device_ids += [device["device_id"] for device in response.data["results"]]
+    assert device_ids == sorted(str(device.id) for device in devices)
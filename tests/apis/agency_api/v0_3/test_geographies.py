@@ -1,3 +1,6 @@
+import datetime
+import uuid
+
 from django.urls import reverse
 
 import pytest
@@ -19,3 +22,56 @@ def test_geography_detail(client):
     # The whole structure is tested in test_models
     assert response.json()["type"] == "FeatureCollection"
     assert len(response.json()["features"]) == 1
+
+
+@pytest.mark.django_db
+def test_geography_detail_conditional(client, django_assert_num_queries):
+    policy = factories.Policy(published=True)
+    url = reverse("agency-0.3:geography-detail", args=[policy.id])
+    response = client.get(url)
+    etag = response["ETag"]
+    assert response["Last-Modified"]
+
+    n = 2  # Savepoint and release
+    n += 1  # query on policy versions
+    with django_assert_num_queries(n):
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+    assert not response.content
+
+    response = client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+    assert response.status_code == 304
+
+    # Published again
+    policy.published_date += datetime.timedelta(seconds=1)
+    policy.save()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+
+    response = client.get(
+        reverse("agency-0.3:geography-detail", args=[uuid.uuid4()]),
+        HTTP_IF_NONE_MATCH=etag,
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_geography_detail_cache(client, django_assert_num_queries, settings):
+    settings.AGENCY_API_POLICIES_CACHE = "default"
+    policy = factories.Policy(published=True)
+    url = reverse("agency-0.3:geography-detail", args=[policy.id])
+    response = client.get(url)
+    assert response.status_code == 200
+
+    n = 2  # Savepoint and release
+    n += 1  # query on policy versions
+    with django_assert_num_queries(n):
+        cached_response = client.get(url)
+    assert cached_response.status_code == 200
+    assert cached_response.content == response.content
+    assert cached_response["Content-Type"] == response["Content-Type"]
+    assert cached_response["ETag"] == response["ETag"]
+    assert cached_response["Vary"] == response["Vary"]
+    assert cached_response["Allow"] == response["Allow"]
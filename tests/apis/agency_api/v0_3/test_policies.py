@@ -32,6 +32,7 @@ def test_policy_list_basic(client, django_assert_num_queries):
 
     # Test without auth
     n = BASE_NUM_QUERIES
+    n += 1  # query on policy versions (ETag)
     n += 1  # query on policies
     n += 1  # query on related providers
     n += 1  # query on related previous policies
@@ -64,6 +65,19 @@ def test_policy_list_basic(client, django_assert_num_queries):
     assert [p["policy_id"] for p in response.data] == [str(general_policy.id)]
 
 
+@pytest.mark.django_db
+def test_policy_list_conditional(client):
+    factories.Policy(published=True)
+    url = reverse("agency-0.3:policy-list")
+    response = client.get(url)
+    etag = response["ETag"]
+    # A policy leaving the list doesn't change the latest publication date
+    assert "Last-Modified" not in response
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+
+
 @pytest.mark.django_db
 def test_policy_list_range(client):
     # Policy from last year
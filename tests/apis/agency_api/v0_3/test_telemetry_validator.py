@@ -0,0 +1,76 @@
+import copy
+import types
+
+import pytest
+
+from rest_framework.exceptions import ValidationError
+
+from mds.apis.agency_api.v0_3 import telemetry_validator
+from mds.apis.agency_api.v0_3.vehicles import DeviceTelemetryInputSerializer
+
+
+FRAME = {
+    "device_id": "bbbb0000-61fd-4cce-8113-81af1de90941",
+    "timestamp": 1_325_376_000_000,
+    "gps": {
+        "lat": 34.07068,
+        "lng": -118.279_678,
+        "altitude": 30.0,
+        "heading": 245.2,
+        "speed": 32.3,
+        "hdop": 2.0,
+        "satellites": 6,
+    },
+    "charge": 0.54,
+}
+
+
+def frame(**kwargs):
+    data = copy.deepcopy(FRAME)
+    data.update(kwargs)
+    return data
+
+
+def gps(**kwargs):
+    data = copy.deepcopy(FRAME)
+    data["gps"].update(kwargs)
+    return data
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"data": [FRAME, frame(charge="0.5"), gps(satellites="2.0")]},
+        {"data": [frame(charge=None), gps(hdop=None)]},
+        {},
+        {"data": None},
+        {"data": {}},
+        {"data": [FRAME, None, 42]},
+        {"data": [frame(device_id="invalid"), frame(charge=2), frame(charge="a")]},
+        {"data": [frame(gps=None), frame(gps=[]), gps(lat=None, lng="a")]},
+        {"data": [gps(heading=-1), gps(hdop=0.5), gps(satellites=1.5)]},
+        {"data": [gps(lat=-118.279_678, lng=34.07068)]},
+        {"data": [gps(lat=0.0, lng=200.0)]},
+    ],
+)
+@pytest.mark.parametrize("swap_lat_lng", [False, True])
+def test_same_as_serializer(payload, swap_lat_lng):
+    context = {"provider_config": types.SimpleNamespace(swap_lat_lng=swap_lat_lng)}
+    serializer = DeviceTelemetryInputSerializer(
+        data=copy.deepcopy(payload), context=context
+    )
+
+    if serializer.is_valid():
+        validated_data = telemetry_validator.validate_telemetry(
+            copy.deepcopy(payload), swap_lat_lng=swap_lat_lng
+        )
+        assert validated_data == serializer.validated_data
+    else:
+        with pytest.raises(ValidationError) as exc_info:
+            telemetry_validator.validate_telemetry(
+                copy.deepcopy(payload), swap_lat_lng=swap_lat_lng
+            )
+        assert exc_info.value.detail == serializer.errors
+        assert (
+            exc_info.value.get_codes() == ValidationError(serializer.errors).get_codes()
+        )
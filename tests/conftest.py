@@ -1,6 +1,7 @@
 import os
 
 import django
+import pytest
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.project.settings")
 os.environ["MDS_AUTH_SECRET_KEY"] = "secret_for_tests"
@@ -8,3 +9,23 @@ os.environ["MDS_AUTH_SECRET_KEY"] = "secret_for_tests"
 
 def pytest_configure():
     django.setup()
+
+
+@pytest.fixture(autouse=True)
+def clear_provider_config():
+    # The same provider IDs are used with different configurations
+    from mds import provider_config
+
+    provider_config.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_poller_state():
+    # Don't reuse the sessions (and their mocked connections) of other tests,
+    # nor their rate limits and circuit breakers
+    from mds.provider_poller import retries
+    from mds.provider_poller import sessions
+
+    yield
+    sessions.clear()
+    retries.clear()
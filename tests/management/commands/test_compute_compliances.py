@@ -0,0 +1,24 @@
+import datetime
+import io
+
+import pytest
+
+from django.core.management import call_command
+
+from mds import models
+
+
+@pytest.mark.django_db
+def test_compute_compliances():
+    stdout = io.StringIO()
+
+    call_command("compute_compliances", "--lag=0", "--lag=60", stdout=stdout)
+
+    assert stdout.getvalue() == (
+        "0 compliances opened and 0 closed (lag 0:00:00).\n"
+        "0 compliances opened and 0 closed (lag 1:00:00).\n"
+    )
+    assert set(models.ComplianceWatermark.objects.values_list("lag", flat=True)) == {
+        datetime.timedelta(0),
+        datetime.timedelta(hours=1),
+    }
@@ -1,9 +1,11 @@
 import datetime
 import io
+import threading
 import urllib.parse
 
 import pytest
 
+from django import db
 from django.core.management import call_command
 from django.utils import timezone
 
@@ -15,10 +17,13 @@ from mds.provider_mapping import (
     PROVIDER_REASON_TO_AGENCY_EVENT,
     PROVIDER_EVENT_TYPE_REASON_TO_EVENT_TYPE,
 )
+from mds.provider_poller import locking
+from mds.provider_poller import poller
 
 
 @pytest.mark.django_db
-def test_poll_provider_batch(client, settings, requests_mock):
+@pytest.mark.parametrize("prefetch_pages", [0, 1])
+def test_poll_provider_batch(client, settings, requests_mock, prefetch_pages):
     """A single provider with two pages of status changes."""
     settings.POLLER_CREATE_REGISTER_EVENTS = True
     provider = factories.Provider(base_api_url="http://provider")
@@ -57,9 +62,18 @@ def test_poll_provider_batch(client, settings, requests_mock):
             event_type_reason="maintenance_pick_up",
         ),
     )
-    call_command("poll_providers", "--raise-on-error", stdout=stdout, stderr=stderr)
+    call_command(
+        "poll_providers",
+        "--raise-on-error",
+        f"--prefetch-pages={prefetch_pages}",
+        stdout=stdout,
+        stderr=stderr,
+    )
 
     assert_command_success(stdout, stderr)
+    # Both pages were asked compressed
+    for request in requests_mock.request_history:
+        assert "gzip" in request.headers["Accept-Encoding"]
 
     event1 = device1.event_records.get()
     assert_event_equal(event1, expected_event1)
@@ -93,13 +107,15 @@ def test_several_providers(client, django_assert_num_queries, settings, requests
     stdout, stderr = io.StringIO(), io.StringIO()
 
     n = 1  # List of providers
-    n += 2  # List of provider IDs (for each provider)
-    n += 2  # List of device IDs (for each provider)
     n += (
-        2  # Savepoint/release for each provider
+        2  # Lock and unlock the provider
+        + 1  # Refresh the polling cursors
+        + 2  # Savepoint/release for each provider
+        + 1  # Look up the provider IDs of the page
+        + 1  # Look up the device IDs of the page
         + 1  # Insert missing devices
-        + 1  # Insert fake register event
-        + 1  # Insert missing event records
+        + 2  # Insert fake register event (staging table and merge, COPY not counted)
+        + 2  # Insert missing event records (same)
         + 1  # Update last start time polled
     ) * 2  # For each provider
     with django_assert_num_queries(n):
@@ -133,6 +149,69 @@ def test_several_providers(client, django_assert_num_queries, settings, requests
     assert_event_equal(event2_regular, expected_event2)
 
 
+# Threads use their own connection, they can't see data in the test transaction
+@pytest.mark.django_db(transaction=True)
+def test_several_providers_concurrently(client, requests_mock):
+    """Same as above but polling both providers at the same time."""
+    provider1 = factories.Provider(base_api_url="http://provider1")
+    device1 = factories.Device.build(provider=provider1)
+    expected_event1 = factories.EventRecord.build(
+        event_type=enums.EVENT_TYPE.provider_drop_off.name
+    )
+    provider2 = factories.Provider(base_api_url="http://provider2")
+    device2 = factories.Device.build(provider=provider2)
+    expected_event2 = factories.EventRecord.build(
+        event_type=enums.EVENT_TYPE.trip_start.name
+    )
+    stdout, stderr = io.StringIO(), io.StringIO()
+
+    requests_mock.get(
+        urllib.parse.urljoin(provider1.base_api_url, "/status_changes"),
+        json=make_response(
+            provider1, device1, expected_event1, event_type_reason="rebalance_drop_off"
+        ),
+    )
+    requests_mock.get(
+        urllib.parse.urljoin(provider2.base_api_url, "/status_changes"),
+        json=make_response(
+            provider2, device2, expected_event2, event_type_reason="maintenance"
+        ),
+    )
+    call_command(
+        "poll_providers",
+        "--raise-on-error",
+        "--workers=2",
+        stdout=stdout,
+        stderr=stderr,
+    )
+
+    assert_command_success(stdout, stderr)
+
+    assert_event_equal(device1.event_records.get(), expected_event1)
+    assert_event_equal(device2.event_records.get(), expected_event2)
+    for provider in models.Provider.objects.filter(pk__in=[provider1.pk, provider2.pk]):
+        assert provider.last_event_time_polled is not None
+
+
+@pytest.mark.django_db
+def test_several_providers_share_caches(monkeypatch):
+    """The pollers of a run share the same existence caches."""
+    factories.Provider(base_api_url="http://provider1")
+    factories.Provider(base_api_url="http://provider2")
+    pollers = []
+    monkeypatch.setattr(
+        poller.StatusChangesPoller, "poll", lambda self: pollers.append(self)
+    )
+    stdout, stderr = io.StringIO(), io.StringIO()
+
+    call_command("poll_providers", "--raise-on-error", stdout=stdout, stderr=stderr)
+
+    assert_command_success(stdout, stderr)
+    assert len(pollers) == 2
+    assert pollers[0].provider_cache is pollers[1].provider_cache
+    assert pollers[0].device_cache is pollers[1].device_cache
+
+
 @pytest.mark.django_db
 def test_follow_up(client, settings, requests_mock):
     """Catching up new telemetries from the last one we got."""
@@ -173,7 +252,8 @@ def test_follow_up(client, settings, requests_mock):
 
 
 @pytest.mark.django_db
-def test_poll_provider_v0_4_archives(client, requests_mock):
+@pytest.mark.parametrize("stream_chunk_size", [0, 1])
+def test_poll_provider_v0_4_archives(client, requests_mock, stream_chunk_size):
     # Note: testing with the default "POLLER_CREATE_REGISTER_EVENTS = False"
     provider = factories.Provider(
         base_api_url="http://provider",
@@ -202,7 +282,13 @@ def test_poll_provider_v0_4_archives(client, requests_mock):
     requests_mock.get(
         urllib.parse.urljoin(provider.base_api_url, "/events"), status_code=400,
     )
-    call_command("poll_providers", "--raise-on-error", stdout=stdout, stderr=stderr)
+    call_command(
+        "poll_providers",
+        "--raise-on-error",
+        f"--stream-chunk-size={stream_chunk_size}",
+        stdout=stdout,
+        stderr=stderr,
+    )
 
     assert_command_success(stdout, stderr)
     # The last poller cursor is updated
@@ -218,6 +304,36 @@ def test_poll_provider_v0_4_archives(client, requests_mock):
     assert_device_equal(device, expected_device)
 
 
+# The lock is held by another connection
+@pytest.mark.django_db(transaction=True)
+def test_poll_provider_locked(client, requests_mock):
+    provider = factories.Provider(base_api_url="http://provider")
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        try:
+            with locking.provider_lock(provider) as acquired:
+                assert acquired
+                locked.set()
+                release.wait(10)
+        finally:
+            db.connection.close()
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    locked.wait(10)
+    stdout, stderr = io.StringIO(), io.StringIO()
+    try:
+        call_command("poll_providers", "--raise-on-error", stdout=stdout, stderr=stderr)
+    finally:
+        release.set()
+        thread.join()
+
+    assert_command_success(stdout, stderr)
+    # Skipped, the other process is polling it
+    assert not requests_mock.request_history
+
+
 @pytest.mark.django_db
 def test_poll_provider_v0_4_archives_resume(client, requests_mock):
     # Note: testing with the default "POLLER_CREATE_REGISTER_EVENTS = False"
@@ -300,6 +416,80 @@ def test_poll_provider_v0_4_archives_no_result(client, requests_mock):
     assert provider.last_event_time_polled is not None
 
 
+@pytest.mark.django_db(transaction=True)
+def test_poll_provider_v0_4_archives_backfill(client, requests_mock):
+    # Five hours of archives to poll
+    last_event_time_polled = timezone.now() - datetime.timedelta(
+        days=9, hours=5, minutes=30
+    )
+    provider = factories.Provider(
+        base_api_url="http://provider",
+        api_configuration__api_version=enums.MDS_VERSIONS.v0_4.name,
+        last_event_time_polled=last_event_time_polled,
+    )
+    first_window = last_event_time_polled.replace(
+        minute=0, second=0, microsecond=0
+    ) + datetime.timedelta(hours=1)
+    windows = [first_window + datetime.timedelta(hours=i) for i in range(5)]
+    # The third hour was already polled last time but the second one failed
+    models.ProviderPollingWindow.objects.create(provider=provider, start=windows[2])
+    expected_device = factories.Device.build()
+    expected_event = factories.EventRecord.build(
+        event_type=enums.EVENT_TYPE.service_start.name,
+    )
+    stdout, stderr = io.StringIO(), io.StringIO()
+
+    polled = []
+
+    def status_changes_callback(request, context):
+        # The query string is lowercased by the mock
+        event_time = request.qs["event_time"][0]
+        polled.append(event_time)
+        if event_time == windows[1].isoformat()[: len("yyyy-mm-ddthh")].lower():
+            return make_response(
+                provider,
+                expected_device,
+                expected_event,
+                event_type_reason="service_start",
+                version="0.4.0",
+            )
+        return {"version": "0.4.0", "data": {"status_changes": []}}
+
+    requests_mock.get(
+        urllib.parse.urljoin(provider.base_api_url, "/status_changes"),
+        json=status_changes_callback,
+    )
+    # Mocking must fail if we query the real time endpoint instead
+    requests_mock.get(
+        urllib.parse.urljoin(provider.base_api_url, "/events"), status_code=400,
+    )
+    call_command(
+        "poll_providers",
+        "--raise-on-error",
+        "--backfill-workers=2",
+        stdout=stdout,
+        stderr=stderr,
+    )
+
+    assert_command_success(stdout, stderr)
+    # Each hour was polled once
+    assert sorted(polled) == sorted(
+        window.isoformat()[: len("yyyy-mm-ddthh")].lower()
+        for window in windows
+        if window != windows[2]
+    )
+    # The cursor is at the end of the last hour
+    provider = models.Provider.objects.get(pk=provider.pk)
+    assert provider.last_event_time_polled == windows[-1] + datetime.timedelta(
+        hours=1, milliseconds=-1
+    )
+    # We don't need to remember the hours polled anymore
+    assert not provider.polling_windows.exists()
+    device = models.Device.objects.get(pk=expected_device.pk)
+    event = device.event_records.get()
+    assert_event_equal(event, expected_event)
+
+
 @pytest.mark.django_db
 def test_poll_provider_v0_4_realtime(client, requests_mock):
     # Note: testing with the default "POLLER_CREATE_REGISTER_EVENTS = False"
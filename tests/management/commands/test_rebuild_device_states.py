@@ -0,0 +1,39 @@
+import io
+
+import pytest
+
+from django.core.management import call_command
+
+from mds import enums
+from mds import factories
+
+
+@pytest.mark.django_db
+def test_rebuild_device_states():
+    provider = factories.Provider()
+    devices = factories.Device.create_batch(
+        3, provider=provider, dn_status=enums.DEVICE_STATUS.unknown.name
+    )
+    # Created directly, so the denormalized fields were not maintained
+    for device in devices:
+        factories.EventRecord(
+            device=device, event_type=enums.EVENT_TYPE.service_end.name
+        )
+    # A device without events
+    untouched = factories.Device(provider=provider)
+    stdout = io.StringIO()
+
+    call_command(
+        "rebuild_device_states",
+        "--chunk-size=2",
+        f"--provider={provider.pk}",
+        stdout=stdout,
+    )
+
+    assert stdout.getvalue() == "3 devices updated.\n"
+    for device in devices:
+        device.refresh_from_db()
+        assert device.dn_status == enums.DEVICE_STATUS.unavailable.name
+        assert device.dn_gps_point.coords == (3.0, 0.0)
+    untouched.refresh_from_db()
+    assert untouched.dn_status_timestamp is None
@@ -0,0 +1,53 @@
+import io
+import urllib.parse
+
+import pytest
+
+from django.core.management import call_command
+
+from mds import enums
+from mds import factories
+from mds import models
+from mds.provider_poller import archive
+
+from .test_poll_providers import assert_command_success, make_response
+
+
+@pytest.mark.django_db
+def test_replay_provider_archives(client, monkeypatch, requests_mock, tmp_path):
+    monkeypatch.setattr(archive, "POLLER_ARCHIVE_DIR", str(tmp_path))
+    provider = factories.Provider(base_api_url="http://provider")
+    expected_device = factories.Device.build()
+    expected_event = factories.EventRecord.build(
+        event_type=enums.EVENT_TYPE.service_start.name,
+    )
+    requests_mock.get(
+        urllib.parse.urljoin(provider.base_api_url, "/status_changes"),
+        json=make_response(
+            provider,
+            expected_device,
+            expected_event,
+            event_type_reason="service_start",
+        ),
+    )
+    stdout, stderr = io.StringIO(), io.StringIO()
+    call_command("poll_providers", "--raise-on-error", stdout=stdout, stderr=stderr)
+    assert_command_success(stdout, stderr)
+    assert len(archive.list_files()) == 1
+
+    # The event was lost or badly mapped
+    models.EventRecord.objects.all().delete()
+    stdout, stderr = io.StringIO(), io.StringIO()
+
+    call_command(
+        "replay_provider_archives",
+        f"--provider={provider.pk}",
+        stdout=stdout,
+        stderr=stderr,
+    )
+
+    assert_command_success(stdout, stderr)
+    assert stdout.getvalue() == "1 status changes replayed from 1 archive files.\n"
+    event = models.EventRecord.objects.get(device_id=expected_device.pk)
+    assert event.event_type == enums.EVENT_TYPE.service_start.name
+    assert event.source == enums.EVENT_SOURCE.provider_api.name
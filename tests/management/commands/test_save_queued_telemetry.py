@@ -0,0 +1,56 @@
+import pytest
+
+from django.core.management import call_command
+from django.urls import reverse
+
+from mds import enums
+from mds import factories
+from mds import models
+from mds import provider_config
+from mds.access_control.scopes import SCOPE_AGENCY_API
+from mds.management.commands import save_queued_telemetry
+from tests.auth_helpers import auth_header, BASE_NUM_QUERIES
+
+
+@pytest.mark.django_db
+def test_save_queued_telemetry(client, settings, django_assert_num_queries):
+    settings.AGENCY_API_TELEMETRY_QUEUE = True
+    provider = factories.Provider()
+    device = factories.Device(provider=provider)
+    frames_saved = save_queued_telemetry.frames_saved.get()
+    provider_config.get(provider.id)  # Already cached
+
+    for timestamp in (1_325_376_000_000, 1_325_376_001_000):
+        n = BASE_NUM_QUERIES
+        n += 1  # select devices
+        n += 1  # queue the telemetry
+        with django_assert_num_queries(n):
+            response = client.post(
+                reverse("agency-0.3:device-telemetry"),
+                data={
+                    "data": [
+                        {
+                            "device_id": str(device.id),
+                            "timestamp": timestamp,
+                            "gps": {"lat": 48.85, "lng": 2.35},
+                            "charge": 0.5,
+                        }
+                    ]
+                },
+                content_type="application/json",
+                **auth_header(SCOPE_AGENCY_API, provider_id=provider.id),
+            )
+        assert response.status_code == 201
+    assert models.QueuedTelemetry.objects.count() == 2
+    assert not models.EventRecord.objects.exists()
+
+    call_command("save_queued_telemetry", "--once")
+
+    assert not models.QueuedTelemetry.objects.exists()
+    event_records = models.EventRecord.objects.order_by("timestamp")
+    assert [event_record.device_id for event_record in event_records] == [device.id] * 2
+    assert event_records[1].properties["telemetry"]["battery_pct"] == 0.5
+    assert event_records[1].source == enums.EVENT_SOURCE.agency_api.name
+    device.refresh_from_db()
+    assert device.dn_gps_point.coords == (2.35, 48.85)
+    assert save_queued_telemetry.frames_saved.get() == frames_saved + 2
@@ -0,0 +1,205 @@
+import datetime
+import uuid
+
+import pytest
+import pytz
+
+from django.contrib.gis import geos
+
+from mds import compliance
+from mds import enums
+from mds import factories
+from mds import models
+
+
+NOW = datetime.datetime(2020, 1, 6, 12, 0, tzinfo=pytz.UTC)  # A monday
+GEOGRAPHY_ID = uuid.UUID("e0e4a085-7a50-43e0-afa4-6792ca897c5a")
+
+
+def make_policy(**rule):
+    rule.setdefault("statuses", {enums.DEVICE_STATUS.available.name: []})
+    return factories.Policy(
+        published=True,
+        start_date=NOW - datetime.timedelta(days=1),
+        rules=[factories.Rule(rule_id=str(uuid.uuid4()), vehicle_types=[], **rule)],
+    )
+
+
+def make_event(device, timestamp, event_type, lng=3.0, lat=3.0, speed=0.0):
+    return factories.EventRecord(
+        device=device,
+        timestamp=timestamp,
+        # Not the real clock, the runs are incremental
+        saved_at=timestamp,
+        event_type=event_type,
+        point=geos.Point(lng, lat),
+        properties={"telemetry": {"gps": {"lng": lng, "lat": lat, "speed": speed}}},
+    )
+
+
+def make_device(timestamp, event_type=enums.EVENT_TYPE.service_start.name, **kwargs):
+    device = factories.Device()
+    make_event(device, timestamp, event_type, **kwargs)
+    return device
+
+
+def fail(*args):
+    raise AssertionError("Evaluated again")
+
+
+@pytest.mark.django_db
+def test_count(monkeypatch):
+    make_policy(rule_type="count", maximum=1)
+    first = make_device(NOW - datetime.timedelta(hours=2))
+    second = make_device(NOW - datetime.timedelta(hours=1))
+    make_device(NOW - datetime.timedelta(hours=1), lng=100.0)  # Elsewhere
+    make_device(NOW, event_type=enums.EVENT_TYPE.trip_start.name)
+
+    assert compliance.compute_compliances(now=NOW) == {"opened": 1, "closed": 0}
+    violation = models.Compliance.objects.get()
+    assert violation.vehicle_id == second.pk
+    assert violation.geography == GEOGRAPHY_ID
+    assert violation.start_date == NOW
+    assert violation.end_date is None
+
+    # The events saved lately may not have been visible yet, seen again
+    later = NOW + compliance.SAVED_AT_MARGIN + datetime.timedelta(minutes=1)
+    assert compliance.compute_compliances(now=later) == {"opened": 0, "closed": 0}
+
+    # Then nothing happened, nothing to compute
+    with monkeypatch.context() as patch:
+        patch.setattr(compliance.Evaluation, "evaluate_count", fail)
+        later += datetime.timedelta(minutes=1)
+        assert compliance.compute_compliances(now=later) == {
+            "opened": 0,
+            "closed": 0,
+        }
+
+    make_event(first, later, enums.EVENT_TYPE.trip_start.name)
+    even_later = later + datetime.timedelta(minutes=1)
+    assert compliance.compute_compliances(now=even_later) == {
+        "opened": 0,
+        "closed": 1,
+    }
+    violation.refresh_from_db()
+    assert violation.end_date == even_later
+
+
+@pytest.mark.django_db
+def test_count_lag():
+    make_policy(rule_type="count", maximum=1)
+    make_device(NOW - datetime.timedelta(hours=2))
+    make_device(NOW - datetime.timedelta(minutes=10))  # Not seen yet
+
+    lag = datetime.timedelta(minutes=30)
+    assert compliance.compute_compliances(lag, now=NOW) == {"opened": 0, "closed": 0}
+    assert models.ComplianceWatermark.objects.get(lag=lag).computed_at == NOW - lag
+    # The other lags have their own timeline
+    assert compliance.compute_compliances(now=NOW) == {"opened": 1, "closed": 0}
+
+
+@pytest.mark.django_db
+def test_count_not_in_effect():
+    make_policy(rule_type="count", maximum=0, days=["sat", "sun"])
+    make_device(NOW - datetime.timedelta(hours=1))
+
+    assert compliance.compute_compliances(now=NOW) == {"opened": 0, "closed": 0}
+
+
+@pytest.mark.django_db
+def test_count_no_longer_in_effect():
+    make_policy(rule_type="count", maximum=0, end_time="12:30:00")
+    make_device(NOW - datetime.timedelta(hours=1))
+    assert compliance.compute_compliances(now=NOW) == {"opened": 1, "closed": 0}
+
+    # Nothing happened but the time
+    later = NOW + datetime.timedelta(minutes=31)
+    assert compliance.compute_compliances(now=later) == {"opened": 0, "closed": 1}
+    assert models.Compliance.objects.get().end_date == later
+
+
+@pytest.mark.django_db
+def test_time():
+    make_policy(rule_type="time", rule_units="minutes", maximum=30)
+    stale = make_device(NOW - datetime.timedelta(hours=1))
+    make_device(NOW - datetime.timedelta(minutes=10))
+
+    assert compliance.compute_compliances(now=NOW) == {"opened": 1, "closed": 0}
+    violation = models.Compliance.objects.get()
+    assert violation.vehicle_id == stale.pk
+    assert violation.start_date == NOW - datetime.timedelta(minutes=30)
+
+    # Still there
+    later = NOW + datetime.timedelta(minutes=1)
+    assert compliance.compute_compliances(now=later) == {"opened": 0, "closed": 0}
+
+
+@pytest.mark.django_db
+def test_time_violating_again():
+    make_policy(rule_type="time", rule_units="minutes", maximum=30)
+    device = make_device(NOW - datetime.timedelta(hours=1))
+    assert compliance.compute_compliances(now=NOW) == {"opened": 1, "closed": 0}
+
+    # Leaving the geography
+    left = NOW + datetime.timedelta(minutes=1)
+    make_event(device, left, "telemetry", lng=100.0)
+    closed_at = NOW + datetime.timedelta(minutes=2)
+    assert compliance.compute_compliances(now=closed_at) == {"opened": 0, "closed": 1}
+
+    # Back with the same status
+    back = NOW + datetime.timedelta(minutes=3)
+    make_event(device, back, "telemetry")
+    later = NOW + datetime.timedelta(minutes=4)
+    assert compliance.compute_compliances(now=later) == {"opened": 1, "closed": 0}
+    previous, violation = models.Compliance.objects.order_by("start_date")
+    assert previous.end_date == closed_at
+    # Not overlapping the previous interval
+    assert violation.start_date == closed_at
+    assert violation.end_date is None
+
+
+@pytest.mark.django_db
+def test_speed():
+    make_policy(rule_type="speed", rule_units="kph", maximum=25, statuses={})
+    device = make_device(NOW - datetime.timedelta(hours=1), speed=5.0)  # 18 kph
+    timestamp = NOW - datetime.timedelta(minutes=30)
+    make_event(device, timestamp, "telemetry", speed=10.0)  # 36 kph
+
+    assert compliance.compute_compliances(now=NOW) == {"opened": 1, "closed": 0}
+    violation = models.Compliance.objects.get()
+    assert violation.vehicle_id == device.pk
+    assert violation.start_date == violation.end_date == timestamp
+
+    # Already seen
+    later = NOW + datetime.timedelta(minutes=1)
+    assert compliance.compute_compliances(now=later) == {"opened": 0, "closed": 0}
+
+
+@pytest.mark.django_db
+def test_speed_in_effect():
+    make_policy(
+        rule_type="speed", rule_units="kph", maximum=25, statuses={}, end_time="12:30"
+    )
+    device = make_device(NOW - datetime.timedelta(hours=1), speed=5.0)
+    assert compliance.compute_compliances(now=NOW) == {"opened": 0, "closed": 0}
+
+    # Evaluated after the end time, at the time of each telemetry
+    before = NOW + datetime.timedelta(minutes=20)
+    make_event(device, before, "telemetry", speed=10.0)
+    make_event(device, NOW + datetime.timedelta(minutes=35), "telemetry", speed=10.0)
+    later = NOW + datetime.timedelta(minutes=40)
+    assert compliance.compute_compliances(now=later) == {"opened": 1, "closed": 0}
+    assert models.Compliance.objects.get().start_date == before
+
+
+@pytest.mark.django_db
+def test_policy_ended():
+    policy = make_policy(rule_type="count", maximum=0)
+    make_device(NOW - datetime.timedelta(hours=1))
+    assert compliance.compute_compliances(now=NOW) == {"opened": 1, "closed": 0}
+
+    policy.end_date = NOW + datetime.timedelta(minutes=1)
+    policy.save()
+    later = NOW + datetime.timedelta(minutes=2)
+    assert compliance.compute_compliances(now=later) == {"opened": 0, "closed": 1}
+    assert models.Compliance.objects.get().end_date == later
@@ -1,8 +1,12 @@
 import pytest
 
+from django.utils import timezone
+
 from mds import db_helpers
+from mds import enums
 from mds import factories
 from mds import models
+from mds import utils
 
 
 # Don't use factories not to prefill all fields
@@ -11,18 +15,34 @@ from mds import models
 @pytest.mark.django_db
 def test_upsert_provider():
     provider = factories.Provider.build()
-    db_helpers.upsert_providers([provider])
+    assert db_helpers.upsert_providers([provider]) == [provider.pk]
 
     assert models.Provider.objects.get()
+    # Only the IDs actually inserted are returned
+    assert db_helpers.upsert_providers([provider]) == []
 
 
 @pytest.mark.django_db
 def test_upsert_device():
     provider = factories.Provider()  # Had issue when not creating it
     device = factories.Device.build(provider=provider)
-    db_helpers.upsert_devices([device])
+    assert db_helpers.upsert_devices([device]) == [device.pk]
 
     assert models.Device.objects.get()
+    # Only the IDs actually inserted are returned
+    assert db_helpers.upsert_devices([device]) == []
+
+
+@pytest.mark.django_db
+def test_upsert_devices_paginated(django_assert_num_queries):
+    provider = factories.Provider()
+    devices = factories.Device.build_batch(5, provider=provider)
+
+    with django_assert_num_queries(3):  # 2 + 2 + 1
+        device_ids = db_helpers.upsert_devices(devices, page_size=2)
+
+    assert set(device_ids) == {device.pk for device in devices}
+    assert models.Device.objects.count() == 5
 
 
 @pytest.mark.django_db
@@ -32,3 +52,117 @@ def test_upsert_event_record():
     db_helpers.upsert_event_records([event_record], "push")
 
     assert models.EventRecord.objects.get()
+
+
+@pytest.mark.django_db
+def test_upsert_single_event_record(django_assert_num_queries):
+    device = factories.Device()
+    event_record = factories.EventRecord.build(
+        device=device, event_type=enums.EVENT_TYPE.service_start.name
+    )
+
+    with django_assert_num_queries(1):
+        saved = db_helpers.upsert_event_record(event_record, "push")
+    assert saved.pk == models.EventRecord.objects.get().pk
+    device.refresh_from_db()
+    assert device.dn_status == enums.DEVICE_STATUS.available.name
+
+    # Ignored duplicate
+    event_record = factories.EventRecord.build(
+        device=device, timestamp=event_record.timestamp
+    )
+    assert db_helpers.upsert_event_record(event_record, "push") is None
+
+
+@pytest.mark.django_db
+def test_copy_event_records_duplicates():
+    device = factories.Device()
+    timestamp = timezone.now()
+    rows = [
+        {
+            "device_id": device.id,
+            "timestamp": timestamp,
+            "point": utils.to_ewkt_point(2.35, 48.85),
+            "event_type": enums.EVENT_TYPE.service_start.name,
+            "properties": {"trip_id": None},
+        },
+        {
+            "device_id": device.id,
+            "timestamp": timestamp,
+            "point": None,
+            "event_type": enums.EVENT_TYPE.service_end.name,
+            # Special characters in the COPY format
+            "properties": {"escaped": "\t\n\\N"},
+        },
+    ]
+
+    # The first duplicate wins when ignoring conflicts...
+    db_helpers.copy_event_records(rows, enums.EVENT_SOURCE.provider_api.name)
+    event_record = models.EventRecord.objects.get()
+    assert event_record.event_type == enums.EVENT_TYPE.service_start.name
+    assert event_record.point.coords == (2.35, 48.85)
+
+    # ... and the last one when overwriting
+    db_helpers.copy_event_records(
+        rows, enums.EVENT_SOURCE.agency_api.name, on_conflict_update=True
+    )
+    event_record = models.EventRecord.objects.get()
+    assert event_record.event_type == enums.EVENT_TYPE.service_end.name
+    assert event_record.properties == {"escaped": "\t\n\\N"}
+    assert event_record.source == enums.EVENT_SOURCE.agency_api.name
+
+
+@pytest.mark.django_db
+def test_copy_event_records_device_states():
+    device = factories.Device(dn_status=enums.DEVICE_STATUS.unknown.name)
+    now = timezone.now()
+    rows = [
+        {
+            "device_id": device.id,
+            "timestamp": now - timezone.timedelta(minutes=2),
+            "point": utils.to_ewkt_point(2.35, 48.85),
+            "event_type": enums.EVENT_TYPE.service_start.name,
+            "properties": {"telemetry": {"battery_pct": 0.9}},
+        },
+        {
+            "device_id": device.id,
+            "timestamp": now - timezone.timedelta(minutes=1),
+            "point": utils.to_ewkt_point(2.36, 48.86),
+            "event_type": enums.EVENT_TYPE.telemetry.name,
+            "properties": {"telemetry": {"battery_pct": 0.8}},
+        },
+    ]
+    db_helpers.copy_event_records(rows, enums.EVENT_SOURCE.agency_api.name)
+
+    device.refresh_from_db()
+    assert device.dn_status == enums.DEVICE_STATUS.available.name
+    assert device.dn_status_timestamp == rows[0]["timestamp"]
+    assert device.dn_gps_point.coords == (2.36, 48.86)
+    assert device.dn_gps_timestamp == rows[1]["timestamp"]
+    assert device.dn_battery_pct == 0.8
+
+    # An older event received late doesn't regress the state
+    db_helpers.copy_event_records(
+        [
+            {
+                "device_id": device.id,
+                "timestamp": now - timezone.timedelta(minutes=3),
+                "point": utils.to_ewkt_point(2.37, 48.87),
+                "event_type": enums.EVENT_TYPE.service_end.name,
+                "properties": {},
+            }
+        ],
+        enums.EVENT_SOURCE.provider_api.name,
+    )
+    device.refresh_from_db()
+    assert device.dn_status == enums.DEVICE_STATUS.available.name
+    assert device.dn_gps_point.coords == (2.36, 48.86)
+
+    # Unless rebuilding from scratch, which gives the same result
+    models.Device.objects.filter(pk=device.pk).update(
+        dn_status=enums.DEVICE_STATUS.unknown.name, dn_status_timestamp=None
+    )
+    assert db_helpers.rebuild_device_states([device.pk]) == 1
+    device.refresh_from_db()
+    assert device.dn_status == enums.DEVICE_STATUS.available.name
+    assert device.dn_status_timestamp == rows[0]["timestamp"]
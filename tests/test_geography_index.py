@@ -0,0 +1,53 @@
+import pytest
+
+from django.contrib.gis import geos
+
+from mds import factories
+from mds import geography_index
+
+
+GEOGRAPHY_ID = "e0e4a085-7a50-43e0-afa4-6792ca897c5a"
+
+
+def square(x, y, size=1.0):
+    return geos.Polygon(
+        ((x, y), (x, y + size), (x + size, y + size), (x + size, y), (x, y)), srid=4326,
+    )
+
+
+def test_str_tree():
+    entries = [((x, y, x + 1, y + 1), (x, y)) for x in range(20) for y in range(20)]
+    tree = geography_index.STRtree(entries, node_capacity=4)
+
+    assert tree.query(3.5, 4.5) == [(3, 4)]
+    assert sorted(tree.query(3, 4)) == [(2, 3), (2, 4), (3, 3), (3, 4)]
+    assert tree.query(-1, 0) == []
+    assert geography_index.STRtree([]).query(0, 0) == []
+
+
+def test_geography_index():
+    index = geography_index.GeographyIndex(
+        {f"{x}-{y}": square(x, y) for x in range(10) for y in range(10)}
+    )
+
+    assert index.locate_many(
+        [(3.5, 4.5), geos.Point(9.5, 0.5, srid=4326), (3, 4.5), (20, 20)]
+    ) == [["3-4"], ["9-0"], ["2-4", "3-4"], []]
+
+
+@pytest.mark.django_db
+def test_get_index():
+    policy = factories.Policy(published=True)
+
+    index = geography_index.get_index(policy)
+    assert index.locate((3.0, 3.0)) == [GEOGRAPHY_ID]
+    assert geography_index.locate(policy, [(3.0, 3.0), (60.0, 3.0)]) == [
+        [GEOGRAPHY_ID],
+        [],
+    ]
+    # Cached
+    assert geography_index.get_index(policy) is index
+
+    # The geographies of a policy published again are frozen again
+    geography_index.invalidate()
+    assert geography_index.get_index(policy) is not index
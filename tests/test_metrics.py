@@ -0,0 +1,54 @@
+import pytest
+
+from mds import metrics
+
+
+def test_histogram():
+    histogram = metrics.histogram(
+        "test_histogram_seconds", "A test histogram.", buckets=(0.1, 1)
+    )
+    histogram.observe(0.05, provider="Lime")
+    histogram.observe(0.5, provider="Lime")
+    histogram.observe(5, provider="Lime")
+    with histogram.time(provider="BlueLA"):
+        pass
+
+    assert histogram.get(provider="Lime") == 3
+    lines = metrics.to_prometheus().splitlines()
+    assert "# TYPE test_histogram_seconds histogram" in lines
+    assert 'test_histogram_seconds_bucket{le="0.1",provider="Lime"} 1' in lines
+    assert 'test_histogram_seconds_bucket{le="1",provider="Lime"} 2' in lines
+    assert 'test_histogram_seconds_bucket{le="+Inf",provider="Lime"} 3' in lines
+    assert 'test_histogram_seconds_sum{provider="Lime"} 5.55' in lines
+    assert 'test_histogram_seconds_count{provider="BlueLA"} 1' in lines
+
+
+def test_counter_to_prometheus():
+    counter = metrics.counter("test_counter", "A test counter.")
+    counter.inc(provider='Say "hello"')
+
+    lines = metrics.to_prometheus().splitlines()
+    assert "# HELP test_counter A test counter." in lines
+    assert 'test_counter{provider="Say \\"hello\\""} 1' in lines
+
+    with pytest.raises(ValueError):
+        metrics.gauge("test_counter", "Not a gauge.")
+
+
+class RecordingBackend(metrics.Backend):
+    recorded = []
+
+    def inc(self, metric, amount, labels):
+        self.recorded.append((metric.name, amount, labels))
+
+
+def test_backend(monkeypatch, settings):
+    settings.MDS_METRICS_BACKENDS = ["tests.test_metrics.RecordingBackend"]
+    monkeypatch.setattr(metrics, "_backends", None)
+    counter = metrics.counter("test_backend_counter", "A test counter.")
+
+    counter.inc(2, provider="Lime")
+
+    assert RecordingBackend.recorded == [
+        ("test_backend_counter", 2, {"provider": "Lime"})
+    ]
@@ -4,6 +4,7 @@ import uuid
 
 import pytest
 
+from django.contrib.gis import geos
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 
@@ -21,6 +22,35 @@ def test_with_device_categories():
     assert provider.device_categories == {"bicycle": 3, "scooter": 2, "car": 1}
 
 
+@pytest.mark.django_db
+def test_with_latest_events(django_assert_num_queries):
+    now = timezone.now()
+    device = factories.Device()
+    latest_event = factories.EventRecord(
+        device=device, event_type="service_end", timestamp=now
+    )
+    factories.EventRecord(
+        device=device,
+        event_type="service_start",
+        timestamp=now - datetime.timedelta(seconds=10),
+    )
+    # Telemetries are not events
+    factories.EventRecord(
+        device=device,
+        event_type="telemetry",
+        timestamp=now + datetime.timedelta(seconds=10),
+    )
+    factories.Device()  # Without events
+
+    with django_assert_num_queries(2):  # Devices then their latest event
+        devices = {
+            device.pk: device.latest_event
+            for device in models.Device.objects.with_latest_events()
+        }
+    assert devices[device.pk] == latest_event
+    assert len([event for event in devices.values() if event is None]) == 1
+
+
 @pytest.mark.django_db
 def test_policy_active():
     now = timezone.now()
@@ -117,3 +147,66 @@ def test_policy_publish():
     assert policy.rules[0]["geographies"] == [
         uuid.UUID("fe363c54-011b-4840-a909-0fd4ef6d168e")
     ]
+
+
+@pytest.mark.django_db
+def test_policy_publish_precision(settings):
+    settings.POLICY_GEOGRAPHY_PRECISION = None
+    coordinates = [
+        [2.123456789012, 48.123456789012],
+        [2.123456789012, 48.987654321098],
+        [2.987654321098, 48.987654321098],
+        [2.123456789012, 48.123456789012],
+    ]
+    polygon = factories.Polygon(geom=geos.MultiPolygon(geos.Polygon(coordinates)))
+    area = factories.Area(polygons=[polygon])
+    policy = factories.Policy(
+        published_date=None,
+        rules=[factories.Rule(rule_id=str(uuid.uuid4()), geographies=[str(area.pk)])],
+    )
+
+    policy.publish()
+
+    (geography,) = policy.geographies.values()
+    (geometry,) = geography["geometry"]["geometries"]
+    (ring,) = geometry["coordinates"][0]
+    # Not rounded
+    assert [value for point in ring for value in point] == pytest.approx(
+        [value for point in coordinates for value in point], abs=1e-12
+    )
+
+
+@pytest.mark.django_db
+def test_policy_publish_queries(django_assert_num_queries, settings):
+    settings.POLICY_GEOGRAPHY_SIMPLIFY = 0.1
+    settings.POLICY_GEOGRAPHY_PRECISION = 1
+    areas = factories.Area.create_batch(3)
+    policy = factories.Policy(
+        published_date=None,
+        rules=[
+            factories.Rule(rule_id=str(uuid.uuid4()), geographies=[str(area.pk)])
+            for area in areas
+        ]
+        + [
+            factories.Rule(
+                rule_id=str(uuid.uuid4()), geographies=[str(area.pk) for area in areas]
+            )
+        ],
+    )
+
+    # The areas, their polygons and saving the policy
+    with django_assert_num_queries(3):
+        policy.publish()
+
+    assert len(policy.geographies) == 3
+    # The same geography for the same area
+    assert policy.rules[-1]["geographies"] == [
+        rule["geographies"][0] for rule in policy.rules[:3]
+    ]
+    for geography in policy.geographies.values():
+        assert geography["geometry"]["geometries"] == [
+            {
+                "type": "MultiPolygon",
+                "coordinates": [[[[0, 0], [0, 50], [50, 50], [50, 0], [0, 0]]]],
+            }
+        ]
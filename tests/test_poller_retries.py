@@ -0,0 +1,86 @@
+import pytest
+import requests
+
+from mds import factories
+from mds.provider_poller import retries
+
+
+def get_json(url):
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+@pytest.fixture
+def slept(monkeypatch):
+    slept = []
+    monkeypatch.setattr(retries, "sleep", slept.append)
+    return slept
+
+
+def test_retry(requests_mock, slept):
+    provider = factories.Provider.build(name="Lime")
+    requests_mock.get(
+        "http://provider/status_changes",
+        [
+            {"status_code": 503, "headers": {"Retry-After": "2"}},
+            {"status_code": 500},
+            {"json": {"data": {}}},
+        ],
+    )
+
+    assert retries.call(provider, get_json, "http://provider/status_changes") == {
+        "data": {}
+    }
+
+    # Waiting what was asked, then backing off (with jitter)
+    assert slept[0] == 2
+    assert 0 <= slept[1] <= 2
+    assert (
+        retries.decisions.get(
+            provider_id=str(provider.pk), provider="Lime", decision="retry"
+        )
+        >= 2
+    )
+
+
+def test_no_retry(requests_mock, slept):
+    provider = factories.Provider.build()
+    requests_mock.get("http://provider/status_changes", status_code=404)
+
+    with pytest.raises(requests.HTTPError):
+        retries.call(provider, get_json, "http://provider/status_changes")
+
+    assert requests_mock.call_count == 1
+    assert not slept
+
+
+def test_no_retry_circuit_closed(requests_mock, slept):
+    provider = factories.Provider.build(
+        api_configuration={"retry_policy": {"failure_threshold": 1}}
+    )
+    requests_mock.get("http://provider/status_changes", status_code=404)
+
+    with pytest.raises(requests.HTTPError):
+        retries.call(provider, get_json, "http://provider/status_changes")
+
+    # Our mistake, not a failure of the provider
+    with pytest.raises(requests.HTTPError):
+        retries.call(provider, get_json, "http://provider/status_changes")
+    assert requests_mock.call_count == 2
+
+
+def test_circuit_breaker(requests_mock, slept):
+    provider = factories.Provider.build(
+        api_configuration={"retry_policy": {"failure_threshold": 2}}
+    )
+    requests_mock.get("http://provider/status_changes", status_code=500)
+
+    with pytest.raises(requests.HTTPError):
+        retries.call(provider, get_json, "http://provider/status_changes")
+    assert requests_mock.call_count == 2
+
+    # The provider is left alone for a while
+    with pytest.raises(retries.CircuitOpen):
+        retries.call(provider, get_json, "http://provider/status_changes")
+    assert requests_mock.call_count == 2
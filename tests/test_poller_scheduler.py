@@ -0,0 +1,49 @@
+import datetime
+
+import pytest
+
+from django.utils import timezone
+
+from mds import factories
+from mds.provider_poller import scheduler
+
+
+def test_get_next_poll_time():
+    now = timezone.now()
+    provider = factories.Provider.build(
+        api_configuration={"polling_interval": "PT5M"}, last_event_time_polled=now
+    )
+    assert scheduler.get_next_poll_time(provider, now) == now + datetime.timedelta(
+        minutes=5
+    )
+
+    # Not before the provider collected the data of its devices
+    provider.api_configuration["provider_polling_lag"] = "PT1H"
+    assert scheduler.get_next_poll_time(provider, now) == now + datetime.timedelta(
+        hours=1
+    )
+
+    # Backing off from errors, up to an hour
+    assert scheduler.get_next_poll_time(
+        provider, now, failures=2
+    ) == now + datetime.timedelta(minutes=20)
+    assert scheduler.get_next_poll_time(
+        provider, now, failures=10
+    ) == now + datetime.timedelta(hours=1)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_scheduler():
+    provider = factories.Provider(name="Lime", base_api_url="http://provider")
+    # Nothing to poll
+    factories.Provider(name="BlueLA", base_api_url="")
+    polled = []
+
+    def poll(provider, stop_event):
+        polled.append(provider.pk)
+        daemon.stop()
+
+    daemon = scheduler.Scheduler(poll, workers=2)
+    daemon.run()
+
+    assert polled == [provider.pk]
@@ -0,0 +1,53 @@
+import gc
+import threading
+import weakref
+
+from mds import factories
+from mds.provider_poller import sessions
+
+
+def test_sessions():
+    provider = factories.Provider.build()
+
+    session = sessions.get(provider)
+    assert sessions.get(provider) is session
+
+    # The OAuth2 token is set on the session, one session per thread
+    oauth2_session = sessions.get(provider, client_id="client")
+    assert sessions.get(provider, client_id="client") is oauth2_session
+    other_sessions = []
+    thread = threading.Thread(
+        target=lambda: other_sessions.append(
+            sessions.get(provider, client_id="client")
+        )
+    )
+    thread.start()
+    thread.join()
+    assert other_sessions[0] is not oauth2_session
+
+    # But they all share the same connections
+    adapter = session.get_adapter("https://provider")
+    assert oauth2_session.get_adapter("https://provider") is adapter
+    assert other_sessions[0].get_adapter("https://provider") is adapter
+
+
+def test_sessions_of_threads():
+    provider = factories.Provider.build()
+    sessions.get(provider)
+    known = dict(sessions._sessions)
+
+    # E.g. the prefetching and backfilling threads of each polling round
+    oauth2_sessions = []
+    for _ in range(3):
+        thread = threading.Thread(
+            target=lambda: oauth2_sessions.append(
+                weakref.ref(sessions.get(provider, client_id="client"))
+            )
+        )
+        thread.start()
+        thread.join()
+
+    assert sessions._sessions == known
+    # Dropped with their thread
+    gc.collect()
+    assert all(session() is None for session in oauth2_sessions)
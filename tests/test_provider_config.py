@@ -0,0 +1,34 @@
+import pytest
+
+from mds import factories
+from mds import provider_config
+
+
+@pytest.mark.django_db
+def test_provider_config(django_assert_num_queries):
+    provider = factories.Provider(
+        agency_api_configuration={"api_version": "v0_3", "swap_lat_lng": True}
+    )
+
+    with django_assert_num_queries(1):
+        config = provider_config.get(provider.pk)
+        assert provider_config.get(provider.pk) is config
+    assert config.agency_api_version == "0.3"
+    assert config.swap_lat_lng is True
+
+    # Saving the provider invalidates the cache
+    provider.agency_api_configuration = {}
+    provider.save()
+    with django_assert_num_queries(1):
+        config = provider_config.get(provider.pk)
+    assert config.swap_lat_lng is False
+
+
+@pytest.mark.django_db
+def test_provider_config_ttl(settings, django_assert_num_queries):
+    settings.PROVIDER_CONFIG_CACHE_TTL = 0
+    provider = factories.Provider()
+
+    with django_assert_num_queries(2):
+        provider_config.get(provider.pk)
+        provider_config.get(provider.pk)